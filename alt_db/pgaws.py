@@ -4,7 +4,7 @@
 Program:     pgaws.py
 Author:      Jeff VanSickle
 Created:     20170117
-Modified:    20170117
+Modified:    20261017
 
 Program creates connection to AWS RDS instance and returns cursor to the
 instance and DB specified.
@@ -17,34 +17,221 @@ perms to that file. Once again, will move this to an encrypted string stored
 in an environment variable soon.
 
 UPDATES:
-    yyyymmdd JV - Changed something, commenting here
+    20261017 JV - Read connection settings once (get_config()) instead of on
+                  every call
+                  Add ConnectionManager, a thread-safe psycopg2 pool that
+                  hands out connections and commits or rolls back for you
+                  Add PostgresSink for collectTemp.py --pgsink: writes
+                  batches from sinkPipeline.py with execute_values,
+                  upserting on rectime, so a reading sent twice is harmless
+                  PGSSLMODE, PGPASSLOC and PGSSLROOTCERT are optional and
+                  PGPASSWORD may replace the password file, so a local
+                  Postgres works for testing
+                  catch_up() reads the Readings table in DBs moved over by
+                  migrateSchema.py
 
 INSTRUCTIONS:
     Use /etc/environment to define environment variables
+    For a local Postgres: PGINST=localhost PGPORT=5432 PGDB=temps
+    PGUSER=<USER> PGPASSWORD=<PASS> PGSSLMODE=disable
 
 TO DO:
     Set up PGP/GPG with Python to encrypt variables properly
 '''
 
 import psycopg2
+import psycopg2.pool
+import psycopg2.extras
 import os
+import threading
+from contextlib import contextmanager
 
-def create_cursor():
-    pginst = os.getenv('PGINST', None).strip().replace('"', '')     # RDS instance
-    pgport = os.getenv('PGPORT', None).strip().replace('"', '')     # Port
-    pgdb = os.getenv('PGDB', None).strip().replace('"', '')         # Database in RDS
-    pguser = os.getenv('PGUSER', None).strip().replace('"', '')     # Read-only!
-    pgsslmode = os.getenv('PGSSLMODE', None).strip().replace('"', '')    # verify-full
-    pgsslcert = '<AWS_RDS_CERT>'     # AWS gives you this cert
-    pgpassloc = '<YOUR_AWS_CONFIG>'  # Password stored here
+# Columns written by PostgresSink, same names as the SQLite Temps table
+COLUMNS = ['rectime', 'dsapi_read', 'owm_read', 'w2_read', 'wg_read', 'ds18b20_read',
+           'temps_mean', 'dsapi_delta', 'owm_delta', 'w2_delta', 'wg_delta',
+           'ds18b20_delta', 'outlier_flags']
+
+_config = None
+_config_lock = threading.Lock()
+
+
+def _env(name, default=None):
+    value = os.getenv(name, default)
+    if value is None:
+        return None
+    return value.strip().replace('"', '')
+
+def get_config():
+    ''' Connection settings as psycopg2.connect() keywords, read once '''
 
-    with open(pgpassloc, 'r') as passfile:
-        for item in passfile:
-            pgpass = item.strip()
+    global _config
 
-    conn_str = "host='{}' port='{}' dbname='{}' user='{}' password='{}' sslmode='{}' sslrootcert='{}'".format(pginst, pgport, pgdb, pguser, pgpass, pgsslmode, pgsslcert)
+    with _config_lock:
+        if _config is not None:
+            return _config
 
-    conn = psycopg2.connect(conn_str)
+        config = {'host': _env('PGINST'),                       # RDS instance
+                  'port': _env('PGPORT', '5432'),               # Port
+                  'dbname': _env('PGDB'),                       # Database in RDS
+                  'user': _env('PGUSER'),                       # Read-only, unless sinking
+                  'sslmode': _env('PGSSLMODE', 'verify-full')}
+
+        if config['sslmode'] not in ('disable', 'allow', 'prefer'):
+            config['sslrootcert'] = _env('PGSSLROOTCERT', '<AWS_RDS_CERT>')    # AWS gives you this cert
+
+        pgpass = _env('PGPASSWORD')
+        if pgpass is None:
+            pgpassloc = _env('PGPASSLOC', '<YOUR_AWS_CONFIG>')  # Password stored here
+            with open(pgpassloc, 'r') as passfile:
+                for item in passfile:
+                    pgpass = item.strip()
+        config['password'] = pgpass
+
+        _config = config
+        return _config
+
+def create_cursor():
+    conn = psycopg2.connect(**get_config())
     dbcursor = conn.cursor()
 
     return dbcursor
+
+
+class ConnectionManager:
+    ''' Pool of connections to one database, safe to share between threads '''
+
+    def __init__(self, minconn=0, maxconn=4, config=None):
+        self.pool = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn,
+                                                         **(config or get_config()))
+
+    @contextmanager
+    def connection(self):
+        '''
+        Lend a connection for a with block. Commits if the block finishes,
+        rolls back if it raises. Connections that broke are thrown away.
+        '''
+
+        conn = self.pool.getconn()
+        broken = False
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            broken = conn.closed != 0
+            if not broken:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    broken = True
+            raise
+        finally:
+            self.pool.putconn(conn, close=broken)
+
+    @contextmanager
+    def cursor(self):
+        with self.connection() as conn:
+            with conn.cursor() as dbcursor:
+                yield dbcursor
+
+    def close(self):
+        self.pool.closeall()
+
+
+_manager = None
+_manager_lock = threading.Lock()   # Not _config_lock: ConnectionManager() takes that
+
+def get_manager(maxconn=4):
+    ''' Module-wide ConnectionManager, created on first use '''
+
+    global _manager
+
+    with _manager_lock:
+        if _manager is None:
+            _manager = ConnectionManager(maxconn=maxconn)
+        return _manager
+
+
+class PostgresSink:
+    '''
+    Writes Temps rows to Postgres. sinkPipeline.py does the batching and
+    retrying and hands each batch to write_batch(). Rows are upserted on
+    rectime, so retrying a batch or catching up from SQLite never makes
+    duplicates.
+    '''
+
+    def __init__(self, manager=None, table='temps'):
+        self.manager = manager or get_manager()
+        self.table = table
+
+        updates = ', '.join('{0} = EXCLUDED.{0}'.format(column) for column in COLUMNS[1:])
+        self.upsert_sql = 'INSERT INTO {} ({}) VALUES %s ON CONFLICT (rectime) DO UPDATE SET {}'.format(
+                          table, ', '.join(COLUMNS), updates)
+
+    def create_table(self):
+        with self.manager.cursor() as dbcursor:
+            dbcursor.execute('''
+                    CREATE TABLE IF NOT EXISTS {}(
+                        rectime TEXT NOT NULL PRIMARY KEY,
+                        dsapi_read DOUBLE PRECISION,
+                        owm_read DOUBLE PRECISION,
+                        w2_read DOUBLE PRECISION,
+                        wg_read DOUBLE PRECISION,
+                        ds18b20_read DOUBLE PRECISION,
+                        temps_mean DOUBLE PRECISION,
+                        dsapi_delta DOUBLE PRECISION,
+                        owm_delta DOUBLE PRECISION,
+                        w2_delta DOUBLE PRECISION,
+                        wg_delta DOUBLE PRECISION,
+                        ds18b20_delta DOUBLE PRECISION,
+                        outlier_flags INTEGER NOT NULL DEFAULT 0)'''.format(self.table)
+            )
+
+    def write_batch(self, rows):
+        ''' Upsert list of row dicts now; raises psycopg2.Error on failure '''
+
+        unique = {str(row['rectime']): tuple(row.get(column) for column in COLUMNS) for row in rows}
+        self.write_rows([unique[rectime] for rectime in sorted(unique)])
+
+    def write_rows(self, rows):
+        with self.manager.cursor() as dbcursor:
+            psycopg2.extras.execute_values(dbcursor, self.upsert_sql, rows, page_size=1000)
+
+    def last_rectime(self):
+        with self.manager.cursor() as dbcursor:
+            dbcursor.execute('SELECT MAX(rectime) FROM {}'.format(self.table))
+            return dbcursor.fetchone()[0]
+
+    def catch_up(self, sqlite_conn, chunk_size=5000):
+        '''
+        Copy SQLite Temps rows newer than anything in Postgres, chunk_size
+        rows per statement. Returns rows copied.
+        '''
+
+        import migrateSchema
+        import tempsCommon
+
+        after = self.last_rectime() or ''
+        select = tempsCommon.select_columns(sqlite_conn, 'Temps', COLUMNS[1:])
+
+        # Migrated DBs: scan the epoch-keyed Readings table, not the view
+        if migrateSchema.schema_version(sqlite_conn) >= migrateSchema.SCHEMA_VERSION:
+            query = 'SELECT {}, rectime, {} FROM Readings WHERE rectime > ? ORDER BY rectime LIMIT ?'.format(
+                    migrateSchema.text_sql('rectime'), select)
+            position = migrateSchema.rectime_to_epoch(after) if after else -1
+        else:
+            query = 'SELECT rectime, rectime, {} FROM Temps WHERE rectime > ? ORDER BY rectime LIMIT ?'.format(select)
+            position = after
+
+        copied = 0
+        while True:
+            rows = sqlite_conn.execute(query, (position, chunk_size)).fetchall()
+            if not rows:
+                break
+            self.write_rows([(row[0],) + row[2:] for row in rows])
+            copied += len(rows)
+            position = rows[-1][1]
+
+        return copied
+
+    def close(self):
+        self.manager.close()
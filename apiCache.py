@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+'''
+Program:      apiCache.py
+Author:       Jeff VanSickle
+Created:      20261017
+Modified:     20261017
+
+Module caches weather API responses in SQLite so repeat polls inside a
+provider's refresh window don't spend API quota. Entries are keyed by
+provider and location. Each provider has its own time-to-live; once an
+entry is stale it is revalidated with If-None-Match/If-Modified-Since, and a
+304 answer keeps the cached body.
+
+The cache lives in a table (ApiCache) in whatever SQLite file you give it,
+normally the same file collectTemp.py writes, so it survives restarts. The
+table is kept to max_entries rows, dropping least-recently-used entries.
+Cache hits only note the time in memory; last_used is written along with
+the next store() or refresh(), just before entries are trimmed, so a hit
+costs no write to the DB.
+
+INSTRUCTIONS:
+    - Pass a ResponseCache to WeatherAPI(cache=...)
+'''
+
+import sqlite3
+import threading
+import time
+
+# Seconds a response stays fresh; roughly how often each provider updates
+# current conditions
+DEFAULT_TTLS = {'dsapi': 300,
+                'owm': 600,
+                'w2': 900,
+                'wg': 300}
+
+
+class ResponseCache:
+    """ SQLite-backed, size-bounded cache of API responses """
+
+    def __init__(self, db_path, ttls=None, max_entries=500):
+        self.ttls = dict(DEFAULT_TTLS)
+        if ttls:
+            self.ttls.update(ttls)
+        self.max_entries = max_entries
+        self.touched = {}       # (provider, location) -> last hit, not yet written
+
+        # API reads run on worker threads, so serialize use of the connection
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS ApiCache(
+                    provider TEXT NOT NULL,
+                    location TEXT NOT NULL,
+                    fetched REAL,
+                    last_used REAL,
+                    etag TEXT,
+                    last_modified TEXT,
+                    body TEXT,
+                    PRIMARY KEY (provider, location))'''
+        )
+        self.conn.commit()
+
+    def get(self, provider, location):
+        """ Return cached entry as dict (fresh flag included), or None """
+
+        with self.lock:
+            row = self.conn.execute('''SELECT fetched, etag, last_modified, body
+                    FROM ApiCache WHERE provider = ? AND location = ?''',
+                    (provider, location)).fetchone()
+            if row is None:
+                return None
+
+            now = time.time()
+            self.touched[(provider, location)] = now
+
+        fetched, etag, last_modified, body = row
+        return {'fresh': now - fetched < self.ttls.get(provider, 0),
+                'etag': etag,
+                'last_modified': last_modified,
+                'body': body}
+
+    def write_touches(self):
+        """ Write last_used for hits since the last write; hold self.lock """
+
+        if self.touched:
+            self.conn.executemany('''UPDATE ApiCache SET last_used = ?
+                    WHERE provider = ? AND location = ?''',
+                    [(used, provider, location) for (provider, location), used in self.touched.items()])
+            self.touched = {}
+
+    def conditional_headers(self, entry):
+        """ Build revalidation headers for a stale entry """
+
+        headers = {}
+        if entry is not None:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def store(self, provider, location, body, headers):
+        """ Save a 200 response, then trim table to max_entries """
+
+        now = time.time()
+        with self.lock:
+            self.write_touches()
+            self.conn.execute('''INSERT OR REPLACE INTO ApiCache
+                    (provider, location, fetched, last_used, etag, last_modified, body)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                    (provider, location, now, now, headers.get('etag'),
+                    headers.get('last-modified'), body))
+            self.conn.execute('''DELETE FROM ApiCache WHERE rowid IN
+                    (SELECT rowid FROM ApiCache ORDER BY last_used DESC
+                    LIMIT -1 OFFSET ?)''', (self.max_entries,))
+            self.conn.commit()
+
+    def refresh(self, provider, location):
+        """ Mark entry fresh again after a 304 Not Modified """
+
+        now = time.time()
+        with self.lock:
+            self.write_touches()
+            self.conn.execute('''UPDATE ApiCache SET fetched = ?, last_used = ?
+                    WHERE provider = ? AND location = ?''',
+                    (now, now, provider, location))
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.write_touches()
+            self.conn.commit()
+            self.conn.close()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+'''
+Program:      backfillStats.py
+Author:       Jeff VanSickle
+Created:      20261017
+Modified:     20261017
+
+Script recomputes temps_mean and the five *_delta columns for rows already
+in the Temps table. Use it after changing which readings count toward the
+mean, so that history follows the same rules as new readings.
+
+Rows are read in rectime order in chunks. Each chunk's means and deltas
+are worked out with NumPy in one go and written back with executemany() in
+the same transaction as a checkpoint. The checkpoint is the chunk's last
+rectime, so if the run is interrupted it picks up after the last finished
+chunk, even if migrateSchema.py moved the DB over in between. --restart
+starts over from the first row. DBs moved over by migrateSchema.py are read
+and updated through the Readings table.
+
+Rules match WeatherAPI.get_mean()/get_delta(): error readings (999.99) are
+left out of the mean, a row with no good readings gets a mean of 0.00, and
+an error reading's delta is 999.99. --sources limits which sources count
+toward the mean; every source still gets a delta against that mean.
+Readings set in outlier_flags (see streamStats.py) stay out of the mean.
+
+Hourly and daily rollups are rebuilt at the end, since they hold means.
+
+INSTRUCTIONS:
+    backfillStats.py -l <SQLITE_DB> [--sources dsapi owm w2 wg ds18b20]
+    - Requires NumPy
+'''
+
+import sqlite3
+import argparse
+import time
+import numpy as np
+import tempsRollup
+import streamStats
+import migrateSchema
+import tempsCommon
+from tempsCommon import ERR_READING
+
+SOURCES = ['dsapi', 'owm', 'w2', 'wg', 'ds18b20']
+CHECKPOINT_NAME = 'stats'
+
+
+def compute_stats(reads, use_sources, flags=None):
+    '''
+    reads is an (n, 5) float array of readings in SOURCES order, flags an
+    optional (n,) array of outlier bitmasks. Returns (means, deltas) where
+    deltas is (n, 5).
+    '''
+
+    good = reads < ERR_READING
+    counted = good & np.array([source in use_sources for source in SOURCES])
+    if flags is not None:
+        bits = np.array([streamStats.SOURCE_BITS[source] for source in SOURCES])
+        counted &= (flags[:, None] & bits) == 0
+
+    totals = np.where(counted, reads, 0.0).sum(axis=1)
+    counts = counted.sum(axis=1)
+    means = np.divide(totals, counts, out=np.zeros_like(totals), where=counts > 0)
+
+    deltas = np.where(good, reads - means[:, None], ERR_READING)
+
+    return means, deltas
+
+
+def backfill(temps_db, use_sources, chunk_size=5000, restart=False):
+    ''' Recompute means and deltas for all rows; returns number of rows done '''
+
+    # Checkpoints from before were Temps ids, which migrateSchema.py
+    # changes; those runs start over
+    if tempsCommon.has_column(temps_db, 'BackfillCheckpoint', 'last_id'):
+        temps_db.execute('DROP TABLE BackfillCheckpoint')
+    temps_db.execute('''
+            CREATE TABLE IF NOT EXISTS BackfillCheckpoint(
+                name TEXT NOT NULL PRIMARY KEY,
+                last_rectime TEXT NOT NULL)'''
+    )
+    if restart:
+        temps_db.execute('DELETE FROM BackfillCheckpoint WHERE name = ?', (CHECKPOINT_NAME,))
+    temps_db.commit()
+
+    row = temps_db.execute('SELECT last_rectime FROM BackfillCheckpoint WHERE name = ?',
+                           (CHECKPOINT_NAME,)).fetchone()
+    last_rectime = row[0] if row else ''
+    if last_rectime:
+        print('Resuming after {}'.format(last_rectime))
+
+    # Migrated DBs: epoch-keyed Readings, not the view
+    if migrateSchema.schema_version(temps_db) >= migrateSchema.SCHEMA_VERSION:
+        table, flags_column = 'Readings', 'outlier_flags'
+        position = migrateSchema.rectime_to_epoch(last_rectime) if last_rectime else -1
+    else:
+        table, flags_column = 'Temps', tempsCommon.select_columns(temps_db, 'Temps', ['outlier_flags'])
+        position = last_rectime
+
+    done = 0
+    while True:
+        rows = temps_db.execute('''SELECT rectime, dsapi_read, owm_read, w2_read, wg_read,
+                ds18b20_read, {} FROM {} WHERE rectime > ? ORDER BY rectime LIMIT ?'''.format(
+                flags_column, table), (position, chunk_size)).fetchall()
+        if not rows:
+            break
+
+        # NULL readings (shouldn't happen) count as errors
+        keys = [row[0] for row in rows]
+        chunk = np.array([row[1:] for row in rows], dtype=np.float64)
+        reads = np.nan_to_num(chunk[:, 0:5], nan=ERR_READING)
+        flags = chunk[:, 5].astype(np.int64)
+
+        means, deltas = compute_stats(reads, use_sources, flags)
+
+        updates = np.column_stack([means, deltas]).tolist()
+        position = keys[-1]
+        last_rectime = position if table == 'Temps' else \
+                       time.strftime('%Y%m%d%H%M%S', time.gmtime(position))
+
+        with temps_db:
+            temps_db.executemany('''UPDATE {} SET temps_mean = ?, dsapi_delta = ?,
+                    owm_delta = ?, w2_delta = ?, wg_delta = ?, ds18b20_delta = ?
+                    WHERE rectime = ?'''.format(table),
+                    [values + [key] for values, key in zip(updates, keys)])
+            temps_db.execute('INSERT OR REPLACE INTO BackfillCheckpoint (name, last_rectime) VALUES (?, ?)',
+                             (CHECKPOINT_NAME, last_rectime))
+
+        done += len(rows)
+
+    # Finished; next run starts from the top
+    temps_db.execute('DELETE FROM BackfillCheckpoint WHERE name = ?', (CHECKPOINT_NAME,))
+    temps_db.commit()
+
+    return done
+
+
+if __name__ == '__main__':
+    inputs = argparse.ArgumentParser()
+    inputs.add_argument('-l', '--localdb',
+                        required=True,
+                        help='Name of local SQLite DB to use')
+    inputs.add_argument('--sources',
+                        nargs='+',
+                        choices=SOURCES,
+                        default=SOURCES,
+                        help='Sources that count toward the mean (default all)')
+    inputs.add_argument('--chunk-size',
+                        type=int,
+                        default=5000,
+                        help='Rows per transaction (default 5000)')
+    inputs.add_argument('--restart',
+                        action='store_true',
+                        help='Ignore any checkpoint and start from the first row')
+    args = inputs.parse_args()
+
+    temps_db = sqlite3.connect(args.localdb)
+
+    start = time.time()
+    done = backfill(temps_db, set(args.sources), args.chunk_size, args.restart)
+    print('Recomputed {} rows in {:.1f} s'.format(done, time.time() - start))
+
+    tempsRollup.rebuild_rollups(temps_db)
+    temps_db.close()
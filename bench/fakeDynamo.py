@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+'''
+Program:      fakeDynamo.py
+Author:       Jeff VanSickle
+Created:      20261017
+Modified:     20261017
+
+Minimal local DynamoDB stand-in for benchmarks. It speaks enough of the
+DynamoDB JSON protocol for what collectTemp.py sends: BatchWriteItem,
+PutItem and UpdateItem. Pass its URL as --dynamo-endpoint (or
+dynamo_endpoint=) and boto3 talks to it like the real service.
+
+Items are counted, not stored. At unprocessed_rate, each item in a batch
+may come back in UnprocessedItems so the outbox retry path runs.
+
+INSTRUCTIONS:
+    fakeDynamo.py [--port 8322] [--latency 0.02] [--unprocessed-rate 0.05]
+    - boto3 still wants a region and credentials; any values do
+'''
+
+import http.server
+import threading
+import random
+import json
+import time
+import argparse
+
+
+class FakeDynamoHandler(http.server.BaseHTTPRequestHandler):
+    ''' One DynamoDB API call '''
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        fake = self.server.fake
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length) or b'{}')
+        action = self.headers.get('X-Amz-Target', '').split('.')[-1]
+
+        if fake.latency > 0:
+            time.sleep(fake.latency)
+
+        if action == 'BatchWriteItem':
+            unprocessed = {}
+            for table, writes in request.get('RequestItems', {}).items():
+                kept = [write for write in writes if random.random() < fake.unprocessed_rate]
+                fake.count(action, len(writes) - len(kept))
+                if kept:
+                    unprocessed[table] = kept
+            self.reply({'UnprocessedItems': unprocessed})
+        elif action in ('PutItem', 'UpdateItem'):
+            fake.count(action, 1)
+            self.reply({})
+        else:
+            self.reply({'__type': 'com.amazon.coral.validate#ValidationException',
+                        'message': 'fakeDynamo does not handle ' + action}, 400)
+
+    def reply(self, body, status=200):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/x-amz-json-1.0')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('x-amzn-RequestId', 'fake')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeDynamo:
+    ''' Threaded fake DynamoDB endpoint '''
+
+    def __init__(self, port=0, latency=0.0, unprocessed_rate=0.0):
+        self.latency = latency
+        self.unprocessed_rate = unprocessed_rate
+        self.items = {}         # Action -> items accepted
+        self.lock = threading.Lock()
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', port), FakeDynamoHandler)
+        self.server.daemon_threads = True
+        self.server.fake = self
+        self.port = self.server.server_address[1]
+
+    def count(self, action, items):
+        with self.lock:
+            self.items[action] = self.items.get(action, 0) + items
+
+    def endpoint(self):
+        return 'http://127.0.0.1:{}'.format(self.port)
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever,
+                         name='fake-dynamo', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == '__main__':
+    inputs = argparse.ArgumentParser()
+    inputs.add_argument('--port', type=int, default=8322)
+    inputs.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds before each answer')
+    inputs.add_argument('--unprocessed-rate', type=float, default=0.0,
+                        help='Fraction of batch items handed back unprocessed')
+    args = inputs.parse_args()
+
+    fake = FakeDynamo(args.port, args.latency, args.unprocessed_rate)
+    print('Serving fake DynamoDB at {}'.format(fake.endpoint()))
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+'''
+Program:      fakeProviders.py
+Author:       Jeff VanSickle
+Created:      20261017
+Modified:     20261017
+
+Local HTTP server that answers like the four weather APIs, for benchmarks
+and for running the collector with no internet. Every provider is served
+from one port:
+
+    /forecast/<key>/<lat>,<lon>         Dark Sky
+    /data/2.5/weather?...               OpenWeatherMap
+    /data/2.5/group?id=...              OpenWeatherMap multi-city
+    /developer/forecast.ashx?...        Weather2
+    /api/<key>/geolookup/conditions/... Wunderground
+
+Each request waits latency seconds (plus up to jitter more), then fails
+with HTTP 500 at fail_rate, or hangs for hang_seconds at hang_rate, so
+timeouts and error paths get exercised too. Connections are kept alive,
+as the real APIs do.
+
+INSTRUCTIONS:
+    fakeProviders.py [--port 8321] [--latency 0.05] [--fail-rate 0.1]
+    - In-process: server = FakeProviders(...).start(); server.install()
+      points WeatherAPI at it
+'''
+
+import http.server
+import threading
+import random
+import json
+import time
+import argparse
+import urllib.parse
+
+
+class FakeProviderHandler(http.server.BaseHTTPRequestHandler):
+    ''' One request; settings come from the server's FakeProviders object '''
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        fake = self.server.fake
+        fake.count(self.path)
+
+        delay = fake.latency + random.uniform(0, fake.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+        roll = random.random()
+        if roll < fake.fail_rate:
+            self.reply(500, {'error': 'fake failure'})
+            return
+        if roll < fake.fail_rate + fake.hang_rate:
+            time.sleep(fake.hang_seconds)
+
+        parts = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(parts.query)
+        temp = round(fake.base_temp + random.gauss(0, 1), 2)
+
+        if parts.path.startswith('/forecast/'):
+            body = {'currently': {'temperature': temp}}
+        elif parts.path == '/data/2.5/weather':
+            body = {'main': {'temp': temp}}
+        elif parts.path == '/data/2.5/group':
+            city_ids = query.get('id', [''])[0].split(',')
+            body = {'cnt': len(city_ids),
+                    'list': [{'id': int(city_id), 'main': {'temp': temp}}
+                             for city_id in city_ids if city_id]}
+        elif parts.path == '/developer/forecast.ashx':
+            body = {'weather': {'curren_weather': [{'temp': str(temp)}]}}
+        elif parts.path.startswith('/api/'):
+            body = {'current_observation': {'temp_f': temp}}
+        else:
+            self.reply(404, {'error': 'unknown path'})
+            return
+
+        self.reply(200, body)
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeProviders:
+    ''' Threaded fake API server with adjustable latency and failures '''
+
+    def __init__(self, port=0, latency=0.05, jitter=0.0, fail_rate=0.0,
+                 hang_rate=0.0, hang_seconds=30.0, base_temp=50.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.fail_rate = fail_rate
+        self.hang_rate = hang_rate
+        self.hang_seconds = hang_seconds
+        self.base_temp = base_temp
+        self.requests = {}
+        self.lock = threading.Lock()
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', port), FakeProviderHandler)
+        self.server.daemon_threads = True
+        self.server.fake = self
+        self.port = self.server.server_address[1]
+        self.thread = None
+
+    def count(self, path):
+        provider = path.split('/')[1] if '/' in path else path
+        with self.lock:
+            self.requests[provider] = self.requests.get(provider, 0) + 1
+
+    def base_url(self):
+        return 'http://127.0.0.1:{}'.format(self.port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       name='fake-providers', daemon=True)
+        self.thread.start()
+        return self
+
+    def install(self, api_class=None):
+        ''' Point WeatherAPI (or api_class) base URLs at this server '''
+
+        if api_class is None:
+            from weatherAPIs import WeatherAPI as api_class
+
+        base = self.base_url()
+        api_class.dsapi_URL = base + '/forecast/'
+        api_class.owm_URL = base + '/data/2.5/weather?'
+        api_class.owm_group_URL = base + '/data/2.5/group?'
+        api_class.w2_URL = base + '/developer/forecast.ashx?'
+        api_class.wg_URL = base + '/api/'
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == '__main__':
+    inputs = argparse.ArgumentParser()
+    inputs.add_argument('--port', type=int, default=8321)
+    inputs.add_argument('--latency', type=float, default=0.05,
+                        help='Seconds before each answer (default 0.05)')
+    inputs.add_argument('--jitter', type=float, default=0.0,
+                        help='Up to this many more seconds, at random')
+    inputs.add_argument('--fail-rate', type=float, default=0.0,
+                        help='Fraction of requests that get HTTP 500')
+    inputs.add_argument('--hang-rate', type=float, default=0.0,
+                        help='Fraction of requests that hang for --hang-seconds')
+    inputs.add_argument('--hang-seconds', type=float, default=30.0)
+    args = inputs.parse_args()
+
+    fake = FakeProviders(args.port, args.latency, args.jitter, args.fail_rate,
+                         args.hang_rate, args.hang_seconds)
+    print('Serving fake weather APIs at {}'.format(fake.base_url()))
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
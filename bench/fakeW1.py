@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+'''
+Program:      fakeW1.py
+Author:       Jeff VanSickle
+Created:      20261017
+Modified:     20261017
+
+Builds a fake 1-Wire sysfs tree that webTemp.py can read in place of
+/sys/bus/w1/devices. Each sensor gets a 28-<serial>/w1_slave file in the
+kernel's two-line format. Set W1_BASE_DIR to the tree before importing
+webTemp.
+
+INSTRUCTIONS:
+    fakeW1.py <DIR> [--sensors 3] [--temp 21.5]
+'''
+
+import os
+import argparse
+
+W1_SLAVE = '72 01 4b 46 7f ff 0e 10 57 : crc=57 {crc}\n72 01 4b 46 7f ff 0e 10 57 t={milli}\n'
+
+
+def write_sensor(base_dir, serial, temp_c, crc_ok=True):
+    ''' Write (or rewrite) one sensor's w1_slave file '''
+
+    device_dir = os.path.join(base_dir, '28-' + serial)
+    os.makedirs(device_dir, exist_ok=True)
+    with open(os.path.join(device_dir, 'w1_slave'), 'w') as slave:
+        slave.write(W1_SLAVE.format(crc='YES' if crc_ok else 'NO',
+                                    milli=int(round(temp_c * 1000))))
+
+
+def make_tree(base_dir, sensors=1, temp_c=21.5):
+    ''' Create sensors fake DS18B20s under base_dir; returns their IDs '''
+
+    serials = ['{:012x}'.format(0x5e2fdc3 + number) for number in range(sensors)]
+    for number, serial in enumerate(serials):
+        write_sensor(base_dir, serial, temp_c + 0.25 * number)
+    return ['28-' + serial for serial in serials]
+
+
+if __name__ == '__main__':
+    inputs = argparse.ArgumentParser()
+    inputs.add_argument('dir', help='Directory to hold the fake devices')
+    inputs.add_argument('--sensors', type=int, default=1)
+    inputs.add_argument('--temp', type=float, default=21.5,
+                        help='Temperature of the first sensor, Celsius')
+    args = inputs.parse_args()
+
+    for sensor in make_tree(args.dir, args.sensors, args.temp):
+        print(sensor)
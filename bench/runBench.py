@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+
+'''
+Program:      runBench.py
+Author:       Jeff VanSickle
+Created:      20261017
+Modified:     20261017
+
+Benchmarks the collector and the graphs end to end, with nothing leaving
+the machine: weather APIs come from fakeProviders.py, the DS18B20s from a
+fakeW1.py tree and DynamoDB from fakeDynamo.py. Everything runs in a
+scratch directory that is removed afterwards.
+
+Benchmarks:
+
+    cycle       collectTemp.Collector.run_cycle() against the fakes;
+                p50/p95/max seconds per cycle and peak RSS
+    insert      SQLite insert rate, one transaction per reading (as the
+                collector does, rollups included) and in batches
+    plot        for each table size (default 10k, 100k, 1M rows): time to
+                load every raw reading with tempsLoader, and wall time and
+                peak RSS of tempsPlotly.py runs
+
+Results are JSON. With --baseline, numbers that moved more than
+--threshold percent from an earlier results file are listed, so a
+regression shows up without reading the whole file.
+
+INSTRUCTIONS:
+    bench/runBench.py [-o results.json] [--sizes 10000 100000 1000000]
+                      [--only cycle insert plot] [--baseline old.json]
+    - Requires NumPy, Plotly and boto3, same as the scripts it runs
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import sqlite3
+import platform
+import resource
+import argparse
+import tempfile
+import subprocess
+import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+VIS_DIR = os.path.join(REPO_DIR, 'vis_tools')
+sys.path[:0] = [REPO_DIR, VIS_DIR, BENCH_DIR]
+
+import numpy as np
+from fakeProviders import FakeProviders
+from fakeDynamo import FakeDynamo
+import fakeW1
+
+# Plot runs per table size: (timeframe, resolution)
+PLOT_RUNS = [('all', 'auto'), ('all', 'raw'), ('weekly', 'raw')]
+
+
+def percentiles(samples):
+    samples = np.asarray(samples, dtype=np.float64)
+    return {'p50': float(np.percentile(samples, 50)),
+            'p95': float(np.percentile(samples, 95)),
+            'max': float(samples.max()),
+            'mean': float(samples.mean())}
+
+
+def peak_rss_mb():
+    ''' Peak RSS of this process; ru_maxrss is KB on Linux, bytes on macOS '''
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return usage.ru_maxrss / scale
+
+
+def setup_environment(work_dir, args):
+    ''' Start fakes and point the collector's environment at them '''
+
+    w1_dir = os.path.join(work_dir, 'w1')
+    fakeW1.make_tree(w1_dir, sensors=args.sensors)
+    os.environ['W1_BASE_DIR'] = w1_dir
+
+    for key in ['DS_APIKEY', 'OWM_APIKEY', 'W2_APIKEY', 'WG_APIKEY']:
+        os.environ[key] = 'bench'
+
+    # boto3 wants these even for a local endpoint; never use real ones here
+    os.environ['AWS_ACCESS_KEY_ID'] = 'bench'
+    os.environ['AWS_SECRET_ACCESS_KEY'] = 'bench'
+    os.environ['AWS_DEFAULT_REGION'] = 'us-east-1'
+
+    providers = FakeProviders(latency=args.latency, jitter=args.jitter,
+                              fail_rate=args.fail_rate).start()
+    providers.install()
+    dynamo = FakeDynamo(latency=args.dynamo_latency).start()
+
+    return providers, dynamo
+
+
+def new_collector(db_path, dynamo, **kwargs):
+    import collectTemp
+    # No quota pacing: every cycle should hit every provider
+    return collectTemp.Collector(db_path, 'bench_temps', 'bench_last_write', '40.0', '-75.0',
+                                 dynamo_endpoint=dynamo.endpoint(), use_scheduler=False, **kwargs)
+
+
+def bench_cycle(work_dir, dynamo, args):
+    ''' Latency of whole collection cycles '''
+
+    collector = new_collector(os.path.join(work_dir, 'cycle.db'), dynamo,
+                              source_timeout=args.source_timeout, use_cache=False)
+    times = []
+    try:
+        for cycle in range(args.cycles):
+            # rectime is unique to the second
+            time.sleep(1.01 - time.time() % 1)
+            start = time.perf_counter()
+            collector.run_cycle()
+            times.append(time.perf_counter() - start)
+    finally:
+        collector.close()
+
+    result = percentiles(times)
+    result.update({'cycles': args.cycles, 'peak_rss_mb': peak_rss_mb(),
+                   'dynamo_items': dynamo.items.get('BatchWriteItem', 0)})
+    return result
+
+
+def synthetic_rows(count, end=None, step_secs=180):
+    '''
+    count Readings rows, step_secs apart and ending now, as a list of tuples
+    (epoch seconds, 5 reads, mean, 5 deltas). About 1% of readings are
+    errors.
+    '''
+
+    from backfillStats import compute_stats, SOURCES
+
+    if end is None:
+        end = np.datetime64(datetime.datetime.utcnow().replace(microsecond=0), 's')
+    stamps = end - np.arange(count - 1, -1, -1, dtype=np.int64) * np.timedelta64(step_secs, 's')
+
+    # Daily swing plus a per-source offset and noise
+    hours = (stamps - stamps[0]).astype(np.int64) / 3600.0
+    base = 50 + 15 * np.sin(hours * 2 * np.pi / 24)
+    offsets = np.array([0.0, 1.0, -1.0, 0.5, -0.5])
+    rng = np.random.default_rng(17)
+    reads = np.round(base[:, None] + offsets + rng.normal(0, 0.75, (count, 5)), 2)
+    reads[rng.random((count, 5)) < 0.01] = 999.99
+
+    means, deltas = compute_stats(reads, set(SOURCES))
+    values = np.column_stack([reads, means, deltas]).tolist()
+
+    return [(epoch, *row) for epoch, row in zip(stamps.astype(np.int64).tolist(), values)]
+
+
+# The collector's table (see migrateSchema.py)
+INSERT_SQL = '''INSERT INTO Readings (rectime, dsapi_read, owm_read, w2_read, wg_read,
+        ds18b20_read, temps_mean, dsapi_delta, owm_delta, w2_delta, wg_delta,
+        ds18b20_delta) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''
+
+
+def create_db(db_path, dynamo):
+    ''' Empty DB with the collector's schema '''
+
+    new_collector(db_path, dynamo, use_cache=False).close()
+
+
+def bench_insert(work_dir, dynamo, args):
+    ''' SQLite insert rates '''
+
+    import tempsRollup
+
+    rows = synthetic_rows(args.insert_rows)
+    result = {'rows': args.insert_rows}
+
+    # One transaction per reading, rollups included, like the collector
+    db_path = os.path.join(work_dir, 'insert_txn.db')
+    create_db(db_path, dynamo)
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    start = time.perf_counter()
+    for row in rows:
+        cursor.execute(INSERT_SQL, row)
+        readings = dict(zip(['dsapi', 'owm', 'w2', 'wg', 'ds18b20', 'mean'], row[1:7]))
+        tempsRollup.update_rollups(cursor, time.strftime('%Y%m%d%H%M%S', time.gmtime(row[0])),
+                                   readings)
+        conn.commit()
+    elapsed = time.perf_counter() - start
+    conn.close()
+    result['per_reading_rows_per_sec'] = args.insert_rows / elapsed
+
+    # Many readings per transaction, no rollups
+    db_path = os.path.join(work_dir, 'insert_batch.db')
+    create_db(db_path, dynamo)
+    conn = sqlite3.connect(db_path)
+    start = time.perf_counter()
+    for offset in range(0, len(rows), 10000):
+        conn.executemany(INSERT_SQL, rows[offset:offset + 10000])
+        conn.commit()
+    elapsed = time.perf_counter() - start
+    conn.close()
+    result['batched_rows_per_sec'] = args.insert_rows / elapsed
+
+    return result
+
+
+# Runs a script and reports its own peak RSS. A child's ru_maxrss starts at
+# the parent's high-water mark on Linux, so the child has to measure itself.
+MEASURE_WRAPPER = '''
+import os, sys, runpy
+script = sys.argv[1]
+sys.argv = sys.argv[1:]
+sys.path.insert(0, os.path.dirname(script))
+try:
+    runpy.run_path(script, run_name='__main__')
+finally:
+    try:
+        with open('/proc/self/status') as status:
+            peak = [line.split()[1] for line in status if line.startswith('VmHWM')][0]
+    except OSError:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    sys.stderr.write('\\nPEAK_RSS_KB ' + str(peak) + '\\n')
+'''
+
+
+def run_python(script, script_args):
+    ''' Run a Python script; returns (seconds, peak RSS MB, return code) '''
+
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-c', MEASURE_WRAPPER, script] + script_args,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    elapsed = time.perf_counter() - start
+
+    peak_kb = None
+    for line in proc.stderr.splitlines():
+        if line.startswith('PEAK_RSS_KB '):
+            peak_kb = int(line.split()[1])
+    if proc.returncode != 0:
+        print('{} failed: {}'.format(script, proc.stderr[-500:]), file=sys.stderr)
+
+    return elapsed, peak_kb / 1024 if peak_kb is not None else None, proc.returncode
+
+
+def bench_plot(work_dir, dynamo, args):
+    ''' Query and graph time by table size '''
+
+    import tempsLoader
+    import tempsRollup
+
+    results = {}
+    for size in args.sizes:
+        db_path = os.path.join(work_dir, 'plot_{}.db'.format(size))
+        create_db(db_path, dynamo)
+
+        conn = sqlite3.connect(db_path)
+        start = time.perf_counter()
+        rows = synthetic_rows(size)
+        for offset in range(0, size, 50000):
+            conn.executemany(INSERT_SQL, rows[offset:offset + 50000])
+            conn.commit()
+        del rows
+        tempsRollup.rebuild_rollups(conn)
+        setup_secs = time.perf_counter() - start
+
+        start = time.perf_counter()
+        columns = tempsLoader.loadTemps(conn, '''SELECT rectime, dsapi_read, owm_read,
+                w2_read, wg_read, ds18b20_read, temps_mean FROM Readings
+                WHERE temps_mean < 150.00 ORDER BY rectime''')
+        query_secs = time.perf_counter() - start
+        conn.close()
+
+        size_result = {'setup_secs': setup_secs,
+                       'query_all_raw_secs': query_secs,
+                       'query_rows': int(len(columns['rectime']))}
+        del columns
+
+        out_dir = os.path.join(work_dir, 'plots_{}'.format(size))
+        os.makedirs(out_dir, exist_ok=True)
+        for timeframe, resolution in PLOT_RUNS:
+            elapsed, rss, code = run_python(os.path.join(VIS_DIR, 'tempsPlotly.py'),
+                    ['-t', timeframe, '-r', resolution, '-d', db_path, '-o', out_dir + '/'])
+            size_result['plot_{}_{}'.format(timeframe, resolution)] = {
+                    'secs': elapsed, 'peak_rss_mb': rss, 'ok': code == 0}
+
+        results[str(size)] = size_result
+        os.remove(db_path)
+
+    return results
+
+
+def flatten(results, prefix=''):
+    ''' Dotted key -> number for every numeric leaf '''
+
+    flat = {}
+    for key, value in results.items():
+        name = prefix + key
+        if isinstance(value, dict):
+            flat.update(flatten(value, name + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def compare(baseline, current, threshold):
+    ''' Print metrics that moved more than threshold percent '''
+
+    old = flatten(baseline.get('results', {}))
+    new = flatten(current['results'])
+    for name in sorted(set(old) & set(new)):
+        if old[name] == 0:
+            continue
+        change = 100.0 * (new[name] - old[name]) / abs(old[name])
+        if abs(change) >= threshold:
+            print('{}: {:.4g} -> {:.4g} ({:+.1f}%)'.format(name, old[name], new[name], change),
+                  file=sys.stderr)
+
+
+def main():
+    inputs = argparse.ArgumentParser()
+    inputs.add_argument('-o', '--out',
+                        default=None,
+                        help='Write results JSON here (default stdout)')
+    inputs.add_argument('--only',
+                        nargs='+',
+                        choices=['cycle', 'insert', 'plot'],
+                        default=['cycle', 'insert', 'plot'],
+                        help='Benchmarks to run (default all)')
+    inputs.add_argument('--sizes',
+                        nargs='+',
+                        type=int,
+                        default=[10000, 100000, 1000000],
+                        help='Temps table sizes for the plot benchmark')
+    inputs.add_argument('--cycles', type=int, default=10,
+                        help='Collection cycles to time (one per second)')
+    inputs.add_argument('--insert-rows', type=int, default=2000,
+                        help='Rows for the insert benchmark')
+    inputs.add_argument('--sensors', type=int, default=1,
+                        help='Fake DS18B20s on the bus')
+    inputs.add_argument('--latency', type=float, default=0.05,
+                        help='Fake API latency, seconds')
+    inputs.add_argument('--jitter', type=float, default=0.05,
+                        help='Extra random fake API latency, up to this many seconds')
+    inputs.add_argument('--fail-rate', type=float, default=0.0,
+                        help='Fraction of fake API calls that fail')
+    inputs.add_argument('--dynamo-latency', type=float, default=0.01,
+                        help='Fake DynamoDB latency, seconds')
+    inputs.add_argument('--source-timeout', type=float, default=2.0,
+                        help='Collector per-source timeout, seconds')
+    inputs.add_argument('--baseline',
+                        default=None,
+                        help='Earlier results JSON to compare against')
+    inputs.add_argument('--threshold', type=float, default=10.0,
+                        help='Percent change --baseline reports (default 10)')
+    args = inputs.parse_args()
+
+    random.seed(17)
+    work_dir = tempfile.mkdtemp(prefix='fahrensight_bench_')
+    providers, dynamo = setup_environment(work_dir, args)
+
+    try:
+        git_rev = subprocess.run(['git', '-C', REPO_DIR, 'rev-parse', '--short', 'HEAD'],
+                                 capture_output=True, text=True).stdout.strip()
+    except OSError:
+        git_rev = None
+
+    output = {'meta': {'started': datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S'),
+                       'git': git_rev or None,
+                       'python': platform.python_version(),
+                       'machine': platform.machine(),
+                       'platform': platform.platform(),
+                       'settings': vars(args)},
+              'results': {}}
+
+    benchmarks = {'cycle': bench_cycle, 'insert': bench_insert, 'plot': bench_plot}
+    try:
+        for name in args.only:
+            start = time.perf_counter()
+            output['results'][name] = benchmarks[name](work_dir, dynamo, args)
+            print('{} done in {:.1f} s'.format(name, time.perf_counter() - start), file=sys.stderr)
+    finally:
+        providers.stop()
+        dynamo.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    text = json.dumps(output, indent=2, sort_keys=True)
+    if args.out:
+        with open(args.out, 'w') as out_file:
+            out_file.write(text + '\n')
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as baseline_file:
+            compare(json.load(baseline_file), output, args.threshold)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+'''
+Program:      collectMetrics.py
+Author:       Jeff VanSickle
+Created:      20261017
+Modified:     20261017
+
+Module keeps counters, gauges and latency histograms for the collector and
+serves them in Prometheus text format, so the slow stage on the Pi can be
+found without a profiler. Everything records into one module-level
+registry, REGISTRY; weatherAPIs.py, outbox.py and collectTemp.py all use
+it. Recording is a dict update under a lock and costs next to nothing when
+no one is scraping.
+
+Metrics recorded:
+
+    weather_fetch_seconds{provider}         HTTP round trip per API call
+    weather_parse_seconds{provider}         JSON parse per API call
+    weather_cache_total{provider,result}    hit, revalidated or miss
+    weather_errors_total{provider,kind}     http, exception, json,
+                                            rate_limited
+    source_read_seconds{source}             whole read, per source
+    source_timeouts_total{source}           reads that missed get_all()'s
+                                            deadline
+    source_busy_total{source}               reads skipped because earlier
+                                            ones were still running
+    dynamo_batch_seconds                    one BatchWriteItem call
+    dynamo_retries_total                    resends of unprocessed items
+    dynamo_errors_total                     failed flushes
+    dynamo_items_written_total
+    outbox_depth                            items waiting for DynamoDB
+    sink_queue_depth{sink}                  readings waiting, per sink
+    sink_lag_seconds{sink}                  age of oldest unwritten reading
+    sink_write_seconds{sink}                one batch write
+    sink_{written,dropped,spilled,errors}_total{sink}
+    provider_calls_today{provider}          network calls against the daily
+                                            quota (pollScheduler.py)
+    provider_breaker_open{provider}         1 while a provider is skipped
+    cycle_stage_seconds{stage}              read, stats, sqlite, publish,
+                                            total
+    collector_cycles_total{result}          ok or failed
+
+collectTemp.py also writes one CycleTimings row per cycle with the stage
+times, outbox depth and error count (see write_cycle()).
+
+INSTRUCTIONS:
+    - collectTemp.py --metrics-port 9108 serves http://127.0.0.1:9108/metrics
+'''
+
+import http.server
+import threading
+import time
+from contextlib import contextmanager
+
+# Seconds; covers a cached read up to a provider timing out
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+CYCLE_STAGES = ['read', 'stats', 'sqlite', 'publish', 'total']
+
+
+def _label_key(labels):
+    return tuple(sorted((labels or {}).items()))
+
+
+def _format_labels(key, extra=None):
+    pairs = list(key) + (extra or [])
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('"', '\\"'))
+                          for name, value in pairs) + '}'
+
+
+class Registry:
+    ''' Thread-safe store of counters, gauges and histograms '''
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.counters = {}      # name -> {label key: value}
+        self.gauges = {}
+        self.histograms = {}    # name -> {label key: [bucket counts, sum, count]}
+
+    def inc(self, name, labels=None, amount=1):
+        key = _label_key(labels)
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def set(self, name, value, labels=None):
+        with self.lock:
+            self.gauges.setdefault(name, {})[_label_key(labels)] = value
+
+    def observe(self, name, value, labels=None):
+        key = _label_key(labels)
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            hist = series.get(key)
+            if hist is None:
+                hist = series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for position, bound in enumerate(self.buckets):
+                if value <= bound:
+                    hist[0][position] += 1
+                    break
+            hist[1] += value
+            hist[2] += 1
+
+    @contextmanager
+    def timer(self, name, labels=None):
+        ''' Observe the time spent inside a with block '''
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, labels)
+
+    def value(self, name, labels=None):
+        ''' Current counter or gauge value, 0 if never set '''
+
+        key = _label_key(labels)
+        with self.lock:
+            for store in (self.counters, self.gauges):
+                if name in store and key in store[name]:
+                    return store[name][key]
+        return 0
+
+    def render(self):
+        ''' Everything in Prometheus text exposition format '''
+
+        lines = []
+        with self.lock:
+            for name in sorted(self.counters):
+                lines.append('# TYPE {} counter'.format(name))
+                for key, value in sorted(self.counters[name].items()):
+                    lines.append('{}{} {}'.format(name, _format_labels(key), value))
+
+            for name in sorted(self.gauges):
+                lines.append('# TYPE {} gauge'.format(name))
+                for key, value in sorted(self.gauges[name].items()):
+                    lines.append('{}{} {}'.format(name, _format_labels(key), value))
+
+            for name in sorted(self.histograms):
+                lines.append('# TYPE {} histogram'.format(name))
+                for key, (counts, total, count) in sorted(self.histograms[name].items()):
+                    cumulative = 0
+                    for bound, bucket_count in zip(self.buckets, counts):
+                        cumulative += bucket_count
+                        lines.append('{}_bucket{} {}'.format(
+                                     name, _format_labels(key, [('le', bound)]), cumulative))
+                    lines.append('{}_bucket{} {}'.format(
+                                 name, _format_labels(key, [('le', '+Inf')]), count))
+                    lines.append('{}_sum{} {}'.format(name, _format_labels(key), total))
+                    lines.append('{}_count{} {}'.format(name, _format_labels(key), count))
+
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    ''' Serves REGISTRY at /metrics '''
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        body = REGISTRY.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass    # Scrapes every 15 s would flood the log
+
+
+def start_server(port, host='127.0.0.1'):
+    ''' Serve metrics from a daemon thread; returns the server '''
+
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics', daemon=True)
+    thread.start()
+    return server
+
+
+def create_timings_table(cursor):
+    cursor.execute('''
+            CREATE TABLE IF NOT EXISTS CycleTimings(
+                rectime TEXT NOT NULL PRIMARY KEY,
+                read_secs REAL,
+                stats_secs REAL,
+                sqlite_secs REAL,
+                publish_secs REAL,
+                total_secs REAL,
+                outbox_depth INTEGER,
+                errors INTEGER)'''
+    )
+
+
+def write_cycle(cursor, rectime, stages, outbox_depth, errors):
+    '''
+    Record one cycle: stages is dict of stage name -> seconds. Each stage
+    also goes into cycle_stage_seconds. Caller commits.
+    '''
+
+    for stage, seconds in stages.items():
+        REGISTRY.observe('cycle_stage_seconds', seconds, {'stage': stage})
+
+    cursor.execute('''INSERT OR REPLACE INTO CycleTimings
+            (rectime, read_secs, stats_secs, sqlite_secs, publish_secs, total_secs,
+            outbox_depth, errors) VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+            (rectime, *[stages.get(stage) for stage in CYCLE_STAGES], outbox_depth, errors))
@@ -4,7 +4,7 @@
 Program:      collectTemp.py
 Author:       Jeff VanSickle
 Created:      20160813
-Modified:     20171101
+Modified:     20261017
 
 Script imports the WeatherAPI class and uses its functions to pull data from
 five sources (four APIs and a local temp sensor):
@@ -30,127 +30,302 @@ UPDATES:
                   Configure for input parameters
     20171014 JV - Add options to write "last-write" DynamoDB table
     20171101 JV - Add check on None return from temp retrieval, exit cleanly
+    20261017 JV - Read all sources concurrently with per-source and per-cycle
+                  deadlines
+                  Add --daemon mode: set up DBs and API objects once, then
+                  collect on a fixed schedule until SIGTERM
+                  Cache API responses in the local DB (apiCache.py) so
+                  polls inside a provider's refresh window cost no quota
+                  Queue DynamoDB items in a local outbox (outbox.py) and
+                  send them in batches; add --dynamo-endpoint for testing
+                  against DynamoDB Local
+                  Keep hourly and daily rollups current (tempsRollup.py)
+                  In daemon mode, read the DS18B20 continuously in the
+                  background (--sample-interval) and report stats for the
+                  interval between collections
+                  Store every DS18B20 on the bus: SensorReads table in
+                  SQLite, ds18b20_<serial>_read attributes in DynamoDB
+                  Flag readings that stray from the other sources
+                  (streamStats.py) and leave them out of the mean; flags
+                  go in Temps.outlier_flags (--outlier-sigma, 0 to disable)
+                  Time each stage of a cycle into a CycleTimings row and
+                  serve collectMetrics.py counters and histograms in
+                  Prometheus format (--metrics-port)
+                  Bring back the Postgres copy (--pgsink): pooled
+                  connections and batched upserts through alt_db/pgaws.py,
+                  catching up from SQLite at start-up
+                  Hand readings to background sinks (sinkPipeline.py) once
+                  the SQLite commit lands: DynamoDB, Postgres, and
+                  optionally a mirror SQLite DB (--mirror-db) and a
+                  JSON-lines file (--jsonl); a slow target no longer holds
+                  up the next poll
+                  Pace API calls to each provider's daily quota and stop
+                  calling providers that keep failing (pollScheduler.py);
+                  skipped providers carry their last reading forward.
+                  --quota PROVIDER=CALLS overrides a quota, --no-scheduler
+                  calls every API every cycle as before
+                  In daemon mode, store DS18B20 readings in SensorReads
+                  every --sensor-interval seconds between collections
+                  New DBs get the compact Readings table keyed on epoch
+                  seconds (migrateSchema.py); readings go straight into
+                  it once a DB is migrated
+                  Move run_daemon() to daemonLoop.py
+                  Put the local DB in WAL mode so readers don't block the
+                  cycle's commit
+                  Mark carried-forward readings in outlier_flags and keep
+                  them out of streamStats.py and the rollups
 
 INSTRUCTIONS:
     - Set up SYSLAT and SYSLON environment variables for your location
+    - Run once per cron entry, or with --daemon [--interval SECONDS] to keep
+      running and collect on its own schedule
+    - With the scheduler, --interval can be well under three minutes; APIs
+      are only called as often as their quotas allow
 '''
 
 from weatherAPIs import WeatherAPI
+from apiCache import ResponseCache
+from outbox import Outbox
+from pollScheduler import PollScheduler
+from daemonLoop import run_daemon
+from sinkPipeline import (SinkPipeline, Sink, DynamoWriter, PostgresWriter,
+                          SQLiteWriter, JsonLinesWriter)
+import tempsRollup
+import streamStats
+import migrateSchema
+import collectMetrics
+from collectMetrics import REGISTRY
 import os
 import time
 import datetime
+import calendar
 import sqlite3
+import signal
+import threading
 import boto3
+import webTemp
 import argparse
 from decimal import *
 
 getcontext().prec = 2
-dynamo_put_success = False
-
-# Get input(s)
-inputs = argparse.ArgumentParser()
-inputs.add_argument('-l', '--localdb',
-                    required=True,
-                    help='Name of local SQLite DB to use')
-inputs.add_argument('-d', '--awsdb',
-                   required=True,
-                   help='Name of DynamoDB table to use')
-inputs.add_argument('-t', '--timestampdb',
-                    required=True,
-                    help='Name of DynamoDB holding last-write timestamp')
-args = inputs.parse_args()
-dynamo_table = args.awsdb
-local_db = args.localdb
-timestamp_table = args.timestampdb
-
-# Set up SQLite DB
-temps_db = sqlite3.connect(local_db)
-sqlite_cursor = temps_db.cursor()
-
-# Create DynamoDB client
-dynamo_db = boto3.resource('dynamodb')
-
-# Connect to DynamoDB resource
-try:
-    aws_cursor = dynamo_db.Table(dynamo_table)
-except:
-    print('Error connecting to DynamoDB table {}. Check name and try again.'.format(dynamo_table))
-    quit()
-
-try:
-    last_write_db = dynamo_db.Table(timestamp_table)
-except:
-    print('Error connecting to DynamoDB table {}. Check name and try again.'.format(timestamp_table))
-    quit()
-
-# Create main DB table if it doesn't exist
-sqlite_cursor.execute('''
-        CREATE TABLE IF NOT EXISTS Temps(
-            id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE,
-            rectime TEXT UNIQUE,
-            dsapi_read REAL,
-            owm_read REAL,
-            w2_read REAL,
-            wg_read REAL,
-            ds18b20_read REAL,
-            temps_mean REAL,
-            dsapi_delta REAL,
-            owm_delta REAL,
-            w2_delta REAL,
-            wg_delta REAL,
-            ds18b20_delta REAL)'''
-)
-
-# Geo coordinates (approx) of my home location
-lat = os.getenv('SYSLAT', None)
-lon = os.getenv('SYSLON', None)
-
-# Can't proceed without a proper location
-if lat is None or lon is None:
-    print('System geo coordinates not defined. Exiting....')
-    quit()
-
-# Temperature object
-tempf_obj = WeatherAPI(lat, lon)
-
-timestamp = datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S')
-
-# Read from sources
-DSAPI_read = tempf_obj.get_DSAPI()
-OWM_read = tempf_obj.get_OWM()
-W2_read =  tempf_obj.get_W2()
-WG_read =  tempf_obj.get_WG()
-DS18B20_read = tempf_obj.get_DS18B20()
-
-if None in [DSAPI_read, OWM_read, W2_read, WG_read, DS18B20_read]:
-    print('Problem retrieving one or more readings. Exiting....')
-    sqlite_cursor.close()
-    quit()
-
-# Get mean
-temps_mean = tempf_obj.get_mean(DSAPI_read, OWM_read, W2_read, WG_read, DS18B20_read)
-
-# Get deltas from the mean
-DSAPI_delta = tempf_obj.get_delta(DSAPI_read, temps_mean)
-OWM_delta = tempf_obj.get_delta(OWM_read, temps_mean)
-W2_delta = tempf_obj.get_delta(W2_read, temps_mean)
-WG_delta = tempf_obj.get_delta(WG_read, temps_mean)
-DS18B20_delta = tempf_obj.get_delta(DS18B20_read, temps_mean)
-
-# Write to local DB
-sqlite_cursor.execute('''INSERT INTO Temps
-        (rectime, dsapi_read, owm_read, w2_read, wg_read, ds18b20_read,
-        temps_mean, dsapi_delta, owm_delta, w2_delta, wg_delta, ds18b20_delta)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-        (timestamp, DSAPI_read, OWM_read, W2_read, WG_read, DS18B20_read,
-        temps_mean, DSAPI_delta, OWM_delta, W2_delta, WG_delta, DS18B20_delta))
-
-temps_db.commit()
-
-# Write to DynamoDB
-try:
-    aws_cursor.put_item(
-        Item={
+
+# Most cycles a partly filled Postgres batch waits for more readings
+PG_LINGER_CYCLES = 3
+
+
+class Collector:
+    ''' Holds DB handles and the WeatherAPI object between collection cycles '''
+
+    def __init__(self, local_db, dynamo_table, timestamp_table, lat, lon,
+                 source_timeout=10.0, cycle_timeout=30.0, use_cache=True,
+                 dynamo_endpoint=None, sample_interval=None, outlier_sigma=4.0,
+                 pg_batch=None, pg_linger=0.0, mirror_db=None, jsonl_file=None,
+                 sink_timeout=30.0, quotas=None, use_scheduler=True):
+        self.source_timeout = source_timeout
+        self.cycle_timeout = cycle_timeout
+        self.sink_timeout = sink_timeout
+
+        # Set up SQLite DB
+        self.temps_db = sqlite3.connect(local_db)
+        self.sqlite_cursor = self.temps_db.cursor()
+
+        # Create DynamoDB client
+        dynamo_db = boto3.resource('dynamodb', endpoint_url=dynamo_endpoint)
+
+        # Connect to DynamoDB resource
+        try:
+            self.aws_cursor = dynamo_db.Table(dynamo_table)
+        except:
+            raise SystemExit('Error connecting to DynamoDB table {}. Check name and try again.'.format(dynamo_table))
+
+        try:
+            self.last_write_db = dynamo_db.Table(timestamp_table)
+        except:
+            raise SystemExit('Error connecting to DynamoDB table {}. Check name and try again.'.format(timestamp_table))
+
+        # Create main DB table if it doesn't exist; DBs from before
+        # migrateSchema.py keep their Temps table until migrated
+        migrateSchema.create_schema(self.temps_db)
+
+        # Older DBs predate outlier flags
+        streamStats.add_flags_column(self.sqlite_cursor)
+
+        # One row per sensor per reading when there are several DS18B20s
+        self.sqlite_cursor.execute('''
+                CREATE TABLE IF NOT EXISTS SensorReads(
+                    rectime TEXT NOT NULL,
+                    sensor_id TEXT NOT NULL,
+                    temp_f REAL,
+                    PRIMARY KEY (rectime, sensor_id))'''
+        )
+
+        # Hourly/daily aggregates for the visualizations
+        tempsRollup.create_rollups(self.sqlite_cursor)
+
+        # Per-stage time for every cycle
+        collectMetrics.create_timings_table(self.sqlite_cursor)
+
+        # Rolling per-source statistics for outlier checks
+        self.stream_stats = None
+        if outlier_sigma:
+            self.stream_stats = streamStats.StreamStats(self.temps_db, sigma=outlier_sigma)
+
+        # Which APIs to call each cycle, within their daily quotas
+        self.scheduler = None
+        if use_scheduler:
+            self.scheduler = PollScheduler(self.temps_db, quotas=quotas)
+        self.temps_db.commit()
+
+        # WAL lets readers (tempsServer.py, the graphs) run while a cycle
+        # commits; the setting stays with the DB file. Set after
+        # create_schema(), since a new DB's auto_vacuum must come first
+        self.temps_db.execute('PRAGMA journal_mode = WAL')
+
+        # Readings not yet written to DynamoDB
+        self.outbox = Outbox(self.temps_db)
+
+        # Cache API responses alongside readings so the cache survives restarts
+        self.api_cache = ResponseCache(local_db) if use_cache else None
+
+        # Read the sensor continuously so cycles don't wait on it
+        self.sampler = None
+        if sample_interval:
+            self.sampler = webTemp.Sampler(interval=sample_interval)
+            self.sampler.start()
+
+        # Everything past the SQLite commit happens in background sinks.
+        # The outbox holds every DynamoDB item, so that sink can drop nudges.
+        spill_dir = os.path.join(os.path.dirname(os.path.abspath(local_db)), 'spill')
+        self.sinks = SinkPipeline()
+        self.sinks.add(Sink('dynamo', DynamoWriter(local_db, self.aws_cursor, self.last_write_db),
+                            queue_size=10, policy='drop_oldest'))
+
+        # Optional Postgres copy; psycopg2 only needed if it's used
+        if pg_batch:
+            from alt_db import pgaws
+            pg_sink = pgaws.PostgresSink()
+            try:
+                pg_sink.create_table()
+                copied = pg_sink.catch_up(self.temps_db)
+                if copied:
+                    print('Copied {} missed reading(s) to Postgres'.format(copied))
+            except pgaws.psycopg2.Error as err:
+                print('Error catching up Postgres: {}'.format(err))
+            self.sinks.add(Sink('postgres', PostgresWriter(pg_sink), queue_size=500,
+                                policy='spill', spill_dir=spill_dir,
+                                batch_size=pg_batch, linger=pg_linger))
+
+        if mirror_db:
+            self.sinks.add(Sink('mirror', SQLiteWriter(mirror_db), queue_size=500,
+                                policy='spill', spill_dir=spill_dir))
+        if jsonl_file:
+            self.sinks.add(Sink('jsonl', JsonLinesWriter(jsonl_file), policy='block'))
+
+        # Temperature object
+        self.tempf_obj = WeatherAPI(lat, lon, timeout=source_timeout,
+                                    cache=self.api_cache, sampler=self.sampler,
+                                    limiters=self.scheduler.counters() if self.scheduler else None)
+
+    def run_cycle(self):
+        ''' Read all sources once and store the results; True on success '''
+
+        tempf_obj = self.tempf_obj
+        cycle_time = datetime.datetime.utcnow()
+        timestamp = cycle_time.strftime('%Y%m%d%H%M%S')
+        stages = {}
+        cycle_start = time.perf_counter()
+
+        # Read from sources, all at once
+        carried = set()
+        if self.scheduler is None:
+            readings = tempf_obj.get_all(source_timeout=self.source_timeout,
+                                         cycle_timeout=self.cycle_timeout)
+        else:
+            # Only the APIs that are due and not failing; the rest carry
+            # their last good reading forward
+            due = self.scheduler.plan()
+            readings = tempf_obj.get_all(source_timeout=self.source_timeout,
+                                         cycle_timeout=self.cycle_timeout,
+                                         sources=due | {'ds18b20'})
+            self.scheduler.record(readings, due, tempf_obj.err_reading)
+            self.scheduler.save()
+            for provider in self.scheduler.quotas:
+                if provider not in due:
+                    readings[provider] = self.scheduler.carried(provider, tempf_obj.err_reading)
+                    if readings[provider] != tempf_obj.err_reading:
+                        carried.add(provider)
+        stats_start = time.perf_counter()
+        stages['read'] = stats_start - cycle_start
+        DSAPI_read = readings['dsapi']
+        OWM_read = readings['owm']
+        W2_read = readings['w2']
+        WG_read = readings['wg']
+        DS18B20_read = readings['ds18b20']
+
+        if None in [DSAPI_read, OWM_read, W2_read, WG_read, DS18B20_read]:
+            print('Problem retrieving one or more readings.')
+            self.temps_db.commit()      # Keep the quota counts
+            REGISTRY.inc('collector_cycles_total', {'result': 'failed'})
+            return False
+
+        ds_stats = tempf_obj.ds18b20_stats
+        if ds_stats is not None and ds_stats['count'] > 0:
+            print('{}: DS18B20 {} samples, min {:.2f} max {:.2f} mean {:.2f}, {} CRC failures'.format(
+                  timestamp, ds_stats['count'], ds_stats['min'], ds_stats['max'],
+                  ds_stats['mean'], webTemp.crc_failures))
+
+        # Flag outliers and keep them out of the mean; carried readings are
+        # marked, not judged
+        outlier_flags = streamStats.carried_flags(carried)
+        if self.stream_stats is not None:
+            found = self.stream_stats.check(readings, tempf_obj.err_reading, carried)
+            self.stream_stats.save()
+            if found:
+                print('{}: Outlier reading(s) from {}'.format(
+                      timestamp, ', '.join(streamStats.flagged_sources(found))))
+            outlier_flags |= found
+
+        mean_reads = [tempf_obj.err_reading if outlier_flags & streamStats.SOURCE_BITS[source]
+                      else readings[source] for source in streamStats.SOURCES]
+
+        # Get mean
+        temps_mean = tempf_obj.get_mean(*mean_reads)
+
+        # Get deltas from the mean
+        DSAPI_delta = tempf_obj.get_delta(DSAPI_read, temps_mean)
+        OWM_delta = tempf_obj.get_delta(OWM_read, temps_mean)
+        W2_delta = tempf_obj.get_delta(W2_read, temps_mean)
+        WG_delta = tempf_obj.get_delta(WG_read, temps_mean)
+        DS18B20_delta = tempf_obj.get_delta(DS18B20_read, temps_mean)
+
+        sqlite_start = time.perf_counter()
+        stages['stats'] = sqlite_start - stats_start
+
+        # Migrated DBs key readings on epoch seconds (see migrateSchema.py);
+        # checked each cycle so a daemon picks up a migration
+        if migrateSchema.schema_version(self.temps_db) >= migrateSchema.SCHEMA_VERSION:
+            row_time, insert_sql = calendar.timegm(cycle_time.timetuple()), migrateSchema.INSERT_SQL
+        else:
+            row_time, insert_sql = timestamp, migrateSchema.LEGACY_INSERT_SQL
+
+        # Write to local DB and queue for DynamoDB in one transaction
+        self.sqlite_cursor.execute(insert_sql,
+                (row_time, DSAPI_read, OWM_read, W2_read, WG_read, DS18B20_read,
+                temps_mean, DSAPI_delta, OWM_delta, W2_delta, WG_delta, DS18B20_delta,
+                outlier_flags))
+
+        sensor_reads = tempf_obj.sensor_reads
+        self.sqlite_cursor.executemany('''INSERT OR REPLACE INTO SensorReads
+                (rectime, sensor_id, temp_f) VALUES (?, ?, ?)''',
+                [(timestamp, sensor, temp) for sensor, temp in sensor_reads.items()])
+
+        # Rollups only count a source when it was actually read
+        readings['mean'] = temps_mean
+        tempsRollup.update_rollups(self.sqlite_cursor, timestamp,
+                                   {source: reading for source, reading in readings.items()
+                                    if source not in carried})
+
+        dynamo_item = {
             'rectime': str(timestamp),
             'dsapi_read': Decimal(str(DSAPI_read)),
             'owm_read': Decimal(str(OWM_read)),
@@ -162,22 +337,211 @@ try:
             'owm_delta': Decimal(str(OWM_delta)),
             'w2_delta': Decimal(str(W2_delta)),
             'wg_delta': Decimal(str(WG_delta)),
-            'ds18b20_delta': Decimal(str(DS18B20_delta))
+            'ds18b20_delta': Decimal(str(DS18B20_delta)),
+            'outlier_flags': outlier_flags
             }
-        )
-    dynamo_put_success = True
-except:
-    print('{}: Error writing DynamoDB.'.format(datetime.datetime.utcnow()))
+        for sensor, temp in sensor_reads.items():
+            dynamo_item['ds18b20_' + sensor.replace('-', '_') + '_read'] = Decimal(str(temp))
+        self.outbox.add(dynamo_item)
+
+        self.temps_db.commit()
+
+        publish_start = time.perf_counter()
+        stages['sqlite'] = publish_start - sqlite_start
+
+        # Reading is durable; the sinks (DynamoDB via the outbox, etc.) drain
+        # in the background
+        self.sinks.publish({'rectime': timestamp,
+                            'dsapi_read': DSAPI_read, 'owm_read': OWM_read,
+                            'w2_read': W2_read, 'wg_read': WG_read,
+                            'ds18b20_read': DS18B20_read, 'temps_mean': temps_mean,
+                            'dsapi_delta': DSAPI_delta, 'owm_delta': OWM_delta,
+                            'w2_delta': W2_delta, 'wg_delta': WG_delta,
+                            'ds18b20_delta': DS18B20_delta,
+                            'outlier_flags': outlier_flags})
+
+        cycle_end = time.perf_counter()
+        stages['publish'] = cycle_end - publish_start
+        stages['total'] = cycle_end - cycle_start
+
+        errors = sum(1 for source in tempf_obj.sources
+                     if readings[source] == tempf_obj.err_reading)
+        # Depth now, not the gauge from the last background flush
+        collectMetrics.write_cycle(self.sqlite_cursor, timestamp, stages,
+                                   self.outbox.depth(), errors)
+        self.temps_db.commit()
+        REGISTRY.inc('collector_cycles_total', {'result': 'ok'})
+
+        return True
+
+    def record_sensors(self):
+        ''' Store every DS18B20's newest reading in SensorReads '''
+
+        tempf_obj = self.tempf_obj
+        timestamp = datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S')
+
+        if self.sampler is None:
+            all_temps = webTemp.read_all()
+        else:
+            read_time = time.time()
+            all_temps = {}
+            for sensor in self.sampler.sensors():
+                sample = self.sampler.latest(sensor)
+                # Don't store the same stale sample over and over
+                if sample is not None and read_time - sample[0] <= 3 * self.sampler.interval + 5:
+                    all_temps[sensor] = sample[1:]
+
+        rows = [(timestamp, sensor, tempf_obj.format_DS18B20(temps))
+                for sensor, temps in all_temps.items() if temps is not None]
+        self.sqlite_cursor.executemany('''INSERT OR REPLACE INTO SensorReads
+                (rectime, sensor_id, temp_f) VALUES (?, ?, ?)''', rows)
+        self.temps_db.commit()
+
+        return len(rows)
+
+    def close(self):
+        ''' Clean up SQLite cursor and connection, close API connections '''
+
+        if self.sampler is not None:
+            self.sampler.stop()
+
+        # Give the sinks a chance to finish what's queued
+        self.sinks.close(self.sink_timeout)
+
+        self.sqlite_cursor.close()
+        self.temps_db.close()
+        self.tempf_obj.close()
+        if self.api_cache is not None:
+            self.api_cache.close()
+
+
+def main():
+    # Get input(s)
+    inputs = argparse.ArgumentParser()
+    inputs.add_argument('-l', '--localdb',
+                        required=True,
+                        help='Name of local SQLite DB to use')
+    inputs.add_argument('-d', '--awsdb',
+                       required=True,
+                       help='Name of DynamoDB table to use')
+    inputs.add_argument('-t', '--timestampdb',
+                        required=True,
+                        help='Name of DynamoDB holding last-write timestamp')
+    inputs.add_argument('--source-timeout',
+                        type=float,
+                        default=10.0,
+                        help='Seconds to wait on any one source (default 10)')
+    inputs.add_argument('--cycle-timeout',
+                        type=float,
+                        default=30.0,
+                        help='Seconds to wait on all sources together (default 30)')
+    inputs.add_argument('--daemon',
+                        action='store_true',
+                        help='Keep running and collect every --interval seconds')
+    inputs.add_argument('--interval',
+                        type=float,
+                        default=180.0,
+                        help='Seconds between collections in daemon mode (default 180)')
+    inputs.add_argument('--sensor-interval',
+                        type=float,
+                        default=30.0,
+                        help='Seconds between DS18B20 rows in SensorReads in daemon mode (default 30; 0 only with collections)')
+    inputs.add_argument('--quota',
+                        action='append',
+                        default=[],
+                        metavar='PROVIDER=CALLS',
+                        help='Daily call quota for dsapi, owm, w2 or wg; repeat for each provider to change')
+    inputs.add_argument('--no-scheduler',
+                        action='store_true',
+                        help='Call every API every cycle, ignoring quotas and failures')
+    inputs.add_argument('--sample-interval',
+                        type=float,
+                        default=5.0,
+                        help='Seconds between background DS18B20 reads in daemon mode (default 5; 0 reads once per cycle)')
+    inputs.add_argument('--outlier-sigma',
+                        type=float,
+                        default=4.0,
+                        help='Standard deviations before a reading is left out of the mean (default 4; 0 disables)')
+    inputs.add_argument('--metrics-port',
+                        type=int,
+                        default=None,
+                        help='Serve Prometheus metrics on this local port (default off)')
+    inputs.add_argument('--pgsink',
+                        action='store_true',
+                        help='Also write readings to Postgres (settings from PG* environment variables)')
+    inputs.add_argument('--pg-batch',
+                        type=int,
+                        default=20,
+                        help='Readings per Postgres write with --pgsink (default 20)')
+    inputs.add_argument('--mirror-db',
+                        default=None,
+                        help='Also copy readings to the Temps table of this SQLite DB')
+    inputs.add_argument('--jsonl',
+                        default=None,
+                        help='Also append readings to this file as JSON lines')
+    inputs.add_argument('--sink-timeout',
+                        type=float,
+                        default=30.0,
+                        help='Seconds to let background writes finish at exit (default 30)')
+    inputs.add_argument('--no-cache',
+                        action='store_true',
+                        help='Always query the APIs instead of using cached responses')
+    inputs.add_argument('--dynamo-endpoint',
+                        default=None,
+                        help='DynamoDB endpoint URL, e.g. http://localhost:8000 for DynamoDB Local')
+    args = inputs.parse_args()
+
+    quotas = {}
+    for quota in args.quota:
+        provider, _, calls = quota.partition('=')
+        if provider not in WeatherAPI.sources or provider == 'ds18b20' or not calls.isdigit():
+            inputs.error('--quota wants PROVIDER=CALLS with PROVIDER one of dsapi, owm, w2, wg')
+        quotas[provider] = int(calls)
+
+    # Geo coordinates (approx) of my home location
+    lat = os.getenv('SYSLAT', None)
+    lon = os.getenv('SYSLON', None)
+
+    # Can't proceed without a proper location
+    if lat is None or lon is None:
+        print('System geo coordinates not defined. Exiting....')
+        quit()
+
+    collector = Collector(args.localdb, args.awsdb, args.timestampdb, lat, lon,
+                          source_timeout=args.source_timeout,
+                          cycle_timeout=args.cycle_timeout,
+                          use_cache=not args.no_cache,
+                          dynamo_endpoint=args.dynamo_endpoint,
+                          sample_interval=args.sample_interval if args.daemon else None,
+                          outlier_sigma=args.outlier_sigma,
+                          pg_batch=args.pg_batch if args.pgsink else None,
+                          pg_linger=args.interval * min(args.pg_batch - 1, PG_LINGER_CYCLES)
+                                    if args.daemon else 0.0,
+                          mirror_db=args.mirror_db,
+                          jsonl_file=args.jsonl,
+                          sink_timeout=args.sink_timeout,
+                          quotas=quotas,
+                          use_scheduler=not args.no_scheduler)
+
+    if args.metrics_port:
+        collectMetrics.start_server(args.metrics_port)
+
+    if not args.daemon:
+        if not collector.run_cycle():
+            print('Exiting....')
+        collector.close()
+        return
+
+    # Finish the current cycle and exit cleanly on SIGTERM/SIGINT
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop_event.set())
 
-if dynamo_put_success:
     try:
-        last_write_db.update_item(
-                Key={'id': 1},
-                UpdateExpression='SET rectime = :updatedate',
-                ExpressionAttributeValues={':updatedate': timestamp}
-                )
-    except:
-        print('{}: Error writing last-write DB'.format(datetime.datetime.utcnow()))
-
-# Clean up SQLite cursor
-sqlite_cursor.close()
+        run_daemon(collector, args.interval, stop_event, sensor_interval=args.sensor_interval)
+    finally:
+        collector.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+'''
+Program:      daemonLoop.py
+Author:       Jeff VanSickle
+Created:      20261017
+Modified:     20261017
+
+Module runs a collector's jobs on a fixed schedule for --daemon mode. It is
+shared by collectTemp.py and fleetCollect.py and imports nothing but the
+standard library, so using it doesn't pull in either collector's
+dependencies.
+
+INSTRUCTIONS:
+    run_daemon(collector, interval, stop_event[, sensor_interval])
+    - collector needs run_cycle(), and record_sensors() if sensor_interval
+      is given
+'''
+
+import datetime
+import time
+
+
+def run_daemon(collector, interval, stop_event, sensor_interval=None):
+    '''
+    Run collection cycles every interval seconds until stop_event is set,
+    and with sensor_interval, store DS18B20 readings that often in between.
+    Start times are fixed offsets from the first run, so time spent inside
+    a job doesn't push later runs back. Slots missed because a job overran
+    are skipped rather than run back to back.
+    '''
+
+    start = time.monotonic()
+    jobs = [['Collection cycle', collector.run_cycle, interval, start]]
+    if sensor_interval:
+        jobs.append(['Sensor read', collector.record_sensors, sensor_interval, start])
+
+    while not stop_event.is_set():
+        job = min(jobs, key=lambda job: job[3])
+        name, run, every, next_run = job
+        now = time.monotonic()
+        if next_run > now:
+            stop_event.wait(next_run - now)
+            continue
+
+        try:
+            run()
+        except Exception as err:
+            print('{}: {} failed: {}'.format(datetime.datetime.utcnow(), name, err))
+
+        next_run += every
+        now = time.monotonic()
+        if next_run <= now:
+            missed = int((now - next_run) // every) + 1
+            print('{}: {} overran, skipping {} slot(s)'.format(datetime.datetime.utcnow(), name, missed))
+            next_run += missed * every
+        job[3] = next_run
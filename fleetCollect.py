@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+
+'''
+Program:      fleetCollect.py
+Author:       Jeff VanSickle
+Created:      20261017
+Modified:     20261017
+
+Script collects API temperatures for many locations from one process. It
+is collectTemp.py for sites that have no DS18B20 of their own. All sites
+share one HTTP connection pool, one response cache and one thread pool,
+and each provider has a single rate limit across all sites. Sites with an
+OpenWeatherMap city ID are read with multi-city group queries, 20 cities
+per request.
+
+Readings go to the FleetTemps table in the SQLite DB, keyed by location
+name and rectime.
+
+Locations file is JSON:
+
+    {
+        "interval": 180,
+        "max_workers": 8,
+        "rate_limits": {"dsapi": {"rate": 1.0, "burst": 2},
+                        "owm": {"rate": 1.0, "burst": 2},
+                        "w2": {"rate": 0.5, "burst": 1},
+                        "wg": {"rate": 0.5, "burst": 1}},
+        "locations": [
+            {"name": "home", "lat": "40.0", "lon": "-75.0", "owm_id": 5197079},
+            {"name": "cabin", "lat": "41.2", "lon": "-77.1"}
+        ]
+    }
+
+Everything except "locations" is optional. Rates are calls per second.
+
+A read that needs a network call waits for its provider's token, but
+only until the last moment a call can still finish before the cycle
+deadline (--cycle-timeout less --source-timeout), so the calls spread out
+over the cycle. A read still without a token then is deferred: it is
+stored as NULL (not polled), not as an error reading, and the deferred
+sites go first in the next cycle. Reads served from the cache don't use a
+token. Keep rate * cycle timeout above the number of sites per provider,
+or some sites are deferred every cycle.
+
+INSTRUCTIONS:
+    fleetCollect.py -l <SQLITE_DB> -c <LOCATIONS_JSON> [--daemon]
+    - API keys come from the same environment variables as weatherAPIs.py
+'''
+
+from weatherAPIs import WeatherAPI
+from httpPool import ConnectionPool
+from apiCache import ResponseCache
+from rateLimit import RateLimiter
+from daemonLoop import run_daemon
+import concurrent.futures
+import datetime
+import argparse
+import json
+import signal
+import sqlite3
+import threading
+import time
+
+OWM_GROUP_SIZE = 20     # Most city IDs OpenWeatherMap takes in one query
+DEFAULT_RATE = {'rate': 1.0, 'burst': 2}
+
+
+class DeadlineLimiter:
+    '''
+    Shared RateLimiter that waits no later than the collector's acquire_by
+    time. When no token comes free by then, the read running on this
+    thread is marked deferred.
+    '''
+
+    def __init__(self, limiter, collector):
+        self.limiter = limiter
+        self.collector = collector
+
+    def acquire(self, timeout=None):
+        wait_for = max(0.0, self.collector.acquire_by - time.monotonic())
+        if self.limiter.acquire(timeout=wait_for):
+            return True
+        self.collector.defer()
+        return False
+
+
+class FleetCollector:
+    ''' Collects every configured location each cycle with shared resources '''
+
+    def __init__(self, local_db, config, source_timeout=10.0, cycle_timeout=60.0):
+        self.source_timeout = source_timeout
+        self.cycle_timeout = cycle_timeout
+        self.acquire_by = 0.0       # monotonic(); last moment to wait for a token
+
+        # Set up SQLite DB
+        self.temps_db = sqlite3.connect(local_db)
+        self.temps_db.execute('''
+                CREATE TABLE IF NOT EXISTS FleetTemps(
+                    location TEXT NOT NULL,
+                    rectime TEXT NOT NULL,
+                    dsapi_read REAL,
+                    owm_read REAL,
+                    w2_read REAL,
+                    wg_read REAL,
+                    temps_mean REAL,
+                    PRIMARY KEY (location, rectime))'''
+        )
+        self.temps_db.commit()
+
+        locations = config['locations']
+        max_workers = config.get('max_workers', 8)
+
+        # Shared by every site
+        self.pool = ConnectionPool(max_per_host=max_workers, timeout=source_timeout)
+        self.cache = ResponseCache(local_db, max_entries=max(500, 8 * len(locations)))
+        rate_limits = config.get('rate_limits', {})
+        self.limiters = {provider: DeadlineLimiter(RateLimiter(**rate_limits.get(provider, DEFAULT_RATE)),
+                                                      self)
+                         for provider in ['dsapi', 'owm', 'w2', 'wg']}
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+
+        # Reads deferred for lack of a rate-limit token; keys as in run_cycle()
+        self.current = threading.local()
+        self.deferred_lock = threading.Lock()
+        self.deferred = set()
+
+        self.sites = []
+        for site in locations:
+            api = WeatherAPI(str(site['lat']), str(site['lon']), timeout=source_timeout,
+                             pool=self.pool, cache=self.cache, limiters=self.limiters)
+            self.sites.append((site, api))
+
+    def defer(self):
+        ''' Mark the read running on this thread as deferred '''
+
+        with self.deferred_lock:
+            self.deferred.add(self.current.key)
+
+    def read(self, key, reader, *args):
+        self.current.key = key
+        return reader(*args)
+
+    def run_cycle(self):
+        ''' Read all sources for all sites and store the results '''
+
+        timestamp = datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S')
+        futures = {}
+
+        # Reads deferred last cycle are submitted first, so they get the
+        # first tokens this time
+        with self.deferred_lock:
+            last_deferred, self.deferred = self.deferred, set()
+        reads = []
+
+        # Sites with an OWM city ID share group queries
+        owm_sites = [(site, api) for site, api in self.sites if 'owm_id' in site]
+        for start in range(0, len(owm_sites), OWM_GROUP_SIZE):
+            group = owm_sites[start:start + OWM_GROUP_SIZE]
+            reads.append((('group', start), group[0][1].get_OWM_group,
+                          [[site['owm_id'] for site, api in group]]))
+
+        for site, api in self.sites:
+            readers = {'dsapi': api.get_DSAPI, 'w2': api.get_W2, 'wg': api.get_WG}
+            if 'owm_id' not in site:
+                readers['owm'] = api.get_OWM
+            for provider, reader in readers.items():
+                reads.append(((site['name'], provider), reader, []))
+
+        reads.sort(key=lambda read: read[0] not in last_deferred)
+        self.acquire_by = time.monotonic() + max(0.0, self.cycle_timeout - self.source_timeout)
+        for key, reader, args in reads:
+            futures[key] = self.executor.submit(self.read, key, reader, *args)
+
+        done, late = concurrent.futures.wait(futures.values(), timeout=self.cycle_timeout)
+        for future in late:
+            future.cancel()
+
+        results = {}
+        for key, future in futures.items():
+            if future in done and future.exception() is None:
+                results[key] = future.result()
+
+        with self.deferred_lock:
+            deferred = set(self.deferred)
+
+        # Spread group answers back out to their sites
+        owm_group = {}
+        for key, temps in results.items():
+            if key[0] == 'group':
+                owm_group.update(temps)
+        for key in deferred:
+            if key[0] == 'group':
+                start = key[1]
+                owm_group.update({str(site['owm_id']): None
+                                  for site, api in owm_sites[start:start + OWM_GROUP_SIZE]})
+
+        rows = []
+        for site, api in self.sites:
+            name = site['name']
+            reads = [None if (name, provider) in deferred else results.get((name, provider), api.err_reading)
+                     for provider in ['dsapi', 'owm', 'w2', 'wg']]
+            if 'owm_id' in site:
+                reads[1] = owm_group.get(str(site['owm_id']), api.err_reading)
+
+            # Deferred reads are NULL in FleetTemps and left out of the mean
+            mean_reads = [api.err_reading if read is None else read for read in reads]
+            temps_mean = api.get_mean(*mean_reads, api.err_reading)
+            rows.append((name, timestamp, *reads, temps_mean))
+
+        self.temps_db.executemany('''INSERT OR REPLACE INTO FleetTemps
+                (location, rectime, dsapi_read, owm_read, w2_read, wg_read, temps_mean)
+                VALUES (?, ?, ?, ?, ?, ?, ?)''', rows)
+        self.temps_db.commit()
+
+        if late:
+            print('{}: {} source read(s) missed the cycle deadline'.format(
+                  datetime.datetime.utcnow(), len(late)))
+        if deferred:
+            print('{}: {} source read(s) deferred by rate limits'.format(
+                  datetime.datetime.utcnow(), len(deferred)))
+
+        return True
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.temps_db.close()
+        self.cache.close()
+        self.pool.close()
+
+
+def main():
+    inputs = argparse.ArgumentParser()
+    inputs.add_argument('-l', '--localdb',
+                        required=True,
+                        help='Name of local SQLite DB to use')
+    inputs.add_argument('-c', '--config',
+                        required=True,
+                        help='JSON file listing locations to collect')
+    inputs.add_argument('--source-timeout',
+                        type=float,
+                        default=10.0,
+                        help='Seconds to wait on any one source (default 10)')
+    inputs.add_argument('--cycle-timeout',
+                        type=float,
+                        default=60.0,
+                        help='Seconds to wait on all sites together (default 60)')
+    inputs.add_argument('--daemon',
+                        action='store_true',
+                        help='Keep running and collect every interval seconds')
+    args = inputs.parse_args()
+
+    with open(args.config, 'r') as config_file:
+        config = json.load(config_file)
+
+    collector = FleetCollector(args.localdb, config,
+                               source_timeout=args.source_timeout,
+                               cycle_timeout=args.cycle_timeout)
+
+    if not args.daemon:
+        collector.run_cycle()
+        collector.close()
+        return
+
+    # Finish the current cycle and exit cleanly on SIGTERM/SIGINT
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop_event.set())
+
+    try:
+        run_daemon(collector, config.get('interval', 180), stop_event)
+    finally:
+        collector.close()
+
+
+if __name__ == '__main__':
+    main()
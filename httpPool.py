@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+'''
+Program:      httpPool.py
+Author:       Jeff VanSickle
+Created:      20261017
+Modified:     20261017
+
+Module keeps HTTP(S) connections to the weather API hosts open between
+requests. urlopen() builds a new TCP connection (and TLS session for Dark
+Sky) on every call; on a Pi Model B the handshake is a big part of each
+fetch. A long-running collector can reuse keep-alive connections instead.
+
+Responses are requested gzip-compressed and decoded here. Per-host counters
+show how often a connection was reused versus opened fresh.
+
+INSTRUCTIONS:
+    - Create one ConnectionPool and share it between WeatherAPI objects
+'''
+
+import http.client
+import urllib.parse
+import threading
+import gzip
+import zlib
+
+# Errors that mean a kept-alive connection was closed by the far end
+STALE_ERRORS = (http.client.RemoteDisconnected, http.client.BadStatusLine,
+                ConnectionResetError, BrokenPipeError)
+
+
+class ConnectionPool:
+    """ Keep-alive HTTP(S) connections, pooled per host """
+
+    def __init__(self, max_per_host=2, timeout=10.0, max_redirects=3):
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.max_redirects = max_redirects
+        self.lock = threading.Lock()
+        self.idle = {}          # (scheme, host, port) -> [connection, ...]
+        self.counters = {}      # host -> {'new': n, 'reused': n}
+
+    def _count(self, host, key):
+        with self.lock:
+            host_counts = self.counters.setdefault(host, {'new': 0, 'reused': 0})
+            host_counts[key] += 1
+
+    def _get_conn(self, key, timeout):
+        """ Return (connection, reused) for key, opening one if none idle """
+
+        with self.lock:
+            conns = self.idle.get(key)
+            conn = conns.pop() if conns else None
+
+        if conn is not None:
+            self._count(key[1], 'reused')
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            return conn, True
+
+        scheme, host, port = key
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(host, port, timeout=timeout)
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=timeout)
+        self._count(host, 'new')
+        return conn, False
+
+    def _put_conn(self, key, conn):
+        with self.lock:
+            conns = self.idle.setdefault(key, [])
+            if len(conns) < self.max_per_host:
+                conns.append(conn)
+                return
+        conn.close()
+
+    def _send(self, key, path, headers, timeout):
+        """ Send one GET on a pooled connection; retry once if it was stale """
+
+        conn, reused = self._get_conn(key, timeout)
+        try:
+            conn.request('GET', path, headers=headers)
+            resp = conn.getresponse()
+        except STALE_ERRORS:
+            conn.close()
+            if not reused:
+                raise
+            conn, reused = self._get_conn(key, timeout)
+            try:
+                conn.request('GET', path, headers=headers)
+                resp = conn.getresponse()
+            except Exception:
+                conn.close()
+                raise
+        except Exception:
+            conn.close()
+            raise
+
+        try:
+            body = resp.read()      # Must drain body before reusing socket
+        except Exception:
+            conn.close()
+            raise
+
+        if resp.will_close:
+            conn.close()
+        else:
+            self._put_conn(key, conn)
+
+        return resp, body
+
+    def request(self, url, headers=None, timeout=None):
+        """
+        GET url and return (status, headers, body). Headers come back as a
+        dict with lower-case names; body is bytes with gzip already decoded.
+        Redirects are followed up to max_redirects.
+        """
+
+        if timeout is None:
+            timeout = self.timeout
+
+        send_headers = {'Accept-Encoding': 'gzip', 'Connection': 'keep-alive'}
+        if headers:
+            send_headers.update(headers)
+
+        for redirect in range(self.max_redirects + 1):
+            parts = urllib.parse.urlsplit(url)
+            scheme = parts.scheme or 'http'
+            port = parts.port or (443 if scheme == 'https' else 80)
+            key = (scheme, parts.hostname, port)
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+
+            resp, body = self._send(key, path, send_headers, timeout)
+            resp_headers = {name.lower(): value for name, value in resp.getheaders()}
+
+            if resp.status in (301, 302, 303, 307, 308) and 'location' in resp_headers:
+                url = urllib.parse.urljoin(url, resp_headers['location'])
+                continue
+            break
+
+        encoding = resp_headers.get('content-encoding', '').lower()
+        if encoding == 'gzip':
+            body = gzip.decompress(body)
+        elif encoding == 'deflate':
+            body = zlib.decompress(body)
+
+        return resp.status, resp_headers, body
+
+    def stats(self):
+        """ Return copy of per-host counters of new and reused connections """
+
+        with self.lock:
+            return {host: dict(counts) for host, counts in self.counters.items()}
+
+    def close(self):
+        """ Close all idle connections """
+
+        with self.lock:
+            conns = [conn for host_conns in self.idle.values() for conn in host_conns]
+            self.idle = {}
+        for conn in conns:
+            conn.close()
@@ -0,0 +1,463 @@
+#!/usr/bin/env python3
+
+'''
+Program:      importTemps.py
+Author:       Jeff VanSickle
+Created:      20261017
+Modified:     20261017
+
+Script loads historical readings into the local DB in bulk, from:
+
+    CSV/TSV     a header row naming the columns, either as in Temps
+                (rectime, dsapi_read, ...) or as in tempsVis.py's data.tsv
+                (date, Dark Sky API, ...). Files without a header are read
+                in data.tsv column order. Times may be YYYYMMDDHHMMSS,
+                ISO 8601 (UTC) or epoch seconds; empty readings load as
+                999.99. Deltas are worked out from the mean, and the mean
+                too where the file has none or it is blank (same rules as
+                backfillStats.py).
+    SQLite      another collector DB, old-style Temps or migrated Readings
+
+Text files are read in chunks of --chunk-rows lines and parsed in a pool
+of worker processes, a few chunks ahead of the writer, so memory stays
+flat however big the file. Parsed rows go into a temporary staging table
+with no indexes, using executemany() in large transactions. Staging lives
+in SQLite's temp store, so the collector isn't held up while files load.
+
+The staged rows are then indexed once and merged in rectime order,
+--batch-rows per transaction, with INSERT OR IGNORE: rows whose rectime is
+already in the DB (or earlier in the import) are skipped, so importing
+the same file twice does nothing. Other indexes on the target table are
+dropped for the merge and created again after. Rows falling in periods
+tempsRetention.py has already folded into 15-minute aggregates are skipped
+too, so they aren't counted twice. Rollups are rebuilt for the days that
+were loaded. Each import that adds rows notes the oldest day it loaded in
+the ImportLog table, so tempsVis.py rebuilds data.tsv instead of missing
+rows older than its watermark.
+
+INSTRUCTIONS:
+    importTemps.py -l <SQLITE_DB> <FILE> [<FILE> ...] [--workers 4]
+                   [--chunk-rows 50000] [--batch-rows 100000] [--no-rollups]
+    - Requires NumPy
+'''
+
+import os
+import csv
+import sqlite3
+import argparse
+import calendar
+import collections
+import itertools
+import concurrent.futures
+import time
+import numpy as np
+import backfillStats
+import migrateSchema
+import tempsRetention
+import tempsRollup
+import tempsCommon
+from tempsCommon import ERR_READING
+
+READ_COLUMNS = ['dsapi_read', 'owm_read', 'w2_read', 'wg_read', 'ds18b20_read']
+
+# data.tsv header names (see tempsVis.py) -> Temps column
+TSV_COLUMNS = collections.OrderedDict([('date', 'rectime'),
+                                       ('dark sky api', 'dsapi_read'),
+                                       ('openweathermap', 'owm_read'),
+                                       ('weather2', 'w2_read'),
+                                       ('wunderground', 'wg_read'),
+                                       ('home', 'ds18b20_read'),
+                                       ('mean', 'temps_mean')])
+
+STAGE_TABLE = 'temp.ImportStage'
+STAGE_INSERT_SQL = 'INSERT INTO {} (rectime, {}) VALUES (?, {})'.format(
+                   STAGE_TABLE, ', '.join(migrateSchema.DATA_COLUMNS),
+                   ', '.join('?' * len(migrateSchema.DATA_COLUMNS)))
+
+SQLITE_MAGIC = b'SQLite format 3\x00'
+
+# Characters dropped from ISO 8601 times before reading the digits
+TIME_PUNCTUATION = str.maketrans('', '', '-:T Z')
+
+
+def parse_rectime(text):
+    '''
+    Epoch seconds for YYYYMMDDHHMMSS, ISO 8601 or epoch seconds text;
+    None if it's none of those
+    '''
+
+    text = text.strip()
+    if text.isdigit() and len(text) <= 10:
+        return int(text)
+
+    digits = text.split('.')[0].split('+')[0].translate(TIME_PUNCTUATION)
+    if not digits.isdigit() or len(digits) not in (12, 14):
+        return None
+    digits = digits.ljust(14, '0')
+
+    try:
+        return calendar.timegm((int(digits[0:4]), int(digits[4:6]), int(digits[6:8]),
+                                int(digits[8:10]), int(digits[10:12]), int(digits[12:14]), 0, 0, 0))
+    except ValueError:
+        return None
+
+
+def header_columns(fields):
+    '''
+    Temps column for each field of a header row (None to ignore the
+    field), or None if the row isn't a header
+    '''
+
+    if fields and parse_rectime(fields[0]) is not None:
+        return None
+
+    known = set(migrateSchema.DATA_COLUMNS) | {'rectime'}
+    columns = []
+    for field in fields:
+        name = field.strip().lower()
+        columns.append(TSV_COLUMNS.get(name, name if name in known else None))
+
+    if 'rectime' not in columns:
+        raise ValueError('no rectime or date column in header {}'.format(fields))
+    return columns
+
+
+def parse_rectimes(values):
+    '''
+    Epoch seconds (int64 array) for a column of time text; -1 where a value
+    can't be read. YYYYMMDDHHMMSS, the usual case, is done in one go with
+    NumPy and anything else one value at a time.
+    '''
+
+    text = np.array(values, dtype=str)
+    compact = (np.char.str_len(text) == 14) & np.char.isdigit(text)
+    epochs = np.full(len(text), -1, dtype=np.int64)
+
+    stamps = text[compact].astype(np.int64)
+    date_part, time_part = np.divmod(stamps, 1000000)
+    year_month, day = np.divmod(date_part, 100)
+    year, month = np.divmod(year_month, 100)
+    hours, min_sec = np.divmod(time_part, 10000)
+    minutes, seconds = np.divmod(min_sec, 100)
+    in_range = ((month >= 1) & (month <= 12) & (day >= 1) & (day <= 31) &
+                (hours < 24) & (minutes < 60) & (seconds < 60))
+
+    months = ((year - 1970) * 12 + (month - 1)).astype('datetime64[M]')
+    days = months.astype('datetime64[D]').astype(np.int64) + day - 1
+    compact_epochs = days * 86400 + hours * 3600 + minutes * 60 + seconds
+    epochs[np.flatnonzero(compact)[in_range]] = compact_epochs[in_range]
+
+    for position in np.flatnonzero(~compact):
+        epoch = parse_rectime(values[position])
+        if epoch is not None:
+            epochs[position] = epoch
+
+    return epochs
+
+
+def parse_floats(values, default):
+    ''' float64 array for a column of text; default where unreadable '''
+
+    try:
+        return np.array(values, dtype=np.float64)
+    except ValueError:
+        pass
+
+    parsed = np.empty(len(values), dtype=np.float64)
+    for position, value in enumerate(values):
+        try:
+            parsed[position] = float(value)
+        except ValueError:
+            parsed[position] = default
+    return parsed
+
+
+def parse_chunk(lines, columns, delimiter):
+    '''
+    Turn text lines into staging rows (epoch rectime, then DATA_COLUMNS).
+    Runs in the worker processes. Returns (rows, lines skipped).
+    '''
+
+    # Short lines padded out so every line has every column
+    width = len(columns)
+    records = [fields + [''] * (width - len(fields)) if len(fields) < width else fields
+               for fields in csv.reader(lines, delimiter=delimiter) if ''.join(fields).strip()]
+    if not records:
+        return [], 0
+
+    fields = dict(zip(columns, zip(*records)))
+    missing = ('',) * len(records)
+
+    rectimes = parse_rectimes(fields['rectime'])
+    good_time = rectimes >= 0
+    skipped = int(len(records) - good_time.sum())
+
+    reads = np.column_stack([parse_floats(fields.get(column, missing), ERR_READING)
+                             for column in READ_COLUMNS])[good_time]
+    flags = parse_floats(fields.get('outlier_flags', missing), 0).astype(np.int64)[good_time]
+    rectimes = rectimes[good_time]
+
+    # Empty readings come through as errors. A mean that is missing (no
+    # column, blank or 999.99) is worked out from the readings instead
+    means, deltas = backfillStats.compute_stats(reads, set(backfillStats.SOURCES), flags)
+    if 'temps_mean' in fields:
+        given = parse_floats(fields['temps_mean'], ERR_READING)[good_time]
+        use_given = given < ERR_READING
+        means = np.where(use_given, given, means)
+        deltas = np.where(use_given[:, None],
+                          np.where(reads < ERR_READING, reads - means[:, None], ERR_READING),
+                          deltas)
+
+    rows = list(zip(rectimes.tolist(), *reads.T.tolist(), means.tolist(), *deltas.T.tolist(),
+                    flags.tolist()))
+    return rows, skipped
+
+
+def read_chunks(handle, chunk_rows):
+    ''' Lists of up to chunk_rows lines from an open text file '''
+
+    chunk = []
+    for line in handle:
+        chunk.append(line)
+        if len(chunk) >= chunk_rows:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def parse_text(path, workers, chunk_rows):
+    '''
+    Staging rows from a CSV/TSV file, chunk by chunk in file order.
+    Yields (rows, lines skipped).
+    '''
+
+    with open(path, newline='') as handle:
+        first = handle.readline()
+        delimiter = '\t' if '\t' in first else ','
+        columns = header_columns(next(csv.reader([first], delimiter=delimiter), []))
+        if columns is None:
+            # No header: data.tsv columns, and the first line is data
+            columns = list(TSV_COLUMNS.values())
+            chunks = read_chunks(itertools.chain([first], handle), chunk_rows)
+        else:
+            chunks = read_chunks(handle, chunk_rows)
+
+        if workers <= 1:
+            for chunk in chunks:
+                yield parse_chunk(chunk, columns, delimiter)
+            return
+
+        # Keep a few chunks in flight; Executor.map() would read the whole
+        # file up front
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            pending = collections.deque()
+            for chunk in chunks:
+                pending.append(pool.submit(parse_chunk, chunk, columns, delimiter))
+                if len(pending) >= workers * 2:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+
+def read_sqlite(path, chunk_rows):
+    ''' Staging rows from another collector DB; yields (rows, 0) '''
+
+    source = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True)
+    try:
+        if migrateSchema.object_type(source, 'Readings') == 'table':
+            table, rectime = 'Readings', 'rectime'
+        else:
+            table, rectime = 'Temps', migrateSchema.rectime_sql('rectime')
+
+        select = tempsCommon.select_columns(source, table, migrateSchema.DATA_COLUMNS, fill='NULL')
+
+        cursor = source.execute('SELECT {}, {} FROM {}'.format(rectime, select, table))
+        while True:
+            rows = cursor.fetchmany(chunk_rows)
+            if not rows:
+                break
+            # Malformed rectimes come back as NULL epochs
+            yield [row for row in rows if row[0] is not None], 0
+    finally:
+        source.close()
+
+
+def is_sqlite(path):
+    with open(path, 'rb') as handle:
+        return handle.read(len(SQLITE_MAGIC)) == SQLITE_MAGIC
+
+
+def create_stage(conn):
+    conn.execute('DROP TABLE IF EXISTS {}'.format(STAGE_TABLE))
+    conn.execute('CREATE TABLE {} (rectime INTEGER NOT NULL, {})'.format(
+                 STAGE_TABLE, ', '.join(migrateSchema.DATA_COLUMNS)))
+
+
+def stage_file(conn, path, workers, chunk_rows, batch_rows):
+    ''' Load one file into the staging table; returns (rows, skipped) '''
+
+    chunks = read_sqlite(path, chunk_rows) if is_sqlite(path) else parse_text(path, workers, chunk_rows)
+
+    staged = skipped = pending = 0
+    for rows, bad in chunks:
+        conn.executemany(STAGE_INSERT_SQL, rows)
+        staged += len(rows)
+        skipped += bad
+        pending += len(rows)
+        if pending >= batch_rows:
+            conn.commit()
+            pending = 0
+    conn.commit()
+
+    return staged, skipped
+
+
+def target_table(conn):
+    '''
+    (table, rectime SQL for a staged epoch, columns it has) for the DB's
+    raw readings
+    '''
+
+    if migrateSchema.schema_version(conn) >= migrateSchema.SCHEMA_VERSION:
+        table, rectime = 'Readings', 'rectime'
+    else:
+        table, rectime = 'Temps', migrateSchema.text_sql('rectime')
+
+    columns = tempsCommon.table_columns(conn, table)
+    return table, rectime, [column for column in migrateSchema.DATA_COLUMNS if column in columns]
+
+
+def log_import(conn, oldest_day):
+    ''' Note in ImportLog that rows from oldest_day (YYYYMMDD) on were added '''
+
+    conn.execute('''
+            CREATE TABLE IF NOT EXISTS ImportLog(
+                id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+                oldest TEXT NOT NULL)'''
+    )
+    conn.execute('INSERT INTO ImportLog (oldest) VALUES (?)', (oldest_day + '000000',))
+    conn.commit()
+
+
+def merge_stage(conn, batch_rows):
+    '''
+    Move staged rows into the DB in rectime order, batch_rows per
+    transaction. Returns (rows inserted, YYYYMMDD days loaded).
+    '''
+
+    table, rectime, columns = target_table(conn)
+    conn.execute('CREATE INDEX temp.ImportStageTime ON ImportStage (rectime)')
+
+    # Folded into Temps15m already (tempsRetention.py); don't count twice
+    folded = ''
+    if tempsRetention.table_exists(conn, tempsRetention.FIFTEEN_TABLE):
+        folded = 'AND NOT EXISTS (SELECT 1 FROM {} WHERE bucket = {})'.format(
+                 tempsRetention.FIFTEEN_TABLE, tempsRetention.bucket_sql(migrateSchema.text_sql('ImportStage.rectime')))
+
+    merge_sql = '''INSERT OR IGNORE INTO {0} (rectime, {1})
+            SELECT {2}, {1} FROM ImportStage
+            WHERE rectime > ? AND rectime <= ? {3}
+            ORDER BY rectime'''.format(table, ', '.join(columns), rectime, folded)
+
+    # Indexes besides the key slow every insert; put them back at the end
+    indexes = conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? "
+                           "AND sql IS NOT NULL", (table,)).fetchall()
+    for name, sql in indexes:
+        conn.execute('DROP INDEX {}'.format(name))
+    conn.commit()
+
+    inserted = 0
+    days = set()
+    try:
+        after = -1
+        while True:
+            row = conn.execute('SELECT rectime FROM ImportStage WHERE rectime > ? ORDER BY rectime '
+                               'LIMIT 1 OFFSET ?', (after, batch_rows - 1)).fetchone()
+            upper = row[0] if row else conn.execute('SELECT MAX(rectime) FROM ImportStage').fetchone()[0]
+            if upper is None or upper <= after:
+                break
+            added = conn.execute(merge_sql, (after, upper)).rowcount
+            conn.commit()
+
+            # Batches that were all duplicates leave the rollups as they are
+            if added:
+                inserted += added
+                days.update(row[0] for row in conn.execute(
+                            "SELECT DISTINCT strftime('%Y%m%d', rectime, 'unixepoch') FROM ImportStage "
+                            "WHERE rectime > ? AND rectime <= ?", (after, upper)))
+            after = upper
+    finally:
+        for name, sql in indexes:
+            conn.execute(sql)
+        conn.commit()
+
+    days = sorted(days)
+    if days:
+        log_import(conn, days[0])
+
+    # Whole days only hold raw readings or 15-minute buckets, never both
+    if folded:
+        aggregated = {row[0] for row in conn.execute('SELECT DISTINCT substr(bucket, 1, 8) FROM {}'.format(
+                                                     tempsRetention.FIFTEEN_TABLE))}
+        days = [day for day in days if day not in aggregated]
+
+    return inserted, days
+
+
+if __name__ == '__main__':
+    inputs = argparse.ArgumentParser()
+    inputs.add_argument('-l', '--localdb',
+                        required=True,
+                        help='Name of local SQLite DB to load into')
+    inputs.add_argument('files',
+                        nargs='+',
+                        help='CSV/TSV files or SQLite DBs to import')
+    inputs.add_argument('--workers',
+                        type=int,
+                        default=os.cpu_count() or 1,
+                        help='Parser processes (default one per CPU)')
+    inputs.add_argument('--chunk-rows',
+                        type=int,
+                        default=50000,
+                        help='Lines per parser chunk (default 50000)')
+    inputs.add_argument('--batch-rows',
+                        type=int,
+                        default=100000,
+                        help='Rows per transaction (default 100000)')
+    inputs.add_argument('--no-rollups',
+                        action='store_true',
+                        help="Don't rebuild hourly and daily rollups afterwards")
+    args = inputs.parse_args()
+
+    temps_db = sqlite3.connect(args.localdb, timeout=60.0)
+    temps_db.execute('PRAGMA cache_size = -65536')      # 64 MB
+    migrateSchema.create_schema(temps_db)
+    create_stage(temps_db)
+
+    start = time.time()
+    staged = 0
+    for path in args.files:
+        file_start = time.time()
+        rows, skipped = stage_file(temps_db, path, args.workers, args.chunk_rows, args.batch_rows)
+        staged += rows
+        elapsed = time.time() - file_start
+        print('{}: read {} rows in {:.1f} s ({:.0f} rows/s){}'.format(
+              path, rows, elapsed, rows / max(elapsed, 1e-6),
+              ', skipped {} bad line(s)'.format(skipped) if skipped else ''))
+
+    merge_start = time.time()
+    inserted, days = merge_stage(temps_db, args.batch_rows)
+    print('Inserted {} new rows ({} already present) in {:.1f} s'.format(
+          inserted, staged - inserted, time.time() - merge_start))
+
+    if days and not args.no_rollups:
+        rollup_start = time.time()
+        tempsRollup.rebuild_rollups(temps_db, days)
+        print('Rebuilt rollups for {} day(s) in {:.1f} s'.format(len(days), time.time() - rollup_start))
+
+    elapsed = time.time() - start
+    print('Total {:.1f} s, {:.0f} rows/s'.format(elapsed, staged / max(elapsed, 1e-6)))
+
+    temps_db.execute('DROP TABLE IF EXISTS {}'.format(STAGE_TABLE))
+    temps_db.close()
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+
+'''
+Program:      migrateSchema.py
+Author:       Jeff VanSickle
+Created:      20261017
+Modified:     20261017
+
+Script moves the Temps table to the compact layout (schema version 1, kept
+in PRAGMA user_version):
+
+    Readings    rectime INTEGER (epoch seconds, UTC) is the primary key of a
+                WITHOUT ROWID table, so rows are stored in time order and
+                there is no separate id or rectime index. Other columns are
+                the same as Temps.
+    Temps       a view over Readings with the old columns: rectime as
+                YYYYMMDDHHMMSS text and id as the epoch seconds (unique and
+                in time order, like the old id). INSTEAD OF triggers turn
+                inserts, updates and deletes on the view into changes to
+                Readings, so older tools keep working unchanged.
+
+Range queries on Readings compare integers on the table's own key. Going
+through the view works but can't use that key for rectime ranges, so tools
+that read big ranges should query Readings when schema_version() >= 1.
+
+Rows are copied in rectime order, chunk_size per transaction, while the
+collector keeps writing to the old table. An interrupted run picks up after
+the newest row already in Readings. The last chunk, dropping the old table,
+creating the view and setting the version happen in one transaction.
+Run with --vacuum afterwards to give the old table's space back; it also
+switches the file to incremental vacuum for tempsRetention.py.
+
+Months archived by tempsArchive.py before migrating keep their old ids;
+purge them (tempsArchive.py --purge) before migrating.
+
+INSTRUCTIONS:
+    migrateSchema.py -l <SQLITE_DB> [--chunk-size 10000] [--vacuum]
+'''
+
+import os
+import sqlite3
+import argparse
+import calendar
+import time
+import tempsCommon
+
+SCHEMA_VERSION = 1
+
+# Columns after rectime, same in Temps and Readings
+DATA_COLUMNS = ['dsapi_read', 'owm_read', 'w2_read', 'wg_read', 'ds18b20_read',
+                'temps_mean', 'dsapi_delta', 'owm_delta', 'w2_delta', 'wg_delta',
+                'ds18b20_delta', 'outlier_flags']
+
+INSERT_SQL = 'INSERT INTO Readings (rectime, {}) VALUES (?, {})'.format(
+             ', '.join(DATA_COLUMNS), ', '.join('?' * len(DATA_COLUMNS)))
+
+# Same row into an old-style Temps table, rectime as text
+LEGACY_INSERT_SQL = INSERT_SQL.replace('Readings', 'Temps')
+
+
+def rectime_sql(column):
+    ''' SQL turning YYYYMMDDHHMMSS text in column into epoch seconds '''
+
+    return ("CAST(strftime('%s', substr({0}, 1, 4) || '-' || substr({0}, 5, 2) || '-' || "
+            "substr({0}, 7, 2) || ' ' || substr({0}, 9, 2) || ':' || substr({0}, 11, 2) || "
+            "':' || substr({0}, 13, 2)) AS INTEGER)").format(column)
+
+def text_sql(column):
+    ''' SQL turning epoch seconds in column into YYYYMMDDHHMMSS text '''
+
+    return "strftime('%Y%m%d%H%M%S', {}, 'unixepoch')".format(column)
+
+def rectime_to_epoch(rectime):
+    return calendar.timegm(time.strptime(rectime, '%Y%m%d%H%M%S'))
+
+def schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+def object_type(conn, name):
+    ''' 'table', 'view' or None '''
+
+    row = conn.execute('SELECT type FROM sqlite_master WHERE name = ?', (name,)).fetchone()
+    return row[0] if row else None
+
+
+def create_readings(cursor):
+    cursor.execute('''
+            CREATE TABLE IF NOT EXISTS Readings(
+                rectime INTEGER NOT NULL PRIMARY KEY,
+                dsapi_read REAL,
+                owm_read REAL,
+                w2_read REAL,
+                wg_read REAL,
+                ds18b20_read REAL,
+                temps_mean REAL,
+                dsapi_delta REAL,
+                owm_delta REAL,
+                w2_delta REAL,
+                wg_delta REAL,
+                ds18b20_delta REAL,
+                outlier_flags INTEGER NOT NULL DEFAULT 0) WITHOUT ROWID'''
+    )
+
+
+def create_compat_view(cursor):
+    ''' Temps view over Readings, writable through INSTEAD OF triggers '''
+
+    cursor.execute('CREATE VIEW IF NOT EXISTS Temps AS SELECT rectime AS id, {} AS rectime, {} '
+                   'FROM Readings'.format(text_sql('rectime'), ', '.join(DATA_COLUMNS)))
+
+    new_values = ', '.join('NEW.' + column for column in DATA_COLUMNS[:-1])
+    cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS TempsInsert INSTEAD OF INSERT ON Temps
+            BEGIN
+                INSERT INTO Readings (rectime, {}) VALUES ({}, {}, COALESCE(NEW.outlier_flags, 0));
+            END'''.format(', '.join(DATA_COLUMNS), rectime_sql('NEW.rectime'), new_values)
+    )
+    cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS TempsUpdate INSTEAD OF UPDATE ON Temps
+            BEGIN
+                UPDATE Readings SET rectime = {}, {} WHERE rectime = OLD.id;
+            END'''.format(rectime_sql('NEW.rectime'),
+                          ', '.join('{0} = NEW.{0}'.format(column) for column in DATA_COLUMNS))
+    )
+    cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS TempsDelete INSTEAD OF DELETE ON Temps
+            BEGIN
+                DELETE FROM Readings WHERE rectime = OLD.id;
+            END'''
+    )
+
+
+def create_schema(conn):
+    '''
+    Set up the current schema in a DB with no Temps yet. Returns the
+    schema version, which stays 0 if Temps is an old-style table.
+    '''
+
+    if object_type(conn, 'Temps') is None:
+        cursor = conn.cursor()
+        # Only takes effect in a file with no tables yet; lets
+        # tempsRetention.py give space back without a full VACUUM
+        cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        create_readings(cursor)
+        create_compat_view(cursor)
+        cursor.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+        conn.commit()
+        cursor.close()
+
+    return schema_version(conn)
+
+
+def copy_chunk(conn, after, chunk_size, select):
+    '''
+    Copy up to chunk_size Temps rows with rectime after the text rectime
+    after. Returns (rows read, rows copied, last rectime read).
+    '''
+
+    rows = conn.execute('SELECT rectime, {}, {} FROM Temps WHERE rectime > ? ORDER BY rectime LIMIT ?'.format(
+                        rectime_sql('rectime'), select), (after, chunk_size)).fetchall()
+    if not rows:
+        return 0, 0, after
+
+    # Malformed rectimes come back as NULL epochs and are left behind
+    good = [row[1:] for row in rows if row[1] is not None]
+    conn.executemany(INSERT_SQL.replace('INSERT', 'INSERT OR REPLACE', 1), good)
+
+    return len(rows), len(good), rows[-1][0]
+
+
+def migrate(conn, chunk_size=10000):
+    ''' Move Temps into Readings; returns rows copied '''
+
+    if schema_version(conn) >= SCHEMA_VERSION:
+        return 0
+    if object_type(conn, 'Temps') != 'table':
+        create_schema(conn)
+        return 0
+
+    create_readings(conn.cursor())
+    conn.commit()
+
+    select = tempsCommon.select_columns(conn, 'Temps', DATA_COLUMNS)
+
+    newest = conn.execute('SELECT MAX(rectime) FROM Readings').fetchone()[0]
+    after = conn.execute('SELECT {}'.format(text_sql('?')), (newest,)).fetchone()[0] if newest else ''
+    if newest:
+        print('Resuming after {}'.format(after))
+
+    copied = skipped = 0
+    while True:
+        read, done, after = copy_chunk(conn, after, chunk_size, select)
+        conn.commit()
+        copied += done
+        skipped += read - done
+        if read < chunk_size:
+            break
+
+    # Rows the collector added since, then swap Temps for the view
+    conn.isolation_level = None
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        while True:
+            read, done, after = copy_chunk(conn, after, chunk_size, select)
+            copied += done
+            skipped += read - done
+            if read < chunk_size:
+                break
+        conn.execute('DROP TABLE Temps')
+        create_compat_view(conn.cursor())
+        conn.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.isolation_level = ''
+
+    if skipped:
+        print('Left out {} row(s) with malformed rectime'.format(skipped))
+
+    return copied
+
+
+if __name__ == '__main__':
+    inputs = argparse.ArgumentParser()
+    inputs.add_argument('-l', '--localdb',
+                        required=True,
+                        help='Name of local SQLite DB to use')
+    inputs.add_argument('--chunk-size',
+                        type=int,
+                        default=10000,
+                        help='Rows per transaction (default 10000)')
+    inputs.add_argument('--vacuum',
+                        action='store_true',
+                        help='Rebuild the file afterwards to give back free space')
+    args = inputs.parse_args()
+
+    temps_db = sqlite3.connect(args.localdb, timeout=60.0)
+
+    if schema_version(temps_db) >= SCHEMA_VERSION:
+        print('{} is already at schema version {}'.format(args.localdb, schema_version(temps_db)))
+    else:
+        start = time.time()
+        copied = migrate(temps_db, args.chunk_size)
+        print('Moved {} rows to Readings in {:.1f} s'.format(copied, time.time() - start))
+
+    if args.vacuum:
+        size_before = os.path.getsize(args.localdb)
+        temps_db.execute('PRAGMA auto_vacuum = INCREMENTAL')    # See tempsRetention.py
+        temps_db.execute('VACUUM')
+        print('File size {:.1f} MB -> {:.1f} MB'.format(size_before / 1e6,
+              os.path.getsize(args.localdb) / 1e6))
+
+    temps_db.close()
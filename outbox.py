@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+'''
+Program:      outbox.py
+Author:       Jeff VanSickle
+Created:      20261017
+Modified:     20261017
+
+Module keeps a local outbox of readings that still need to reach DynamoDB.
+collectTemp.py adds each reading to the Outbox table in the same SQLite
+transaction as its Temps row, so a reading can't be lost between the two.
+flush() then drains the outbox with BatchWriteItem, 25 items per request,
+retrying unprocessed items with exponential backoff. It updates the
+last-write table once per flush instead of once per reading.
+
+If DynamoDB is down, rows pile up in the outbox and go out in one catch-up
+burst once it is reachable again. Batch latency, retries, errors and
+outbox depth are recorded in collectMetrics.REGISTRY.
+
+INSTRUCTIONS:
+    - Point boto3 at DynamoDB Local (endpoint_url) to try this without AWS
+'''
+
+import json
+import time
+import random
+import datetime
+from decimal import Decimal
+from collectMetrics import REGISTRY
+
+BATCH_SIZE = 25     # BatchWriteItem limit
+
+
+class Outbox:
+    """ Unsent DynamoDB items, stored in the local SQLite DB """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS Outbox(
+                    rectime TEXT NOT NULL PRIMARY KEY,
+                    item TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0)'''
+        )
+        self.conn.commit()
+
+    def add(self, item):
+        """
+        Queue item (dict of attribute -> value) for DynamoDB. Doesn't commit;
+        caller commits along with the matching Temps row.
+        """
+
+        self.conn.execute('INSERT OR REPLACE INTO Outbox (rectime, item) VALUES (?, ?)',
+                          (str(item['rectime']),
+                          json.dumps({key: str(value) for key, value in item.items()})))
+
+    def depth(self):
+        """ Number of items waiting to be sent """
+
+        return self.conn.execute('SELECT COUNT(*) FROM Outbox').fetchone()[0]
+
+    def _to_dynamo(self, item_json):
+        """ Rebuild DynamoDB item; every attribute but rectime is a number """
+
+        item = json.loads(item_json)
+        return {key: (value if key == 'rectime' else Decimal(value))
+                for key, value in item.items()}
+
+    def _write_batch(self, client, table_name, requests, max_retries, base_delay):
+        """
+        Send one batch; resend unprocessed items with backoff. Returns the
+        requests that still weren't written.
+        """
+
+        pending = requests
+        for attempt in range(max_retries + 1):
+            if attempt > 0:
+                # Exponential backoff with jitter, per AWS guidance
+                time.sleep(base_delay * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5))
+                REGISTRY.inc('dynamo_retries_total')
+
+            with REGISTRY.timer('dynamo_batch_seconds'):
+                response = client.batch_write_item(RequestItems={table_name: pending})
+            pending = response.get('UnprocessedItems', {}).get(table_name, [])
+            if not pending:
+                break
+
+        return pending
+
+    def flush(self, aws_table, last_write_db=None, max_retries=5, base_delay=0.5):
+        """
+        Drain the outbox into DynamoDB Table aws_table, then record the
+        newest rectime sent in last_write_db. Returns number of items
+        written. Stops early if DynamoDB errors or keeps refusing items;
+        whatever is left stays queued for the next flush.
+        """
+
+        client = aws_table.meta.client
+        table_name = aws_table.name
+        sent = 0
+        last_rectime = None
+        after = ''
+
+        while True:
+            rows = self.conn.execute('''SELECT rectime, item FROM Outbox
+                    WHERE rectime > ? ORDER BY rectime LIMIT ?''',
+                    (after, BATCH_SIZE)).fetchall()
+            if not rows:
+                break
+
+            requests = [{'PutRequest': {'Item': self._to_dynamo(item)}} for rectime, item in rows]
+            try:
+                unsent = self._write_batch(client, table_name, requests,
+                                           max_retries, base_delay)
+            except Exception as err:
+                print('{}: Error writing DynamoDB: {}'.format(datetime.datetime.utcnow(), err))
+                REGISTRY.inc('dynamo_errors_total')
+                self.conn.execute('UPDATE Outbox SET attempts = attempts + 1 WHERE rectime <= ?',
+                                  (rows[-1][0],))
+                self.conn.commit()
+                break
+
+            unsent_times = {req['PutRequest']['Item']['rectime'] for req in unsent}
+            done = [(rectime,) for rectime, item in rows if rectime not in unsent_times]
+            self.conn.executemany('DELETE FROM Outbox WHERE rectime = ?', done)
+            self.conn.commit()
+
+            sent += len(done)
+            REGISTRY.inc('dynamo_items_written_total', amount=len(done))
+            if done:
+                last_rectime = max(last_rectime or '', done[-1][0])
+
+            if unsent:
+                print('{}: DynamoDB left {} item(s) unprocessed; will retry next flush'.format(
+                      datetime.datetime.utcnow(), len(unsent)))
+                break
+
+            after = rows[-1][0]
+
+        REGISTRY.set('outbox_depth', self.depth())
+
+        # One last-write update per flush, not per reading
+        if last_write_db is not None and last_rectime is not None:
+            try:
+                last_write_db.update_item(
+                        Key={'id': 1},
+                        UpdateExpression='SET rectime = :updatedate',
+                        ExpressionAttributeValues={':updatedate': last_rectime}
+                        )
+            except:
+                print('{}: Error writing last-write DB'.format(datetime.datetime.utcnow()))
+
+        return sent
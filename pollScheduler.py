@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+
+'''
+Program:      pollScheduler.py
+Author:       Jeff VanSickle
+Created:      20261017
+Modified:     20261017
+
+Module decides which weather APIs to call each cycle, so the collector can
+run faster than the three-minute interval the daily limits used to force
+without going over any provider's quota.
+
+Quotas: each provider has a daily call budget (DEFAULT_QUOTAS, less a small
+reserve). By any time of day a provider may have used the same share of
+its budget as the share of the day gone by, plus one call. Calls are
+spread evenly whatever the cycle interval, and a provider that was skipped
+earlier catches up. Only real network calls count; answers served from
+apiCache.py are free. Counts per UTC day are kept in the ProviderQuota
+table.
+
+Circuit breakers: after failure_threshold failed reads in a row a provider
+is left alone for reset_timeout seconds. Then one probe call is let
+through. If the probe fails, the wait doubles, up to max_timeout. The
+first good read closes the breaker again.
+
+Providers that are skipped carry their last good reading forward for up to
+max_age seconds, then read as 999.99. collectTemp.py marks carried readings
+in outlier_flags (streamStats.CARRIED_BITS) so they aren't taken for fresh
+ones. Breaker state and last readings are kept in the ProviderState table,
+so cron runs and restarts pick up where the last run left off.
+
+INSTRUCTIONS:
+    scheduler = PollScheduler(conn)
+    due = scheduler.plan()                  # providers to call this cycle
+    WeatherAPI(..., limiters=scheduler.counters())
+    scheduler.record(readings, due, err_reading); scheduler.save()
+'''
+
+import time
+import datetime
+import threading
+from collectMetrics import REGISTRY
+
+# Free-tier calls per day
+DEFAULT_QUOTAS = {'dsapi': 1000,
+                  'owm': 1000,
+                  'w2': 500,
+                  'wg': 500}
+
+DAY_SECONDS = 86400
+
+
+def utc_day(now):
+    return datetime.datetime.utcfromtimestamp(now).strftime('%Y%m%d')
+
+def day_elapsed(now):
+    ''' Seconds since UTC midnight '''
+
+    return now % DAY_SECONDS
+
+
+class CircuitBreaker:
+    ''' Closed -> open after repeated failures -> half-open probe -> closed '''
+
+    def __init__(self, failure_threshold=3, reset_timeout=300.0, max_timeout=3600.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_timeout = max_timeout
+        self.failures = 0
+        self.open_until = 0.0       # 0 when closed
+        self.timeout = reset_timeout
+
+    def state(self, now=None):
+        if now is None:
+            now = time.time()
+        if self.open_until == 0.0:
+            return 'closed'
+        return 'open' if now < self.open_until else 'half_open'
+
+    def allow(self, now=None):
+        return self.state(now) != 'open'
+
+    def record(self, ok, now=None):
+        if now is None:
+            now = time.time()
+
+        if ok:
+            self.failures = 0
+            self.open_until = 0.0
+            self.timeout = self.reset_timeout
+            return
+
+        probing = self.state(now) == 'half_open'
+        self.failures += 1
+        if probing:
+            self.timeout = min(self.timeout * 2, self.max_timeout)
+        if probing or self.failures >= self.failure_threshold:
+            self.open_until = now + self.timeout
+
+
+class CallCounter:
+    '''
+    Counts network calls for one provider. Goes in WeatherAPI's limiters,
+    which are consulted just before every real request (not cache hits).
+    Wraps an optional real rate limiter.
+    '''
+
+    def __init__(self, scheduler, provider, limiter=None):
+        self.scheduler = scheduler
+        self.provider = provider
+        self.limiter = limiter
+
+    def acquire(self, timeout=None):
+        if self.limiter is not None and not self.limiter.acquire(timeout=timeout):
+            return False
+        self.scheduler.count_call(self.provider)
+        return True
+
+
+class PollScheduler:
+    ''' Quota pacing and circuit breakers for the weather APIs '''
+
+    def __init__(self, conn, quotas=None, reserve=0.05, max_age=900.0,
+                 failure_threshold=3, reset_timeout=300.0, max_timeout=3600.0):
+        self.conn = conn
+        self.quotas = dict(DEFAULT_QUOTAS)
+        self.quotas.update(quotas or {})
+        self.reserve = reserve
+        self.max_age = max_age
+        self.lock = threading.Lock()
+
+        self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS ProviderQuota(
+                    provider TEXT NOT NULL,
+                    day TEXT NOT NULL,
+                    calls INTEGER NOT NULL,
+                    PRIMARY KEY (provider, day))'''
+        )
+        self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS ProviderState(
+                    provider TEXT NOT NULL PRIMARY KEY,
+                    failures INTEGER NOT NULL,
+                    open_until REAL NOT NULL,
+                    open_timeout REAL NOT NULL,
+                    last_reading REAL,
+                    last_reading_time REAL)'''
+        )
+
+        self.breakers = {provider: CircuitBreaker(failure_threshold, reset_timeout, max_timeout)
+                         for provider in self.quotas}
+        self.last_good = {}         # provider -> (epoch seconds, reading)
+
+        for provider, failures, open_until, open_timeout, reading, read_time in \
+                self.conn.execute('SELECT * FROM ProviderState'):
+            if provider not in self.breakers:
+                continue
+            breaker = self.breakers[provider]
+            breaker.failures, breaker.open_until, breaker.timeout = failures, open_until, open_timeout
+            if reading is not None:
+                self.last_good[provider] = (read_time, reading)
+
+        self.day = utc_day(time.time())
+        self.calls = {provider: 0 for provider in self.quotas}
+        self.load_calls()
+
+    def load_calls(self):
+        for provider, calls in self.conn.execute(
+                'SELECT provider, calls FROM ProviderQuota WHERE day = ?', (self.day,)):
+            if provider in self.calls:
+                self.calls[provider] = calls
+
+    def roll_day(self, now):
+        ''' New UTC day: budgets start over '''
+
+        today = utc_day(now)
+        if today != self.day:
+            self.save()
+            self.day = today
+            self.calls = {provider: 0 for provider in self.quotas}
+            self.load_calls()
+
+    def count_call(self, provider):
+        with self.lock:
+            if provider in self.calls:
+                self.calls[provider] += 1
+
+    def counters(self, limiters=None):
+        ''' Dict of provider -> CallCounter for WeatherAPI(limiters=...) '''
+
+        limiters = limiters or {}
+        return {provider: CallCounter(self, provider, limiters.get(provider))
+                for provider in self.quotas}
+
+    def within_quota(self, provider, now):
+        budget = self.quotas[provider] * (1.0 - self.reserve)
+        allowed = budget * day_elapsed(now) / DAY_SECONDS + 1
+        with self.lock:
+            used = self.calls[provider]
+        return used < min(allowed, budget)
+
+    def plan(self, now=None):
+        ''' Providers to call this cycle '''
+
+        if now is None:
+            now = time.time()
+        self.roll_day(now)
+
+        return {provider for provider in self.quotas
+                if self.breakers[provider].allow(now) and self.within_quota(provider, now)}
+
+    def carried(self, provider, err_reading, now=None):
+        ''' Last good reading if recent enough, else err_reading '''
+
+        if now is None:
+            now = time.time()
+        read_time, reading = self.last_good.get(provider, (None, None))
+        if read_time is None or now - read_time > self.max_age:
+            return err_reading
+        return reading
+
+    def record(self, readings, called, err_reading, now=None):
+        '''
+        Update breakers and last readings from one cycle. readings maps
+        provider -> reading for the providers in called.
+        '''
+
+        if now is None:
+            now = time.time()
+
+        for provider in called:
+            reading = readings.get(provider)
+            ok = reading is not None and reading != err_reading
+            was_open = self.breakers[provider].state(now) != 'closed'
+            self.breakers[provider].record(ok, now)
+            if ok:
+                self.last_good[provider] = (now, reading)
+                if was_open:
+                    print('{}: {} is answering again'.format(datetime.datetime.utcnow(), provider))
+            elif self.breakers[provider].state(now) == 'open' and not was_open:
+                print('{}: {} failing; not calling it for {:.0f} s'.format(
+                      datetime.datetime.utcnow(), provider, self.breakers[provider].timeout))
+
+    def status(self, now=None):
+        ''' Provider -> dict of calls today, quota, breaker state '''
+
+        if now is None:
+            now = time.time()
+        with self.lock:
+            return {provider: {'calls': self.calls[provider],
+                               'quota': self.quotas[provider],
+                               'breaker': self.breakers[provider].state(now)}
+                    for provider in self.quotas}
+
+    def save(self):
+        ''' Write counts and state; caller commits '''
+
+        with self.lock:
+            calls = [(provider, self.day, count) for provider, count in self.calls.items()]
+        self.conn.executemany('INSERT OR REPLACE INTO ProviderQuota (provider, day, calls) VALUES (?, ?, ?)',
+                              calls)
+        for provider, day, count in calls:
+            REGISTRY.set('provider_calls_today', count, {'provider': provider})
+
+        rows = []
+        for provider, breaker in self.breakers.items():
+            REGISTRY.set('provider_breaker_open', int(breaker.state() == 'open'), {'provider': provider})
+            read_time, reading = self.last_good.get(provider, (None, None))
+            rows.append((provider, breaker.failures, breaker.open_until, breaker.timeout,
+                         reading, read_time))
+        self.conn.executemany('''INSERT OR REPLACE INTO ProviderState
+                (provider, failures, open_until, open_timeout, last_reading, last_reading_time)
+                VALUES (?, ?, ?, ?, ?, ?)''', rows)
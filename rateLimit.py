@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+'''
+Program:      rateLimit.py
+Author:       Jeff VanSickle
+Created:      20261017
+Modified:     20261017
+
+Module provides a token-bucket rate limiter for API calls. WeatherAPI
+takes one per provider, and all WeatherAPI objects share it, so the
+provider sees at most the configured rate from this host however many
+locations are being collected.
+
+INSTRUCTIONS:
+    - RateLimiter(rate, burst): rate is calls per second, burst is how many
+      calls may go out back to back after a quiet spell
+'''
+
+import threading
+import time
+
+
+class RateLimiter:
+    """ Token bucket shared between threads """
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, timeout=None):
+        """
+        Take one token, waiting for it if needed. Returns False if no token
+        came free within timeout seconds (None waits as long as it takes).
+        """
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return True
+
+                wait_for = (1.0 - self.tokens) / self.rate
+
+            if deadline is not None:
+                if now + wait_for > deadline:
+                    return False
+            time.sleep(wait_for)
@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+
+'''
+Program:      sinkPipeline.py
+Author:       Jeff VanSickle
+Created:      20261017
+Modified:     20261017
+
+Module hands each reading to any number of sinks (DynamoDB, Postgres, a
+mirror SQLite DB, a JSON-lines file) that write it in the background, so a
+slow or unreachable target can't hold up the next poll. collectTemp.py
+commits the reading to the local SQLite DB first; from then on it is
+durable and the sinks catch up on their own.
+
+Every Sink has a bounded queue and one worker thread. The worker writes
+what is queued in batches, waiting up to linger seconds for a batch to
+fill; close() cuts the wait short and writes (or spills) the partial
+batch. If a write fails it retries the same batch with exponential backoff.
+While it is stuck, new readings pile up in the queue. What happens when
+the queue is full is up to the sink's policy:
+
+    block           put() waits for room (the poll waits too)
+    drop_oldest     the oldest queued reading is thrown away
+    spill           the reading is appended to <spill_dir>/<name>.spill
+                    and written once the queue has drained; spill files
+                    left over from an earlier run are picked up too
+
+Readings must be JSON-friendly dicts (for spilling). Per-sink queue depth,
+lag (age of the oldest unwritten reading), written, dropped, spilled and
+error counts are in stats() and in collectMetrics.REGISTRY.
+
+INSTRUCTIONS:
+    pipeline = SinkPipeline([Sink('file', JsonLinesWriter('temps.jsonl'))])
+    pipeline.publish(row) ... pipeline.close()
+'''
+
+import os
+import json
+import time
+import queue
+import sqlite3
+import datetime
+import threading
+from collectMetrics import REGISTRY
+
+POLICIES = ['block', 'drop_oldest', 'spill']
+LINGER_SLICE = 0.5      # Seconds between checks for close() while a batch fills
+
+
+class Sink:
+    ''' One target: bounded queue plus a worker thread that writes batches '''
+
+    def __init__(self, name, writer, queue_size=100, policy='block', batch_size=25,
+                 linger=0.0, spill_dir=None, retry_delay=2.0, max_delay=300.0):
+        if policy not in POLICIES:
+            raise ValueError('Unknown sink policy {}'.format(policy))
+        if policy == 'spill' and spill_dir is None:
+            raise ValueError('Sink {} spills but has no spill_dir'.format(name))
+
+        self.name = name
+        self.writer = writer        # Callable taking a list of readings; raises on failure
+        self.policy = policy
+        self.batch_size = batch_size
+        self.linger = linger        # Seconds to wait for a batch to fill
+        self.retry_delay = retry_delay
+        self.max_delay = max_delay
+        self.queue = queue.Queue(maxsize=queue_size)
+
+        self.spill_path = None
+        if policy == 'spill':
+            os.makedirs(spill_dir, exist_ok=True)
+            self.spill_path = os.path.join(spill_dir, name + '.spill')
+        self.spill_lock = threading.Lock()
+        self.backlog = []           # Readings read back from a spill file
+
+        self.counts = {'written': 0, 'dropped': 0, 'spilled': 0, 'errors': 0}
+        self.count_lock = threading.Lock()
+        self.inflight_since = None  # Enqueue time of oldest reading being written
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='sink-' + name, daemon=True)
+        self.thread.start()
+
+    def labels(self):
+        return {'sink': self.name}
+
+    def put(self, item):
+        ''' Queue one reading, applying the backpressure policy if full '''
+
+        entry = (time.time(), item)
+
+        if self.policy == 'block':
+            self.queue.put(entry)
+        else:
+            while True:
+                try:
+                    self.queue.put_nowait(entry)
+                    break
+                except queue.Full:
+                    if self.policy == 'spill':
+                        self.spill([entry])
+                        break
+                    try:
+                        self.queue.get_nowait()
+                        self.count('dropped')
+                    except queue.Empty:
+                        pass
+
+        REGISTRY.set('sink_queue_depth', self.queue.qsize(), self.labels())
+
+    def count(self, what, amount=1):
+        with self.count_lock:
+            self.counts[what] += amount
+        REGISTRY.inc('sink_{}_total'.format(what), self.labels(), amount)
+
+    def spill(self, entries):
+        with self.spill_lock:
+            with open(self.spill_path, 'a') as spill_file:
+                for enqueued, item in entries:
+                    spill_file.write(json.dumps({'t': enqueued, 'item': item}) + '\n')
+        self.count('spilled', len(entries))
+
+    def load_spill(self):
+        '''
+        Move the spill file aside and read it into the backlog. A file left
+        aside by a run that died is read first.
+        '''
+
+        draining = self.spill_path + '.draining'
+        with self.spill_lock:
+            if not os.path.exists(draining):
+                if not os.path.exists(self.spill_path):
+                    return
+                os.rename(self.spill_path, draining)
+
+        with open(draining, 'r') as spill_file:
+            for line in spill_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue        # Torn last line from a crash
+                self.backlog.append((entry['t'], entry['item']))
+        os.remove(draining)
+
+    def next_batch(self):
+        ''' Up to batch_size entries; [] if idle, None once stopped and empty '''
+
+        batch = []
+        try:
+            # Don't idle on the queue while spilled readings are waiting
+            if self.backlog:
+                batch.append(self.queue.get_nowait())
+            else:
+                batch.append(self.queue.get(timeout=0.5))
+            fill_by = time.monotonic() + self.linger
+            while len(batch) < self.batch_size:
+                wait_for = 0 if self.stopping.is_set() else fill_by - time.monotonic()
+                if wait_for <= 0:
+                    batch.append(self.queue.get_nowait())
+                    continue
+                # Short waits, so close() doesn't sit out the whole linger
+                try:
+                    batch.append(self.queue.get(timeout=min(wait_for, LINGER_SLICE)))
+                except queue.Empty:
+                    pass
+        except queue.Empty:
+            pass
+
+        if batch:
+            return batch
+
+        if self.stopping.is_set():
+            return None
+
+        # Queue has drained; work through anything spilled
+        if self.policy == 'spill' and not self.backlog:
+            self.load_spill()
+        batch, self.backlog = self.backlog[:self.batch_size], self.backlog[self.batch_size:]
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                break
+            if batch:
+                self.write_batch(batch)
+
+        # Stopped with readings read back from a spill file; keep them
+        if self.backlog:
+            self.abandon(self.backlog)
+            self.backlog = []
+
+    def write_batch(self, batch):
+        '''
+        Write batch, retrying with backoff until it goes or the sink is
+        stopping, in which case it is spilled or dropped.
+        '''
+
+        self.inflight_since = min(enqueued for enqueued, item in batch)
+        delay = self.retry_delay
+
+        while True:
+            try:
+                with REGISTRY.timer('sink_write_seconds', self.labels()):
+                    self.writer([item for enqueued, item in batch])
+                self.count('written', len(batch))
+                break
+            except Exception as err:
+                self.count('errors')
+                print('{}: Sink {} write failed: {}'.format(datetime.datetime.utcnow(), self.name, err))
+                if self.stopping.is_set():
+                    self.abandon(batch)
+                    break
+                self.stopping.wait(delay)
+                delay = min(delay * 2, self.max_delay)
+
+        self.inflight_since = None
+        REGISTRY.set('sink_queue_depth', self.queue.qsize(), self.labels())
+        REGISTRY.set('sink_lag_seconds', self.lag(), self.labels())
+
+    def abandon(self, entries):
+        if self.policy == 'spill':
+            self.spill(entries)
+        else:
+            self.count('dropped', len(entries))
+
+    def lag(self):
+        ''' Seconds since the oldest reading not yet written was queued '''
+
+        oldest = [self.inflight_since] if self.inflight_since is not None else []
+        with self.queue.mutex:
+            if self.queue.queue:
+                oldest.append(self.queue.queue[0][0])
+        if self.backlog:
+            oldest.append(self.backlog[0][0])
+
+        return max(0.0, time.time() - min(oldest)) if oldest else 0.0
+
+    def stats(self):
+        with self.count_lock:
+            stats = dict(self.counts)
+        stats.update({'depth': self.queue.qsize(), 'lag': self.lag()})
+        return stats
+
+    def close(self, timeout=30.0):
+        '''
+        Let the worker drain the queue (one try per batch), then stop. True
+        if it finished within timeout seconds.
+        '''
+
+        self.stopping.set()
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            print('{}: Sink {} still busy with {} reading(s) queued'.format(
+                  datetime.datetime.utcnow(), self.name, self.queue.qsize()))
+            return False
+
+        closer = getattr(self.writer, 'close', None)
+        if closer is not None:
+            closer()
+        return True
+
+
+class SinkPipeline:
+    ''' Fans each reading out to every sink '''
+
+    def __init__(self, sinks=None):
+        self.sinks = list(sinks or [])
+
+    def add(self, sink):
+        self.sinks.append(sink)
+
+    def publish(self, item):
+        for sink in self.sinks:
+            sink.put(item)
+
+    def stats(self):
+        return {sink.name: sink.stats() for sink in self.sinks}
+
+    def close(self, timeout=30.0):
+        ''' Close every sink; timeout is shared, not per sink '''
+
+        deadline = time.monotonic() + timeout
+        for sink in self.sinks:
+            sink.stopping.set()
+        for sink in self.sinks:
+            sink.close(max(0.0, deadline - time.monotonic()))
+
+
+class DynamoWriter:
+    '''
+    Flushes the SQLite outbox to DynamoDB. The outbox already holds every
+    reading, so the queued readings only say "there is something to send";
+    dropping some of them loses nothing. Uses its own SQLite connection.
+    '''
+
+    def __init__(self, local_db, aws_table, last_write_db=None):
+        self.local_db = local_db
+        self.aws_table = aws_table
+        self.last_write_db = last_write_db
+        self.conn = None
+
+    def __call__(self, items):
+        from outbox import Outbox
+
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.local_db, timeout=30.0, check_same_thread=False)
+            self.outbox = Outbox(self.conn)
+
+        self.outbox.flush(self.aws_table, self.last_write_db)
+        left = self.outbox.depth()
+        if left:
+            raise RuntimeError('{} item(s) still in outbox'.format(left))
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+
+
+class PostgresWriter:
+    ''' Upserts readings through an alt_db/pgaws.py PostgresSink '''
+
+    def __init__(self, pg_sink):
+        self.pg_sink = pg_sink
+
+    def __call__(self, items):
+        self.pg_sink.write_batch(items)
+
+    def close(self):
+        self.pg_sink.close()
+
+
+class SQLiteWriter:
+    ''' Copies readings into the Temps table of another SQLite DB '''
+
+    columns = ['rectime', 'dsapi_read', 'owm_read', 'w2_read', 'wg_read', 'ds18b20_read',
+               'temps_mean', 'dsapi_delta', 'owm_delta', 'w2_delta', 'wg_delta',
+               'ds18b20_delta', 'outlier_flags']
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.conn = None
+
+    def __call__(self, items):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.db_path, timeout=30.0, check_same_thread=False)
+            self.conn.execute('''
+                    CREATE TABLE IF NOT EXISTS Temps(
+                        id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE,
+                        rectime TEXT UNIQUE,
+                        dsapi_read REAL,
+                        owm_read REAL,
+                        w2_read REAL,
+                        wg_read REAL,
+                        ds18b20_read REAL,
+                        temps_mean REAL,
+                        dsapi_delta REAL,
+                        owm_delta REAL,
+                        w2_delta REAL,
+                        wg_delta REAL,
+                        ds18b20_delta REAL,
+                        outlier_flags INTEGER NOT NULL DEFAULT 0)'''
+            )
+
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO Temps ({}) VALUES ({})'.format(
+                                  ', '.join(self.columns), ', '.join('?' * len(self.columns))),
+                                  [[item.get(column) for column in self.columns] for item in items])
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+
+
+class JsonLinesWriter:
+    ''' Appends readings to a file, one JSON object per line '''
+
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, items):
+        with open(self.path, 'a') as out_file:
+            out_file.writelines(json.dumps(item, sort_keys=True) + '\n' for item in items)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+'''
+Program:      streamStats.py
+Author:       Jeff VanSickle
+Created:      20261017
+Modified:     20261017
+
+Module flags readings that are plausible but wrong, e.g. a provider stuck
+on an old observation or a sensor in direct sun, so they can be kept out
+of the mean.
+
+Weather moves all sources together, so each reading is judged by its
+residual: the reading minus the median of the other sources' good readings
+in the same cycle. Each source keeps an exponentially weighted mean and
+variance of its residual. A reading is an outlier when its residual is
+more than sigma standard deviations (and at least min_dev degrees) away
+from that source's usual residual. Flagged readings still update the
+state, so a source that shifts for good stops being flagged once the
+statistics catch up.
+
+Each update is O(1) per source. State lives in the SourceStats table of
+the local DB and is loaded once at start-up, so neither cron runs nor
+restarts rescan history.
+
+Flags are a bitmask with one bit per source, in SOURCES order:
+
+    dsapi 1, owm 2, w2 4, wg 8, ds18b20 16
+
+The next five bits, in the same order, mark readings that collectTemp.py
+carried forward from an earlier cycle because pollScheduler.py didn't call
+that API (see CARRIED_BITS):
+
+    dsapi 32, owm 64, w2 128, wg 256, ds18b20 512
+
+Carried readings are neither judged nor used to judge the other sources,
+and they don't update the statistics.
+
+INSTRUCTIONS:
+    - StreamStats(conn).check(readings, err_reading, carried) returns the
+      flags for one cycle; save() writes state without committing
+'''
+
+import statistics
+import tempsCommon
+
+SOURCES = ['dsapi', 'owm', 'w2', 'wg', 'ds18b20']
+SOURCE_BITS = {source: 1 << position for position, source in enumerate(SOURCES)}
+CARRIED_BITS = {source: 1 << (len(SOURCES) + position) for position, source in enumerate(SOURCES)}
+
+
+def add_flags_column(cursor):
+    ''' Add outlier_flags column to Temps if it isn't there yet '''
+
+    if not tempsCommon.has_column(cursor, 'Temps', 'outlier_flags'):
+        cursor.execute('ALTER TABLE Temps ADD COLUMN outlier_flags INTEGER NOT NULL DEFAULT 0')
+
+
+def flagged_sources(flags):
+    ''' Names of the sources set in a flags bitmask '''
+
+    return [source for source in SOURCES if flags & SOURCE_BITS[source]]
+
+
+def carried_flags(carried):
+    ''' Flags bitmask marking the sources in carried as carried forward '''
+
+    flags = 0
+    for source in carried:
+        flags |= CARRIED_BITS[source]
+    return flags
+
+
+class StreamStats:
+    ''' Rolling per-source residual statistics, checkpointed to SQLite '''
+
+    def __init__(self, conn, alpha=0.02, sigma=4.0, min_dev=3.0, warmup=30):
+        self.conn = conn
+        self.alpha = alpha          # EWMA weight; ~1/alpha readings of memory
+        self.sigma = sigma
+        self.min_dev = min_dev      # Degrees F; ignore tiny absolute differences
+        self.warmup = warmup        # Readings before a source can be flagged
+
+        self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS SourceStats(
+                    source TEXT NOT NULL PRIMARY KEY,
+                    count INTEGER NOT NULL,
+                    mean REAL NOT NULL,
+                    var REAL NOT NULL)'''
+        )
+
+        self.state = {source: [0, 0.0, 0.0] for source in SOURCES}
+        for source, count, mean, var in self.conn.execute(
+                'SELECT source, count, mean, var FROM SourceStats'):
+            if source in self.state:
+                self.state[source] = [count, mean, var]
+
+    def update(self, source, residual):
+        '''
+        Fold one residual into a source's state. Early on the weight is 1/n,
+        which gives the plain running mean and variance.
+        '''
+
+        state = self.state[source]
+        state[0] += 1
+        weight = max(self.alpha, 1.0 / state[0])
+        diff = residual - state[1]
+        incr = weight * diff
+        state[1] += incr
+        state[2] = (1.0 - weight) * (state[2] + diff * incr)
+
+    def check(self, readings, err_reading, carried=()):
+        '''
+        Take dict of source -> reading for one cycle. Returns flags bitmask
+        of outliers and updates state. Error readings and sources in carried
+        (readings repeated from an earlier cycle) are skipped, and a source
+        is only judged when at least two others read correctly.
+        '''
+
+        good = {source: readings[source] for source in SOURCES
+                if source not in carried and readings.get(source) is not None
+                and readings[source] < err_reading}
+
+        flags = 0
+        for source, reading in good.items():
+            others = [value for other, value in good.items() if other != source]
+            if len(others) < 2:
+                continue
+
+            residual = reading - statistics.median(others)
+            count, mean, var = self.state[source]
+            if count >= self.warmup:
+                limit = max(self.sigma * var ** 0.5, self.min_dev)
+                if abs(residual - mean) > limit:
+                    flags |= SOURCE_BITS[source]
+
+            self.update(source, residual)
+
+        return flags
+
+    def save(self):
+        ''' Write state to SourceStats; caller commits '''
+
+        self.conn.executemany('''INSERT OR REPLACE INTO SourceStats
+                (source, count, mean, var) VALUES (?, ?, ?, ?)''',
+                [(source, *state) for source, state in self.state.items()])
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+
+'''
+Program:      tempsCommon.py
+Author:       Jeff VanSickle
+Created:      20261017
+Modified:     20261017
+
+Module holds the constants and small helpers the collector-side tools share,
+so each tool doesn't keep its own copy.
+
+Databases from before some columns were added (outlier_flags, the deltas)
+are still read and migrated. select_columns() builds a select list from a
+table's actual columns with a stand-in for the missing ones, so tools don't
+each check PRAGMA table_info themselves.
+
+vis_tools/tempsLoader.py mirrors the constants for the visualization tools,
+which don't import from here.
+'''
+
+ERR_READING = 999.99    # Reading a source sends (or is given) when it fails
+MEAN_LIMIT = 150.00     # Sanity limit on temps_mean for graphs and rollups
+
+
+def table_columns(conn, table):
+    ''' Column names of table, in table order '''
+
+    return [row[1] for row in conn.execute('PRAGMA table_info({})'.format(table))]
+
+
+def has_column(conn, table, column):
+    ''' True if table has column '''
+
+    return column in table_columns(conn, table)
+
+
+def select_columns(conn, table, columns, fill='0'):
+    '''
+    Select list for columns from table. Columns the table doesn't have
+    read as fill, except outlier_flags, which reads as 0 (nothing flagged).
+    '''
+
+    present = table_columns(conn, table)
+    return ', '.join(column if column in present else ('0' if column == 'outlier_flags' else fill)
+                     for column in columns)
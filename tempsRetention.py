@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+
+'''
+Program:      tempsRetention.py
+Author:       Jeff VanSickle
+Created:      20261017
+Modified:     20261017
+
+Script keeps the local DB from growing without bound. Readings age through
+tiers, each coarser than the last:
+
+    raw         Temps (or Readings after migrateSchema.py), --raw-days
+    15 minutes  Temps15m, --fifteen-days
+    hourly      TempsHourly, --hourly-days (0 keeps them forever)
+    daily       TempsDaily, kept forever
+
+Temps15m has the same layout as the rollups in tempsRollup.py, with buckets
+of YYYYMMDDHHMM where MM is 00, 15, 30 or 45. Raw rows older than the raw
+cutoff are folded into it and deleted. Aggregates older than a tier's
+cutoff are folded into the next tier if that tier doesn't have the bucket
+yet (the collector keeps the hourly and daily rollups current, so it
+usually does) and deleted. SensorReads and CycleTimings rows go with the
+raw rows.
+
+Cutoffs fall on UTC midnight, so a bucket is never split between tiers.
+Work goes in batches of --batch-rows rows, one short transaction each with
+a pause between, so the collector waits at most for one batch.
+
+Freed pages go back to the file system with PRAGMA incremental_vacuum,
+which needs auto_vacuum=INCREMENTAL. New DBs get that from
+migrateSchema.create_schema(); for older ones run once with --setup-vacuum
+(a full VACUUM, which needs free space the size of the DB and blocks the
+collector while it runs).
+
+Run daily from cron. Graphs and tempsServer.py ranges older than the raw
+cutoff should use the hourly or daily resolution.
+
+INSTRUCTIONS:
+    tempsRetention.py -l <SQLITE_DB> [--raw-days 30] [--fifteen-days 365]
+                      [--hourly-days 0] [--batch-rows 2000] [--setup-vacuum]
+                      [--dry-run]
+'''
+
+import sqlite3
+import argparse
+import datetime
+import time
+import migrateSchema
+import tempsRollup
+import streamStats
+import tempsCommon
+
+FIFTEEN_TABLE = 'Temps15m'
+FIFTEEN_WIDTH = 12
+BUCKET_SECONDS = 900
+
+# Aggregate tiers, finest first: (table, bucket width)
+AGGREGATE_TIERS = [(FIFTEEN_TABLE, FIFTEEN_WIDTH),
+                   ('TempsHourly', 10),
+                   ('TempsDaily', 8)]
+
+# Tables pruned along with the raw readings -> text rectime column
+PRUNE_TABLES = {'SensorReads': 'rectime',
+                'CycleTimings': 'rectime'}
+
+AUTO_VACUUM_INCREMENTAL = 2
+
+
+def create_tables(cursor):
+    ''' Rollup tables, plus Temps15m in the same layout '''
+
+    tempsRollup.create_rollups(cursor)
+    cursor.execute('''
+            CREATE TABLE IF NOT EXISTS {}(
+                bucket TEXT NOT NULL,
+                source TEXT NOT NULL,
+                min_read REAL,
+                max_read REAL,
+                mean_read REAL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (bucket, source))'''.format(FIFTEEN_TABLE)
+    )
+
+
+def cutoff_rectime(days, now=None):
+    ''' YYYYMMDDHHMMSS of UTC midnight days ago '''
+
+    if now is None:
+        now = time.time()
+    day = datetime.datetime.utcfromtimestamp(now - days * 86400).date()
+    return day.strftime('%Y%m%d') + '000000'
+
+
+def bucket_sql(text):
+    ''' SQL for the 15-minute bucket of the YYYYMMDDHHMMSS text in text '''
+
+    return ("substr({0}, 1, 10) || printf('%02d', CAST(substr({0}, 11, 2) AS INTEGER) "
+            "/ 15 * 15)").format(text)
+
+
+def table_exists(conn, table):
+    return migrateSchema.object_type(conn, table) == 'table'
+
+
+class RawTable:
+    ''' Where raw readings live and how their rectime is stored '''
+
+    def __init__(self, conn):
+        if migrateSchema.schema_version(conn) >= migrateSchema.SCHEMA_VERSION:
+            self.table = 'Readings'
+            self.as_text = migrateSchema.text_sql('rectime')
+        else:
+            self.table = 'Temps'
+            self.as_text = 'rectime'
+
+        self.bucket = bucket_sql(self.as_text)
+        self.has_flags = tempsCommon.has_column(conn, self.table, 'outlier_flags')
+
+    def key(self, epoch):
+        ''' rectime value for epoch seconds '''
+
+        if self.table == 'Readings':
+            return epoch
+        return time.strftime('%Y%m%d%H%M%S', time.gmtime(epoch))
+
+    def epoch(self, key):
+        if self.table == 'Readings':
+            return key
+        return migrateSchema.rectime_to_epoch(key)
+
+
+def fold_raw(conn, cutoff, batch_rows, pause):
+    '''
+    Fold raw rows older than the text rectime cutoff into Temps15m and
+    delete them. Returns rows deleted.
+    '''
+
+    raw = RawTable(conn)
+    cutoff_key = raw.key(migrateSchema.rectime_to_epoch(cutoff))
+    removed = 0
+
+    while True:
+        # End the batch on a bucket boundary after batch_rows rows
+        row = conn.execute('SELECT rectime FROM {} WHERE rectime < ? ORDER BY rectime '
+                           'LIMIT 1 OFFSET ?'.format(raw.table),
+                           (cutoff_key, batch_rows - 1)).fetchone()
+        if row is None:
+            upper = cutoff_key
+        else:
+            boundary = (raw.epoch(row[0]) // BUCKET_SECONDS + 1) * BUCKET_SECONDS
+            upper = min(raw.key(boundary), cutoff_key)
+
+        # Merge rather than replace, in case a bucket was partly folded
+        # before (late rows from importTemps.py or a clock change).
+        # Carried-forward readings are left out, as in tempsRollup.py
+        for source, column in tempsRollup.SOURCE_COLUMNS.items():
+            limit = tempsCommon.MEAN_LIMIT if source == 'mean' else tempsCommon.ERR_READING
+            carried = streamStats.CARRIED_BITS.get(source, 0) if raw.has_flags else 0
+            conn.execute('''INSERT INTO {0}
+                    (bucket, source, min_read, max_read, mean_read, count)
+                    SELECT {1}, ?, MIN({2}), MAX({2}), AVG({2}), COUNT({2})
+                    FROM {3} WHERE rectime < ? AND {2} < ? AND {4} & ? = 0
+                    GROUP BY 1
+                    ON CONFLICT(bucket, source) DO UPDATE SET
+                        min_read = MIN(min_read, excluded.min_read),
+                        max_read = MAX(max_read, excluded.max_read),
+                        mean_read = (mean_read * count + excluded.mean_read * excluded.count)
+                                    / (count + excluded.count),
+                        count = count + excluded.count'''.format(
+                    FIFTEEN_TABLE, raw.bucket, column, raw.table,
+                    'outlier_flags' if raw.has_flags else '0'),
+                    (source, upper, limit, carried))
+
+        removed += conn.execute('DELETE FROM {} WHERE rectime < ?'.format(raw.table),
+                                (upper,)).rowcount
+        conn.commit()
+
+        if row is None:
+            break
+        time.sleep(pause)
+
+    return removed
+
+
+def fold_aggregates(conn, tier, cutoff, batch_rows, pause):
+    '''
+    Fold buckets of AGGREGATE_TIERS[tier] older than the text rectime cutoff
+    into the next tier where it lacks them, then delete them. Returns rows
+    deleted.
+    '''
+
+    table, width = AGGREGATE_TIERS[tier]
+    next_table, next_width = AGGREGATE_TIERS[tier + 1]
+    cutoff_bucket = cutoff[:width]
+    removed = 0
+
+    while True:
+        # Whole next-tier buckets per batch, so none is copied half done
+        row = conn.execute('SELECT substr(bucket, 1, ?) FROM {} WHERE bucket < ? ORDER BY bucket '
+                           'LIMIT 1 OFFSET ?'.format(table),
+                           (next_width, cutoff_bucket, batch_rows - 1)).fetchone()
+        if row is None:
+            upper = cutoff_bucket
+        else:
+            upper = min(row[0] + '9' * (width - next_width), cutoff_bucket)
+
+        conn.execute('''INSERT OR IGNORE INTO {0}
+                (bucket, source, min_read, max_read, mean_read, count)
+                SELECT substr(bucket, 1, {1}), source, MIN(min_read), MAX(max_read),
+                    SUM(mean_read * count) / SUM(count), SUM(count)
+                FROM {2} WHERE bucket <= ? AND bucket < ?
+                GROUP BY 1, source'''.format(next_table, next_width, table),
+                (upper, cutoff_bucket))
+        deleted = conn.execute('DELETE FROM {} WHERE bucket <= ? AND bucket < ?'.format(table),
+                               (upper, cutoff_bucket)).rowcount
+        conn.commit()
+        removed += deleted
+
+        if row is None or deleted == 0:
+            break
+        time.sleep(pause)
+
+    return removed
+
+
+def prune_table(conn, table, column, cutoff, batch_rows, pause):
+    ''' Delete rows with text rectime before cutoff; returns rows deleted '''
+
+    removed = 0
+    while True:
+        deleted = conn.execute('DELETE FROM {0} WHERE rowid IN (SELECT rowid FROM {0} '
+                               'WHERE {1} < ? LIMIT ?)'.format(table, column),
+                               (cutoff, batch_rows)).rowcount
+        conn.commit()
+        removed += deleted
+        if deleted < batch_rows:
+            break
+        time.sleep(pause)
+
+    return removed
+
+
+def count_older(conn, raw_cutoff, fifteen_cutoff, hourly_cutoff):
+    ''' Rows each tier would remove, for --dry-run '''
+
+    raw = RawTable(conn)
+    counts = {raw.table: conn.execute(
+              'SELECT COUNT(*) FROM {} WHERE rectime < ?'.format(raw.table),
+              (raw.key(migrateSchema.rectime_to_epoch(raw_cutoff)),)).fetchone()[0]}
+
+    for (table, width), cutoff in zip(AGGREGATE_TIERS, [fifteen_cutoff, hourly_cutoff]):
+        if cutoff is not None and table_exists(conn, table):
+            counts[table] = conn.execute('SELECT COUNT(*) FROM {} WHERE bucket < ?'.format(table),
+                                         (cutoff[:width],)).fetchone()[0]
+
+    for table, column in PRUNE_TABLES.items():
+        if table_exists(conn, table):
+            counts[table] = conn.execute('SELECT COUNT(*) FROM {} WHERE {} < ?'.format(table, column),
+                                         (raw_cutoff,)).fetchone()[0]
+
+    return counts
+
+
+def apply_retention(conn, raw_days, fifteen_days, hourly_days=0, batch_rows=2000, pause=0.05):
+    '''
+    Age readings through the tiers; days of 0 keeps a tier forever (raw_days
+    must be set). Returns dict of table -> rows deleted.
+    '''
+
+    create_tables(conn.cursor())
+    conn.commit()
+
+    now = time.time()
+    removed = {}
+
+    raw_cutoff = cutoff_rectime(raw_days, now)
+    removed[RawTable(conn).table] = fold_raw(conn, raw_cutoff, batch_rows, pause)
+
+    for table, column in PRUNE_TABLES.items():
+        if table_exists(conn, table):
+            removed[table] = prune_table(conn, table, column, raw_cutoff, batch_rows, pause)
+
+    for tier, days in enumerate([fifteen_days, hourly_days]):
+        if days:
+            removed[AGGREGATE_TIERS[tier][0]] = fold_aggregates(conn, tier, cutoff_rectime(days, now),
+                                                                batch_rows, pause)
+
+    return removed
+
+
+def incremental_vacuum(conn, pages_per_step=256, pause=0.05):
+    ''' Give free pages back in small steps; returns pages freed '''
+
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != AUTO_VACUUM_INCREMENTAL:
+        return None
+
+    start_pages = free_pages = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    while free_pages > 0:
+        # execute() would only step the pragma once, freeing a single page
+        conn.executescript('PRAGMA incremental_vacuum({});'.format(pages_per_step))
+        left = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        if left >= free_pages:
+            break
+        free_pages = left
+        time.sleep(pause)
+
+    return start_pages - free_pages
+
+
+if __name__ == '__main__':
+    inputs = argparse.ArgumentParser()
+    inputs.add_argument('-l', '--localdb',
+                        required=True,
+                        help='Name of local SQLite DB to use')
+    inputs.add_argument('--raw-days',
+                        type=int,
+                        default=30,
+                        help='Days of raw readings to keep (default 30)')
+    inputs.add_argument('--fifteen-days',
+                        type=int,
+                        default=365,
+                        help='Days of 15-minute aggregates to keep; 0 keeps all (default 365)')
+    inputs.add_argument('--hourly-days',
+                        type=int,
+                        default=0,
+                        help='Days of hourly aggregates to keep; 0 keeps all (default)')
+    inputs.add_argument('--batch-rows',
+                        type=int,
+                        default=2000,
+                        help='Rows per transaction (default 2000)')
+    inputs.add_argument('--pause',
+                        type=float,
+                        default=0.05,
+                        help='Seconds between transactions (default 0.05)')
+    inputs.add_argument('--setup-vacuum',
+                        action='store_true',
+                        help='Switch the DB to incremental vacuum (runs a full VACUUM once)')
+    inputs.add_argument('--dry-run',
+                        action='store_true',
+                        help='Only report how many rows each tier would remove')
+    args = inputs.parse_args()
+
+    if args.raw_days < 1:
+        inputs.error('--raw-days must be at least 1')
+    for name, days in [('--fifteen-days', args.fifteen_days), ('--hourly-days', args.hourly_days)]:
+        if days and days < args.raw_days:
+            inputs.error('{} must be 0 or at least --raw-days'.format(name))
+    if args.hourly_days and args.fifteen_days and args.hourly_days < args.fifteen_days:
+        inputs.error('--hourly-days must be 0 or at least --fifteen-days')
+
+    temps_db = sqlite3.connect(args.localdb, timeout=60.0)
+
+    if args.dry_run:
+        now = time.time()
+        counts = count_older(temps_db, cutoff_rectime(args.raw_days, now),
+                             cutoff_rectime(args.fifteen_days, now) if args.fifteen_days else None,
+                             cutoff_rectime(args.hourly_days, now) if args.hourly_days else None)
+        for table, count in counts.items():
+            print('{}: {} row(s) older than cutoff'.format(table, count))
+        temps_db.close()
+        raise SystemExit(0)
+
+    if args.setup_vacuum:
+        temps_db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        temps_db.execute('VACUUM')
+
+    start = time.time()
+    removed = apply_retention(temps_db, args.raw_days, args.fifteen_days, args.hourly_days,
+                              args.batch_rows, args.pause)
+    for table, count in removed.items():
+        print('{}: removed {} row(s)'.format(table, count))
+
+    freed = incremental_vacuum(temps_db, pause=args.pause)
+    if freed is None:
+        print('auto_vacuum is not INCREMENTAL; run once with --setup-vacuum to give space back')
+    else:
+        print('Freed {} page(s) in {:.1f} s'.format(freed, time.time() - start))
+
+    temps_db.close()
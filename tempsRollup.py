@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+'''
+Program:      tempsRollup.py
+Author:       Jeff VanSickle
+Created:      20261017
+Modified:     20261017
+
+Module maintains hourly and daily rollups of the Temps table so long-range
+graphs don't have to pull every raw reading. For each hour (TempsHourly)
+and day (TempsDaily) there is one row per source holding min, max, mean
+and count of that source's readings. Error readings (999.99) and readings
+carried forward from an earlier cycle (see streamStats.CARRIED_BITS) are
+left out.
+The mean of all sources is rolled up under source 'mean'.
+
+collectTemp.py calls update_rollups() for each new reading in the same
+transaction as its insert. Run this file with --rebuild to build the rollups
+from readings already in the database.
+
+Buckets are the leading digits of rectime: YYYYMMDDHH for hours and
+YYYYMMDD for days.
+
+INSTRUCTIONS:
+    tempsRollup.py -l <SQLITE_DB> --rebuild
+'''
+
+import sqlite3
+import argparse
+import streamStats
+import tempsCommon
+from tempsCommon import ERR_READING, MEAN_LIMIT
+
+# Rollup table -> length of rectime prefix used as its bucket
+ROLLUP_TABLES = {'TempsHourly': 10,
+                 'TempsDaily': 8}
+
+# Rollup source name -> Temps column
+SOURCE_COLUMNS = {'dsapi': 'dsapi_read',
+                  'owm': 'owm_read',
+                  'w2': 'w2_read',
+                  'wg': 'wg_read',
+                  'ds18b20': 'ds18b20_read',
+                  'mean': 'temps_mean'}
+
+
+def create_rollups(cursor):
+    ''' Create rollup tables if they don't exist '''
+
+    for table in ROLLUP_TABLES:
+        cursor.execute('''
+                CREATE TABLE IF NOT EXISTS {}(
+                    bucket TEXT NOT NULL,
+                    source TEXT NOT NULL,
+                    min_read REAL,
+                    max_read REAL,
+                    mean_read REAL,
+                    count INTEGER NOT NULL,
+                    PRIMARY KEY (bucket, source))'''.format(table)
+        )
+
+
+def valid_reading(source, value):
+    ''' True if value belongs in the rollups '''
+
+    if value is None:
+        return False
+    if source == 'mean':
+        return value < MEAN_LIMIT
+    return value < ERR_READING
+
+
+def update_rollups(cursor, rectime, readings):
+    '''
+    Fold one reading into the rollups. readings maps source name (keys of
+    SOURCE_COLUMNS) to value. Doesn't commit; caller commits along with the
+    Temps insert.
+    '''
+
+    rows = [(source, value) for source, value in readings.items()
+            if source in SOURCE_COLUMNS and valid_reading(source, value)]
+
+    for table, width in ROLLUP_TABLES.items():
+        bucket = rectime[:width]
+        cursor.executemany('''INSERT INTO {0}
+                (bucket, source, min_read, max_read, mean_read, count)
+                VALUES (?, ?, ?, ?, ?, 1)
+                ON CONFLICT(bucket, source) DO UPDATE SET
+                    min_read = MIN(min_read, excluded.min_read),
+                    max_read = MAX(max_read, excluded.max_read),
+                    mean_read = mean_read + (excluded.mean_read - mean_read) / (count + 1),
+                    count = count + 1'''.format(table),
+                [(bucket, source, value, value, value) for source, value in rows])
+
+
+def rebuild_rollups(conn, days=None):
+    '''
+    Recompute rollups from the Temps table. Buckets before the oldest
+    reading in Temps are left alone, since tempsRetention.py may have
+    deleted their readings. days, a list of YYYYMMDD strings, limits the
+    rebuild to those days.
+    '''
+
+    cursor = conn.cursor()
+    create_rollups(cursor)
+
+    if days is None:
+        oldest = cursor.execute('SELECT MIN(rectime) FROM Temps').fetchone()[0] or ''
+        rows_where = '1'
+    else:
+        cursor.execute('CREATE TEMP TABLE IF NOT EXISTS RebuildDays(day TEXT NOT NULL PRIMARY KEY)')
+        cursor.execute('DELETE FROM RebuildDays')
+        cursor.executemany('INSERT OR IGNORE INTO RebuildDays (day) VALUES (?)', [(day,) for day in days])
+        rows_where = 'substr(rectime, 1, 8) IN (SELECT day FROM RebuildDays)'
+
+    has_flags = tempsCommon.has_column(cursor, 'Temps', 'outlier_flags')
+
+    # One pass over the readings into the finest buckets; every rollup
+    # table is then built from those
+    finest = max(ROLLUP_TABLES.values())
+    sums = []
+    for source, column in SOURCE_COLUMNS.items():
+        limit = MEAN_LIMIT if source == 'mean' else ERR_READING
+        condition = '{} < {}'.format(column, limit)
+        if has_flags and source in streamStats.CARRIED_BITS:
+            condition += ' AND outlier_flags & {} = 0'.format(streamStats.CARRIED_BITS[source])
+        good = 'CASE WHEN {} THEN {} END'.format(condition, column)
+        sums.append('MIN({0}) AS {1}_min, MAX({0}) AS {1}_max, SUM({0}) AS {1}_sum, '
+                    'COUNT({0}) AS {1}_count'.format(good, source))
+    cursor.execute('DROP TABLE IF EXISTS temp.RebuildBuckets')
+    cursor.execute('CREATE TEMP TABLE RebuildBuckets AS SELECT substr(rectime, 1, {}) AS bucket, {} '
+                   'FROM Temps WHERE {} GROUP BY 1'.format(finest, ', '.join(sums), rows_where))
+
+    for table, width in ROLLUP_TABLES.items():
+        if days is None:
+            cursor.execute('DELETE FROM {} WHERE bucket >= ?'.format(table), (oldest[:width],))
+        else:
+            cursor.execute('DELETE FROM {} WHERE substr(bucket, 1, 8) IN '
+                           '(SELECT day FROM RebuildDays)'.format(table))
+
+        for source in SOURCE_COLUMNS:
+            cursor.execute('''INSERT INTO {0}
+                    (bucket, source, min_read, max_read, mean_read, count)
+                    SELECT substr(bucket, 1, {1}), ?, MIN({2}_min), MAX({2}_max),
+                        SUM({2}_sum) / SUM({2}_count), SUM({2}_count)
+                    FROM RebuildBuckets
+                    GROUP BY 1 HAVING SUM({2}_count) > 0'''.format(table, width, source),
+                    (source,))
+
+    cursor.execute('DROP TABLE temp.RebuildBuckets')
+    conn.commit()
+    cursor.close()
+
+
+if __name__ == '__main__':
+    inputs = argparse.ArgumentParser()
+    inputs.add_argument('-l', '--localdb',
+                        required=True,
+                        help='Name of local SQLite DB to use')
+    inputs.add_argument('--rebuild',
+                        action='store_true',
+                        help='Recompute rollups from the readings in Temps')
+    args = inputs.parse_args()
+
+    temps_db = sqlite3.connect(args.localdb)
+
+    if args.rebuild:
+        rebuild_rollups(temps_db)
+    else:
+        create_rollups(temps_db.cursor())
+        temps_db.commit()
+
+    temps_db.close()
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# Modules live at the top of the repo and in vis_tools/, not in a package
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in [ROOT, os.path.join(ROOT, 'vis_tools')]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
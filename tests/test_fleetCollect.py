@@ -0,0 +1,39 @@
+import json
+
+import fleetCollect
+
+PROVIDERS = ['dsapi', 'owm', 'w2', 'wg']
+
+# One body every provider's parser can read
+BODY = json.dumps({'currently': {'temperature': 50.0},
+                   'main': {'temp': 51.0},
+                   'weather': {'curren_weather': [{'temp': 52.0}]},
+                   'current_observation': {'temp_f': 53.0}}).encode('utf-8')
+
+
+def test_every_site_read_when_sites_outnumber_burst(tmp_path, monkeypatch):
+    for key in ['DS_APIKEY', 'OWM_APIKEY', 'W2_APIKEY', 'WG_APIKEY']:
+        monkeypatch.setenv(key, 'test')
+
+    sites = 6
+    config = {'max_workers': 8,
+              'rate_limits': {provider: {'rate': 4.0, 'burst': 2} for provider in PROVIDERS},
+              'locations': [{'name': 'n{}'.format(number), 'lat': '40.0', 'lon': str(-75.0 - number)}
+                            for number in range(sites)]}
+    collector = fleetCollect.FleetCollector(str(tmp_path / 'fleet.db'), config,
+                                            source_timeout=0.5, cycle_timeout=3.0)
+    collector.pool.request = lambda url, headers=None, timeout=None: (200, {}, BODY)
+    collector.cache.ttls = {provider: 0 for provider in PROVIDERS}     # Every read calls out
+
+    read = set()
+    try:
+        for cycle in range(2):
+            collector.run_cycle()
+            for row in collector.temps_db.execute('''SELECT location, dsapi_read, owm_read, w2_read,
+                    wg_read FROM FleetTemps WHERE rectime = (SELECT MAX(rectime) FROM FleetTemps)'''):
+                read.update((row[0], provider) for provider, value in zip(PROVIDERS, row[1:])
+                            if value is not None and value < 999.99)
+    finally:
+        collector.close()
+
+    assert read == {('n{}'.format(number), provider) for number in range(sites) for provider in PROVIDERS}
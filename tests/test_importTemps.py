@@ -0,0 +1,29 @@
+import pytest
+
+pytest.importorskip('numpy')
+
+import importTemps
+
+ERR = importTemps.ERR_READING
+COLUMNS = ['rectime', 'dsapi_read', 'owm_read', 'w2_read', 'wg_read', 'ds18b20_read', 'temps_mean']
+
+
+def test_blank_mean_is_recomputed():
+    lines = ['20261017000000,50,52,54,56,58,60\n',      # Mean given; kept
+             '20261017000300,50,52,54,56,58,\n',        # Blank mean
+             '20261017000600,50,52,,56,58,999.99\n']    # Error mean, one blank reading
+    rows, skipped = importTemps.parse_chunk(lines, COLUMNS, ',')
+
+    assert skipped == 0
+    given, blank, error = rows
+
+    assert given[6] == 60
+    assert given[7:12] == (-10, -8, -6, -4, -2)
+
+    assert blank[6] == pytest.approx(54)
+    assert blank[7:12] == pytest.approx((-4, -2, 0, 2, 4))
+
+    assert error[6] == pytest.approx(54)
+    assert error[3] == ERR
+    assert error[9] == ERR
+    assert error[7] == pytest.approx(-4)
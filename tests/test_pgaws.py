@@ -0,0 +1,34 @@
+import threading
+
+import pytest
+
+pgaws = pytest.importorskip('alt_db.pgaws')
+
+
+class FakePool:
+    def __init__(self, minconn, maxconn, **config):
+        self.config = config
+
+    def closeall(self):
+        pass
+
+
+def test_get_manager_without_injected_manager(monkeypatch):
+    monkeypatch.setattr(pgaws, '_config', None)
+    monkeypatch.setattr(pgaws, '_manager', None)
+    monkeypatch.setattr(pgaws.psycopg2.pool, 'ThreadedConnectionPool', FakePool)
+    monkeypatch.setenv('PGINST', 'localhost')
+    monkeypatch.setenv('PGDB', 'temps')
+    monkeypatch.setenv('PGUSER', 'collector')
+    monkeypatch.setenv('PGPASSWORD', 'secret')
+    monkeypatch.setenv('PGSSLMODE', 'disable')
+
+    result = {}
+    worker = threading.Thread(target=lambda: result.update(sink=pgaws.PostgresSink()),
+                              daemon=True)
+    worker.start()
+    worker.join(5)
+
+    assert not worker.is_alive(), 'get_manager() deadlocked'
+    assert result['sink'].manager is pgaws.get_manager()
+    assert result['sink'].manager.pool.config['host'] == 'localhost'
@@ -0,0 +1,32 @@
+import json
+import os
+import time
+
+from sinkPipeline import Sink
+
+
+def test_close_cuts_linger_short_and_writes_partial_batch():
+    written = []
+    sink = Sink('test', written.extend, batch_size=20, linger=3420.0)
+    for number in range(3):
+        sink.put({'rectime': number})
+    time.sleep(0.2)         # Worker is now lingering for the rest of the batch
+
+    start = time.monotonic()
+    assert sink.close(5.0)
+    assert time.monotonic() - start < 2.0
+    assert written == [{'rectime': number} for number in range(3)]
+
+
+def test_close_spills_partial_batch_that_fails(tmp_path):
+    def failing(items):
+        raise RuntimeError('target down')
+
+    sink = Sink('test', failing, policy='spill', spill_dir=str(tmp_path),
+                batch_size=20, linger=3420.0, retry_delay=0.1)
+    sink.put({'rectime': 1})
+    time.sleep(0.2)
+
+    assert sink.close(5.0)
+    with open(os.path.join(str(tmp_path), 'test.spill')) as spill_file:
+        assert [json.loads(line)['item'] for line in spill_file] == [{'rectime': 1}]
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+
+'''
+Program:      tempsArchive.py
+Author:       Jeff VanSickle
+Created:      20261017
+Modified:     20261017
+
+Program moves closed months of the Temps table into a columnar archive and
+provides the reader the visualization tools use to get them back.
+
+Each archived month is a directory of flat binary files, one per column:
+
+    <ARCHIVE>/YYYYMM/id.i8           int64
+    <ARCHIVE>/YYYYMM/rectime.i8      int64 epoch seconds (UTC)
+    <ARCHIVE>/YYYYMM/<column>.f8     float64, for each reading, the mean
+                                     and each delta
+    <ARCHIVE>/YYYYMM/outlier_flags.i8
+                                     int64 bitmask from streamStats.py;
+                                     months archived without it read as 0
+
+plus <ARCHIVE>/index.json listing the months, their row counts and first
+and last id/rectime. Files are read with numpy.memmap, so pulling a range
+out of a month touches only the pages it needs and copies nothing until
+the data is used. Rows stay sorted by rectime, so a range is found with a
+binary search.
+
+Run with --purge to delete archived rows from SQLite once they are safely
+on disk. tempsLoader.combineColumns() joins archived rows with whatever is
+still in SQLite.
+
+In DBs moved over by migrateSchema.py, months are read from the Readings
+table and a row's id is its epoch seconds.
+
+INSTRUCTIONS:
+    tempsArchive.py -d <SQLITE_DB> -a <ARCHIVE_DIR> [--purge]
+    - Requires NumPy
+'''
+
+import sqlite3
+import argparse
+import datetime
+import json
+import os
+import shutil
+import numpy as np
+import tempsLoader
+
+# Reading, mean and delta columns, stored as float64
+FLOAT_COLUMNS = ['dsapi_read', 'owm_read', 'w2_read', 'wg_read', 'ds18b20_read',
+                 'temps_mean', 'dsapi_delta', 'owm_delta', 'w2_delta', 'wg_delta',
+                 'ds18b20_delta']
+
+# Integer columns after id and rectime, stored as int64
+INT_COLUMNS = ['outlier_flags']
+
+INDEX_FILE = 'index.json'
+
+
+# Function to give start of month after YYYYMM as YYYYMMDDHHMMSS
+def nextMonthStart(month):
+    year, mon = int(month[:4]), int(month[4:6])
+    if mon == 12:
+        return '{:04d}0101000000'.format(year + 1)
+    return '{:04d}{:02d}01000000'.format(year, mon + 1)
+
+class ArchiveReader:
+    ''' Memory-mapped access to archived months '''
+
+    def __init__(self, archiveDir):
+        self.archiveDir = archiveDir
+        try:
+            with open(os.path.join(archiveDir, INDEX_FILE), 'r') as indexHandle:
+                self.index = json.load(indexHandle)
+        except (OSError, ValueError):
+            self.index = {'months': {}}
+
+    def months(self):
+        ''' Archived months (YYYYMM), oldest first '''
+
+        return sorted(self.index['months'])
+
+    def lastRectime(self):
+        ''' Newest archived rectime as YYYYMMDDHHMMSS, or None '''
+
+        months = self.months()
+        return self.index['months'][months[-1]]['last'] if months else None
+
+    def lastId(self):
+        ''' Highest archived id, or 0 '''
+
+        return max([info['lastId'] for info in self.index['months'].values()] or [0])
+
+    def openMonth(self, month):
+        ''' Return dict of column -> read-only memmap for one month '''
+
+        monthDir = os.path.join(self.archiveDir, month)
+        rows = self.index['months'][month]['rows']
+        columns = {'id': np.memmap(os.path.join(monthDir, 'id.i8'), dtype = np.int64,
+                                   mode = 'r', shape = (rows,)),
+                   'rectime': np.memmap(os.path.join(monthDir, 'rectime.i8'),
+                                        dtype = 'datetime64[s]', mode = 'r', shape = (rows,))}
+        for colName in FLOAT_COLUMNS:
+            columns[colName] = np.memmap(os.path.join(monthDir, colName + '.f8'),
+                                         dtype = np.float64, mode = 'r', shape = (rows,))
+        for colName in INT_COLUMNS:
+            colPath = os.path.join(monthDir, colName + '.i8')
+            if os.path.exists(colPath):
+                columns[colName] = np.memmap(colPath, dtype = np.int64, mode = 'r', shape = (rows,))
+            else:
+                columns[colName] = np.zeros(rows, dtype = np.int64)
+        return columns
+
+    def loadRange(self, start = None, end = None, includeEnd = True, minId = None,
+                  names = None, validOnly = True):
+        '''
+        Return dict of column -> array for archived rows with start <= rectime
+        <= end (or < end if not includeEnd) and id > minId. start and end are
+        YYYYMMDDHHMMSS strings; None means no bound. Float columns come back
+        masked like tempsLoader's. With validOnly, rows whose mean fails the
+        usual MEAN_LIMIT sanity check are left out, same as the SQL queries.
+        '''
+
+        if names is None:
+            names = ['rectime'] + tempsLoader.READ_COLUMNS
+
+        startStamp = tempsLoader.parseRectimes([start])[0] if start else None
+        endStamp = tempsLoader.parseRectimes([end])[0] if end else None
+        pieces = {name: [] for name in names}
+
+        for month in self.months():
+            info = self.index['months'][month]
+            if end is not None and info['first'] > end:
+                continue
+            if start is not None and info['last'] < start:
+                continue
+            if minId is not None and info['lastId'] <= minId:
+                continue
+
+            columns = self.openMonth(month)
+            lowIdx, highIdx = 0, info['rows']
+            if startStamp is not None:
+                lowIdx = np.searchsorted(columns['rectime'], startStamp, side = 'left')
+            if endStamp is not None:
+                highIdx = np.searchsorted(columns['rectime'], endStamp,
+                                          side = 'right' if includeEnd else 'left')
+
+            if highIdx <= lowIdx:
+                continue
+
+            keep = slice(lowIdx, highIdx)
+            rowMask = np.ones(highIdx - lowIdx, dtype = bool)
+            if minId is not None:
+                rowMask &= columns['id'][keep] > minId
+            if validOnly:
+                rowMask &= columns['temps_mean'][keep] < tempsLoader.MEAN_LIMIT
+
+            for name in names:
+                pieces[name].append(np.asarray(columns[name][keep])[rowMask])
+
+        result = {}
+        for name in names:
+            if pieces[name]:
+                values = np.concatenate(pieces[name])
+            else:
+                values = tempsLoader.emptyColumn(name)
+            if name in FLOAT_COLUMNS:
+                values = tempsLoader.maskReadings(np.asarray(values, dtype = np.float64))
+            result[name] = values
+
+        return result
+
+# Function to write one month of Temps to the archive
+def archiveMonth(tempsDB, archiveDir, month):
+    names = ['id', 'rectime'] + FLOAT_COLUMNS + INT_COLUMNS
+    if tempsLoader.readingsSchema(tempsDB):
+        # Epoch-keyed table; the key stands in for id
+        monthData = tempsLoader.loadTemps(tempsDB,
+                    'SELECT rectime, ' + ', '.join(names[1:]) + ' FROM Readings ' +
+                    'WHERE rectime >= ? AND rectime < ? ORDER BY rectime',
+                    (tempsLoader.rectimeToEpoch(month + '01000000'),
+                    tempsLoader.rectimeToEpoch(nextMonthStart(month))), names = names)
+    else:
+        monthData = tempsLoader.loadTemps(tempsDB,
+                    'SELECT ' + tempsLoader.selectColumns(tempsDB, 'Temps', names) + ' FROM Temps ' +
+                    'WHERE rectime >= ? AND rectime < ? ORDER BY rectime',
+                    (month + '01000000', nextMonthStart(month)), names = names)
+
+    rows = len(monthData['id'])
+    if rows == 0:
+        return None
+
+    # Write into a scratch directory and rename, so a month is all or nothing
+    monthDir = os.path.join(archiveDir, month)
+    tmpDir = monthDir + '.tmp'
+    shutil.rmtree(tmpDir, ignore_errors = True)
+    os.makedirs(tmpDir)
+
+    monthData['id'].astype(np.int64).tofile(os.path.join(tmpDir, 'id.i8'))
+    monthData['rectime'].astype('datetime64[s]').astype(np.int64).tofile(
+        os.path.join(tmpDir, 'rectime.i8'))
+    for colName in FLOAT_COLUMNS:
+        np.ma.getdata(monthData[colName]).astype(np.float64).tofile(
+            os.path.join(tmpDir, colName + '.f8'))
+    for colName in INT_COLUMNS:
+        monthData[colName].astype(np.int64).tofile(os.path.join(tmpDir, colName + '.i8'))
+
+    shutil.rmtree(monthDir, ignore_errors = True)
+    os.rename(tmpDir, monthDir)
+
+    rectimes = tempsLoader.formatRectimes(monthData['rectime'][[0, -1]])
+    return {'rows': rows,
+            'first': str(rectimes[0]),
+            'last': str(rectimes[1]),
+            'firstId': int(monthData['id'].min()),
+            'lastId': int(monthData['id'].max())}
+
+# Function to save archive index atomically
+def writeIndex(archiveDir, index):
+    tmpName = os.path.join(archiveDir, INDEX_FILE + '.tmp')
+    with open(tmpName, 'w') as indexHandle:
+        json.dump(index, indexHandle, indent = 1, sort_keys = True)
+    os.replace(tmpName, os.path.join(archiveDir, INDEX_FILE))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--db',
+                        required = True,
+                        help = 'SQLite database where data is stored')
+    parser.add_argument('-a', '--archive',
+                        required = True,
+                        help = 'Directory for archived months')
+    parser.add_argument('--purge',
+                        action = 'store_true',
+                        help = 'Delete archived rows from SQLite afterwards')
+    args = parser.parse_args()
+
+    os.makedirs(args.archive, exist_ok = True)
+    reader = ArchiveReader(args.archive)
+    index = reader.index
+
+    tempsDB = sqlite3.connect(args.db)
+    tempsDB.text_factory = str
+
+    # Closed months are every month before the current one (rectime is UTC)
+    thisMonth = datetime.datetime.utcnow().strftime('%Y%m')
+    closedMonths = [row[0] for row in tempsDB.execute(
+                    'SELECT DISTINCT substr(rectime, 1, 6) FROM Temps WHERE rectime < ?',
+                    (thisMonth + '01000000',))]
+
+    for month in closedMonths:
+        if month in index['months']:
+            continue
+        info = archiveMonth(tempsDB, args.archive, month)
+        if info is None:
+            continue
+        index['months'][month] = info
+        writeIndex(args.archive, index)
+        print('Archived {}: {} rows'.format(month, info['rows']))
+
+    if args.purge:
+        # Delete by archived id so rows that arrived after archiving stay put.
+        # In Readings the id is the key itself.
+        deleteSql = 'DELETE FROM Temps WHERE id = ?'
+        if tempsLoader.readingsSchema(tempsDB):
+            deleteSql = 'DELETE FROM Readings WHERE rectime = ?'
+        for month in reader.months():
+            archivedIds = reader.openMonth(month)['id']
+            deleted = tempsDB.executemany(deleteSql,
+                                          ((int(rowId),) for rowId in archivedIds)).rowcount
+            tempsDB.commit()
+            if deleted > 0:
+                print('Purged {}: {} rows'.format(month, deleted))
+
+    tempsDB.close()
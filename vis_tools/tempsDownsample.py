@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+'''
+Program:      tempsDownsample.py
+Author:       Jeff VanSickle
+Created:      20261017
+Modified:     20261017
+
+Module thins out long series before they go to Plotly. A browser can't show
+more points than the chart has pixels, so a month of three-minute readings
+only makes the HTML bigger and slower to render.
+
+Two methods:
+
+    lttb    Largest-Triangle-Three-Buckets (Sveinn Steinarsson, 2013). Keeps
+            the point in each bucket that makes the biggest triangle with
+            its neighbors, so the shape of the line survives.
+    minmax  Keeps the lowest and highest point in each bucket.
+
+Both keep error readings (999.99) visible: lttb always picks an error
+reading if its bucket has one, and minmax keeps it as the bucket maximum.
+
+Requires NumPy.
+
+Downsampling paper:
+http://skemman.is/stream/get/1946/15343/37285/3/SS_MSthesis.pdf
+'''
+
+import numpy as np
+from tempsLoader import ERR_READING
+
+
+def toSeconds(xVals):
+    ''' X values may be datetimes; LTTB needs plain numbers '''
+
+    xVals = np.asarray(xVals)
+    if xVals.dtype.kind in 'MO':
+        return xVals.astype('datetime64[ms]').astype(np.float64) / 1000.0
+    return xVals.astype(np.float64)
+
+def lttbIndexes(xs, ys, threshold, errReading = ERR_READING):
+    ''' Return indexes of points LTTB keeps, in order '''
+
+    numPoints = len(ys)
+    if threshold >= numPoints or threshold < 3:
+        return np.arange(numPoints)
+
+    every = (numPoints - 2) / (threshold - 2)
+    keep = np.empty(threshold, dtype = np.int64)
+    keep[0] = 0
+    keep[-1] = numPoints - 1
+    prevIdx = 0
+
+    for bucket in range(threshold - 2):
+        # Average of the next bucket is the triangle's third corner
+        nextStart = int((bucket + 1) * every) + 1
+        nextEnd = min(int((bucket + 2) * every) + 1, numPoints)
+        avgX = xs[nextStart:nextEnd].mean()
+        avgY = ys[nextStart:nextEnd].mean()
+
+        bucketStart = int(bucket * every) + 1
+        bucketEnd = int((bucket + 1) * every) + 1
+        bucketY = ys[bucketStart:bucketEnd]
+
+        # Error readings always win so outages show on the graph
+        errIdx = np.flatnonzero(bucketY >= errReading)
+        if errIdx.size:
+            chosen = bucketStart + errIdx[0]
+        else:
+            prevX = xs[prevIdx]
+            prevY = ys[prevIdx]
+            areas = np.abs((prevX - avgX) * (bucketY - prevY) -
+                           (prevX - xs[bucketStart:bucketEnd]) * (avgY - prevY))
+            chosen = bucketStart + int(areas.argmax())
+
+        keep[bucket + 1] = chosen
+        prevIdx = chosen
+
+    return keep
+
+def minMaxIndexes(ys, threshold):
+    ''' Return indexes of min and max point in each of threshold/2 buckets '''
+
+    numPoints = len(ys)
+    if threshold >= numPoints or threshold < 2:
+        return np.arange(numPoints)
+
+    numBuckets = threshold // 2
+    edges = np.linspace(0, numPoints, numBuckets + 1).astype(np.int64)
+    keep = []
+
+    for bucketStart, bucketEnd in zip(edges[:-1], edges[1:]):
+        if bucketStart >= bucketEnd:
+            continue
+        bucketY = ys[bucketStart:bucketEnd]
+        lowIdx = bucketStart + int(bucketY.argmin())
+        highIdx = bucketStart + int(bucketY.argmax())
+        keep.extend(sorted(set([lowIdx, highIdx])))
+
+    return np.array(keep, dtype = np.int64)
+
+def downsampleTrace(xVals, yVals, maxPoints, method = 'lttb'):
+    '''
+    Return (xVals, yVals) arrays cut down to about maxPoints points. yVals
+    may be a masked array from tempsLoader; error readings keep their raw
+    999.99 value so they still plot. Points with no value (NaN/None) are
+    dropped first. method is 'lttb', 'minmax' or 'none'.
+    '''
+
+    ys = np.array(np.ma.getdata(yVals), dtype = np.float64)
+    valid = ~np.isnan(ys)
+    xs = np.asarray(xVals)[valid]
+    ys = ys[valid]
+
+    if method == 'none' or len(ys) <= maxPoints:
+        return xs, ys
+
+    if method == 'minmax':
+        keep = minMaxIndexes(ys, maxPoints)
+    else:
+        keep = lttbIndexes(toSeconds(xs), ys, maxPoints)
+
+    return xs[keep], ys[keep]
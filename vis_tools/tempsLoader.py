@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+
+'''
+Program:      tempsLoader.py
+Author:       Jeff VanSickle
+Created:      20261017
+Modified:     20261017
+
+Module loads readings from the Temps table (or a rollup table) into NumPy
+arrays for the visualization tools. Rows come out of SQLite in chunks with
+fetchmany() and each column lands in one array:
+
+    rectime     datetime64[s], parsed from YYYYMMDDHHMMSS text in one pass,
+                or from epoch seconds (the Readings table)
+    id          int64
+    outlier_flags
+                int64 bitmask (streamStats.py); NULL is 0
+    anything    float64 masked array; error readings (999.99) are masked,
+    else        missing values (NULL) are NaN and masked
+
+Months moved out of SQLite by tempsArchive.py can be joined back on with
+combineColumns(). sliceColumns() cuts a time range out of loaded columns
+with a binary search, so one load can feed graphs of several timeframes.
+
+A year of three-minute readings is ~175k rows. As arrays that is a few MB;
+as per-row Python datetimes and strings it was many times that.
+
+DBs migrated by migrateSchema.py (readingsSchema() is True) keep readings in
+the Readings table, keyed on integer epoch seconds. Range queries should go
+there with bounds from rectimeToEpoch(); the Temps view still works but
+can't use the key for rectime ranges.
+
+The constants the visualization tools share live here too, mirroring
+tempsCommon.py on the collector side. selectColumns() reads columns an older
+DB doesn't have (outlier_flags) as 0.
+
+INSTRUCTIONS:
+    - Requires NumPy
+'''
+
+import calendar
+import numpy as np
+
+ERR_READING = 999.99
+MEAN_LIMIT = 150.00     # Sanity limit on temps_mean for graphs and rollups
+CHUNK_SIZE = 10000
+
+# PRAGMA user_version from which readings live in Readings (migrateSchema.py)
+READINGS_VERSION = 1
+
+# Smallest YYYYMMDDHHMMSS value; anything below is epoch seconds
+MIN_RECTIME = 10 ** 13
+
+# Columns the graphs use, in the order the tools expect them
+READ_COLUMNS = ['dsapi_read', 'owm_read', 'w2_read', 'wg_read', 'ds18b20_read',
+                'temps_mean']
+
+# Rollup tables (see tempsRollup.py, tempsRetention.py) and length of
+# rectime prefix in bucket
+ROLLUP_TABLES = {'15m': ('Temps15m', 12),
+                 'hourly': ('TempsHourly', 10),
+                 'daily': ('TempsDaily', 8)}
+
+TSV_HEADER = "date\tDark Sky API\tOpenWeatherMap\tWeather2\tWunderground\tHome\tMean\n"
+
+
+def selectColumns(conn, table, names):
+    ''' Select list for names from table; columns it doesn't have read as 0 '''
+
+    tableCols = [row[1] for row in conn.execute('PRAGMA table_info({})'.format(table))]
+    return ', '.join(name if name in tableCols else '0' for name in names)
+
+
+def readingsSchema(conn):
+    ''' True if readings are in the epoch-keyed Readings table '''
+
+    return conn.execute('PRAGMA user_version').fetchone()[0] >= READINGS_VERSION
+
+def rectimeToEpoch(rectimeStr):
+    '''
+    Epoch seconds for a YYYYMMDDHHMMSS string. Fields out of range are
+    pulled in, so bounds padded with 0s or 9s ('20260000000000',
+    '20269999999999') give the start and end of the year.
+    '''
+
+    fields = [int(rectimeStr[pos:pos + width]) for pos, width in
+              [(0, 4), (4, 2), (6, 2), (8, 2), (10, 2), (12, 2)]]
+    year = max(fields[0], 1)
+    month = min(max(fields[1], 1), 12)
+    day = min(max(fields[2], 1), calendar.monthrange(year, month)[1])
+
+    return calendar.timegm((year, month, day, min(fields[3], 23), min(fields[4], 59),
+                            min(fields[5], 59)))
+
+def parseRectimes(rectimes):
+    '''
+    Turn YYYYMMDDHHMMSS strings (or integers), or epoch seconds, into
+    datetime64[s] array
+    '''
+
+    stamps = np.asarray(rectimes).astype(np.int64)
+    if stamps.size == 0:
+        return np.array([], dtype = 'datetime64[s]')
+    if stamps.max() < MIN_RECTIME:
+        return stamps.astype('datetime64[s]')
+
+    datePart, timePart = np.divmod(stamps, 1000000)
+    yearMon, day = np.divmod(datePart, 100)
+    year, month = np.divmod(yearMon, 100)
+    hours, minSec = np.divmod(timePart, 10000)
+    minutes, seconds = np.divmod(minSec, 100)
+
+    months = ((year - 1970) * 12 + (month - 1)).astype('datetime64[M]')
+    days = months.astype('datetime64[D]') + (day - 1).astype('timedelta64[D]')
+    offsets = (hours * 3600 + minutes * 60 + seconds).astype('timedelta64[s]')
+
+    return days.astype('datetime64[s]') + offsets
+
+def formatRectimes(stamps):
+    ''' Turn datetime64 array back into YYYYMMDDHHMMSS strings '''
+
+    if stamps.size == 0:
+        return np.array([], dtype = 'U14')
+
+    isoStamps = np.datetime_as_string(stamps.astype('datetime64[s]'), unit = 's')
+    for sepChar in ['-', 'T', ':']:
+        isoStamps = np.char.replace(isoStamps, sepChar, '')
+    return isoStamps
+
+def toColumn(name, values):
+    ''' Build the array for one column from a list of Python values '''
+
+    if name == 'rectime':
+        return parseRectimes(values)
+    if name == 'id':
+        return np.array(values, dtype = np.int64)
+    if name == 'outlier_flags':
+        return np.array([value or 0 for value in values], dtype = np.int64)
+
+    return maskReadings(np.array(values, dtype = np.float64))     # None -> NaN
+
+def maskReadings(data):
+    ''' Mask NaN and error readings in a float64 array '''
+
+    return np.ma.masked_array(data, mask = np.isnan(data) | (data >= ERR_READING))
+
+def emptyColumn(name):
+    return toColumn(name, [])
+
+def loadColumns(cursor, names, chunkSize = CHUNK_SIZE):
+    '''
+    Read every row left in cursor. names labels the columns of the query,
+    in order. Returns dict of name -> array.
+    '''
+
+    chunks = {name: [] for name in names}
+
+    while True:
+        rows = cursor.fetchmany(chunkSize)
+        if not rows:
+            break
+        for name, values in zip(names, zip(*rows)):
+            chunks[name].append(toColumn(name, values))
+
+    columns = {}
+    for name in names:
+        if not chunks[name]:
+            columns[name] = emptyColumn(name)
+        elif isinstance(chunks[name][0], np.ma.MaskedArray):
+            columns[name] = np.ma.concatenate(chunks[name])
+        else:
+            columns[name] = np.concatenate(chunks[name])
+
+    return columns
+
+def combineColumns(archived, live, key = 'rectime'):
+    '''
+    Join columns from the archive (see tempsArchive.py) with columns loaded
+    from SQLite. Live rows at or before the newest archived key are dropped,
+    so rows that were archived but not purged aren't counted twice.
+    '''
+
+    if len(archived[key]) and len(live[key]):
+        liveKeep = live[key] > archived[key].max()
+    else:
+        liveKeep = slice(None)
+
+    combined = {}
+    for name in live:
+        if isinstance(live[name], np.ma.MaskedArray):
+            combined[name] = np.ma.concatenate([archived[name], live[name][liveKeep]])
+        else:
+            combined[name] = np.concatenate([archived[name], live[name][liveKeep]])
+
+    return combined
+
+def sortColumns(columns, key = 'rectime'):
+    ''' Put rows in key order if they aren't already '''
+
+    keys = columns[key]
+    if len(keys) < 2 or not (keys[1:] < keys[:-1]).any():
+        return columns
+
+    order = np.argsort(keys, kind = 'stable')
+    return {name: values[order] for name, values in columns.items()}
+
+def sliceColumns(columns, start = None, end = None, includeEnd = True, key = 'rectime'):
+    '''
+    Rows with start <= rectime <= end (or < end if not includeEnd) from
+    columns sorted by rectime. start and end are YYYYMMDDHHMMSS strings;
+    None means no bound. Slices are views, not copies.
+    '''
+
+    keys = columns[key]
+    lowIdx, highIdx = 0, len(keys)
+    if start is not None:
+        lowIdx = np.searchsorted(keys, parseRectimes([start])[0], side = 'left')
+    if end is not None:
+        highIdx = np.searchsorted(keys, parseRectimes([end])[0],
+                                  side = 'right' if includeEnd else 'left')
+
+    keep = slice(lowIdx, max(lowIdx, highIdx))
+    return {name: values[keep] for name, values in columns.items()}
+
+def loadTemps(conn, query, params = (), names = None, chunkSize = CHUNK_SIZE):
+    '''
+    Run query on conn and load result. By default the query must return
+    rectime followed by READ_COLUMNS.
+    '''
+
+    if names is None:
+        names = ['rectime'] + READ_COLUMNS
+
+    cursor = conn.cursor()
+    cursor.execute(query, params)
+    columns = loadColumns(cursor, names, chunkSize)
+    cursor.close()
+
+    return columns
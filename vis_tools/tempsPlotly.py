@@ -4,7 +4,7 @@
 Program:      tempsPlotly.py
 Author:       Jeff VanSickle
 Created:      20160811
-Modified:     20170130
+Modified:     20261017
 
 Program creates visualization of temperature data using tempsDB.sqlite as
 source. Visualization created using Plotly, cribbed from examples that were
@@ -25,10 +25,29 @@ UPDATES:
                   Add parameter for graph output directory, pass to 
                   buildDBQuery
                   Concatenate output path intelligently with os.path.join()
+    20261017 JV - Read weekly, monthly and all-time graphs from the hourly
+                  and daily rollup tables (see tempsRollup.py); add
+                  --resolution to pick the table by hand
+                  Add 'all' timeframe option; fix -d/-o option names
+                  Convert print statements to Python 3
+                  Downsample each trace to --max-points before plotting
+                  (see tempsDownsample.py)
+                  Load readings into NumPy arrays with tempsLoader.py in
+                  place of per-row lists and castToDatetime()
+                  Add --archive to include months moved out of SQLite by
+                  tempsArchive.py in raw graphs
+                  Add '-t multi': daily, weekly, monthly and currmonth
+                  graphs from one load per resolution, sliced in memory.
+                  Pages share one copy of plotly.js and load their data
+                  from a JSON file beside the HTML
+                  Read raw readings from the Readings table, with integer
+                  time bounds, in DBs moved over by migrateSchema.py
 
 INSTRUCTIONS:
     - Replace instances of '<YOUR...>' with information for your system
     - Ensure you can access the location of your SQLite DB
+    - '-t multi' pages fetch their JSON, which browsers won't do from
+      file:// URLs; serve the output directory (e.g. python3 -m http.server)
 
 TO DO:
     - Revisit PEP8. These conventions are inconsistent.
@@ -42,16 +61,12 @@ import calendar
 import plotly as py
 import plotly.graph_objs as go
 import argparse
+import json
 import os
-
-# Function to process leading zeroes
-def trimLeadZero(strIn):
-    if strIn >= '10':
-        return strIn
-    elif strIn == '00':
-        return '0'
-    else:
-        return strIn.lstrip('0')
+import plotly.io as pio
+import tempsDownsample
+import tempsLoader
+import tempsArchive
 
 # Function to create plot trace objects
 def createPlotTrace(scatterXVal, scatterYVal, traceName):
@@ -66,159 +81,307 @@ def createPlotTrace(scatterXVal, scatterYVal, traceName):
 
     return plotTrace
 
-# Function to build time-based query to SQLite DB
-def buildDBQuery(timeIn, baseOutDir):
+# Coarsest table that still gives a useful graph for each timeframe
+AUTO_RESOLUTION = {'daily': 'raw',
+                   'weekly': 'hourly',
+                   'monthly': 'hourly',
+                   'currmonth': 'hourly',
+                   'all': 'daily'}
+
+# Function to work out time range and output file for a timeframe
+def timeframeBounds(timeIn, baseOutDir):
     timeframe = timeIn.lower()
-    baseQuery = 'SELECT * FROM Temps WHERE temps_mean < 150.00 '
 
     # Build time constraint for target values
     timeNow = datetime.datetime.now()
     todayStart = timeNow.strftime('%Y%m%d000000')
     todayEnd = timeNow.strftime('%Y%m%d235959')
 
+    # Lower bound is inclusive; upper bound inclusive unless endOp says not
+    startStr = None
+    endStr = None
+    endOp = '<='
+
     if timeframe == 'all':
-        dbQuery = baseQuery
         outFName = os.path.join(baseOutDir, 'tempsPlotly_All.html')
     elif timeframe == 'daily':
         # Get all readings for current day
         tomLong = timeNow + datetime.timedelta(days = 1)
-        tomShort = tomLong.strftime('%Y%m%d000000')
-        dbQuery = baseQuery + 'AND rectime >= ' + todayStart + \
-                  ' AND rectime < ' + tomShort
+        startStr = todayStart
+        endStr = tomLong.strftime('%Y%m%d000000')
+        endOp = '<'
         outFName = os.path.join(baseOutDir, 'tempsPlotly_Day.html')
     elif timeframe == 'weekly':
         # Get all readings for last week up to end of current day
         lastWkLong = timeNow + datetime.timedelta(days = -7)
-        lastWkShort = lastWkLong.strftime('%Y%m%d000000')
-        dbQuery = baseQuery + 'AND rectime >= ' + lastWkShort + \
-                  ' AND rectime <= ' + todayEnd
+        startStr = lastWkLong.strftime('%Y%m%d000000')
+        endStr = todayEnd
         outFName = os.path.join(baseOutDir, 'tempsPlotly_Week.html')
     elif timeframe == 'monthly':
         # Get all readings one month back (i.e., 08/20 back to 07/20), up to 
         # end of current day 
         lastMonLong = timeNow + datetime.timedelta(days = \
                       calendar.monthrange(timeNow.year, timeNow.month)[1] * -1)
-        lastMonShort = lastMonLong.strftime('%Y%m%d000000')
-        dbQuery = baseQuery + 'AND rectime >= ' + lastMonShort + \
-                  ' AND rectime <= ' + todayEnd
+        startStr = lastMonLong.strftime('%Y%m%d000000')
+        endStr = todayEnd
         outFName = os.path.join(baseOutDir, 'tempsPlotly_Month.html')
     elif timeframe == 'currmonth':
         # Get all readings for current calendar month (i.e., August 2016)
         startOfMonth = timeNow.replace(day = 1)
-        startMonStr = startOfMonth.strftime('%Y%m%d000000')
+        startStr = startOfMonth.strftime('%Y%m%d000000')
         endOfMonth = timeNow.replace(day = calendar.monthrange(timeNow.year, \
                      timeNow.month)[1])
-        endMonStr = endOfMonth.strftime('%Y%m%d235959')
-        dbQuery = baseQuery + 'AND rectime >= ' + startMonStr + \
-                  ' AND rectime <= ' + endMonStr
-        outFName = os.path.join('tempsPlotly_currMonth.html')
+        endStr = endOfMonth.strftime('%Y%m%d235959')
+        outFName = os.path.join(baseOutDir, 'tempsPlotly_currMonth.html')
+
+    return startStr, endStr, endOp, outFName
+
+# Function to build time-based query to SQLite DB
+def buildDBQuery(timeIn, baseOutDir, resolution = 'raw'):
+    timeframe = timeIn.lower()
+    if resolution == 'auto':
+        resolution = AUTO_RESOLUTION[timeframe]
+
+    startStr, endStr, endOp, outFName = timeframeBounds(timeframe, baseOutDir)
+
+    return rangeQuery(startStr, endStr, endOp, resolution), outFName
+
+# Function to build query for a time range (None bounds mean all readings);
+# with readings, raw rows come from the epoch-keyed Readings table
+def rangeQuery(startStr, endStr, endOp, resolution = 'raw', readings = False):
+    if resolution == 'raw':
+        dbQuery = 'SELECT rectime, dsapi_read, owm_read, w2_read, wg_read, ' + \
+                  'ds18b20_read, temps_mean FROM {} WHERE temps_mean < {} '.format(
+                  'Readings' if readings else 'Temps', tempsLoader.MEAN_LIMIT)
+        timeCol = 'rectime'
+    else:
+        # One row per bucket, sources pivoted into columns; pad bucket back
+        # out to a full timestamp for the loader
+        rollupTable, width = tempsLoader.ROLLUP_TABLES[resolution]
+        pivotCols = ', '.join(["MAX(CASE WHEN source = '{}' THEN mean_read END)".format(src)
+                               for src in ['dsapi', 'owm', 'w2', 'wg', 'ds18b20', 'mean']])
+        dbQuery = "SELECT bucket || '{}', {} FROM {} WHERE 1 ".format(
+                  '0' * (14 - width), pivotCols, rollupTable)
+        timeCol = 'bucket'
+        if startStr is not None:
+            startStr = startStr[:width]
+            endStr = endStr[:width]
+
+    if startStr is not None:
+        if resolution == 'raw' and readings:
+            startVal = tempsLoader.rectimeToEpoch(startStr)
+            endVal = tempsLoader.rectimeToEpoch(endStr)
+        else:
+            startVal = "'{}'".format(startStr)
+            endVal = "'{}'".format(endStr)
+        dbQuery += "AND {0} >= {1} AND {0} {2} {3}".format(timeCol,
+                   startVal, endOp, endVal)
+
+    if resolution != 'raw':
+        dbQuery += ' GROUP BY bucket ORDER BY bucket'
+
+    return dbQuery
+
+# Timeframes drawn by '-t multi'
+MULTI_TIMEFRAMES = ['daily', 'weekly', 'monthly', 'currmonth']
+
+# Function to load readings for a time range; returns (columns, resolution)
+def loadRange(tempsDB, startStr, endStr, endOp, resolution):
+    try:
+        tempsData = tempsLoader.loadTemps(tempsDB, rangeQuery(startStr, endStr,
+                    endOp, resolution, useReadings))
+    except sqlite3.OperationalError:
+        # No rollup tables yet (run tempsRollup.py --rebuild); use raw readings
+        tempsData = tempsLoader.loadTemps(tempsDB, rangeQuery(startStr, endStr,
+                    endOp, 'raw', useReadings))
+        resolution = 'raw'
+
+    # Archived months only hold raw readings; rollups already cover them
+    if archiveDir is not None and resolution == 'raw':
+        archivedData = tempsArchive.ArchiveReader(archiveDir).loadRange(startStr,
+                       endStr, includeEnd = (endOp == '<='))
+        tempsData = tempsLoader.combineColumns(archivedData, tempsData)
+
+    return tempsData, resolution
 
-    return dbQuery, outFName
+# Function to build the graph for one set of readings
+def buildFigure(tempsData):
+    timestamps = tempsData['rectime']
 
-# Function to format datestamps for Plotly
-def castToDatetime(dateStr):
-    year = dateStr[0:4]
-    month = trimLeadZero(str(dateStr[4:6]))
-    day = trimLeadZero(str(dateStr[6:8]))
-    hours = trimLeadZero(str(dateStr[8:10]))
-    minutes = trimLeadZero(str(dateStr[10:12]))
-    seconds = trimLeadZero(str(dateStr[12:14]))
+    # Scatter plot axis and title labels
+    graphTitle = 'Local and API Temperature Readings'
+    xAxisTitle = 'Timestamp'
+    yAxisTitle = 'Temperature (F)'
 
-    return datetime.datetime(int(year), int(month), int(day), int(hours),
-            int(minutes), int(seconds))
+    # Create traces for each reading, thinned out to the point budget
+    def createThinTrace(scatterYVal, traceName):
+        thinX, thinY = tempsDownsample.downsampleTrace(timestamps, scatterYVal,
+                       maxPoints, downsampleMethod)
+        return createPlotTrace(thinX, thinY, traceName)
+
+    DSAPI_trace = createThinTrace(tempsData['dsapi_read'], 'Dark Sky API')
+    OWM_trace = createThinTrace(tempsData['owm_read'], 'OpenWeatherMap')
+    W2_trace = createThinTrace(tempsData['w2_read'], 'Weather2')
+    WG_trace = createThinTrace(tempsData['wg_read'], 'Wunderground')
+    DS18B20_trace = createThinTrace(tempsData['ds18b20_read'], 'RasPi_DS18B20')
+    temps_means_trace = createThinTrace(tempsData['temps_mean'], "Mean")
+
+    # Set data for graph
+    tempsGraphData = [DSAPI_trace, OWM_trace, W2_trace, WG_trace, DS18B20_trace,
+                      temps_means_trace]
+
+    # Define layout for graph
+    tempsGraphLayout = go.Layout(
+            showlegend = True,
+            title = graphTitle,
+            xaxis = dict(title = xAxisTitle),
+            yaxis = dict(title = yAxisTitle)
+            )
+
+    return go.Figure(data = tempsGraphData, layout = tempsGraphLayout)
+
+# Function to replace a file in one step, so a reader never sees half of it
+def writeAtomic(fileName, text):
+    tmpName = fileName + '.tmp'
+    with open(tmpName, 'w') as outHandle:
+        outHandle.write(text)
+    os.replace(tmpName, fileName)
+
+# Function to write shared plotly.js once per version; returns its file name
+def writePlotlyJs(baseOutDir):
+    jsName = 'plotly-{}.min.js'.format(py.offline.get_plotlyjs_version())
+    jsFile = os.path.join(baseOutDir, jsName)
+    if not os.path.isfile(jsFile):
+        writeAtomic(jsFile, py.offline.get_plotlyjs())
+    return jsName
+
+PAGE_TEMPLATE = '''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<script src="{plotlyJs}"></script>
+</head>
+<body>
+<div id="graph" style="width:100%;height:95vh;"></div>
+<script>
+fetch("{dataFile}", {{cache: "no-cache"}})
+  .then(function(resp) {{ return resp.json(); }})
+  .then(function(fig) {{
+    Plotly.newPlot("graph", fig.data, fig.layout, {{responsive: true}});
+  }});
+</script>
+</body>
+</html>
+'''
+
+# Function to write a graph as small HTML page plus JSON data file
+def writePage(tempsGraphFig, htmlFile, jsName):
+    dataFile = os.path.splitext(htmlFile)[0] + '.json'
+    writeAtomic(dataFile, pio.to_json(tempsGraphFig, validate = False, pretty = False))
+
+    # Page never changes between runs; leave it alone unless it would
+    pageText = PAGE_TEMPLATE.format(title = os.path.basename(htmlFile),
+               plotlyJs = jsName, dataFile = os.path.basename(dataFile))
+    try:
+        with open(htmlFile, 'r') as pageHandle:
+            if pageHandle.read() == pageText:
+                return
+    except OSError:
+        pass
+    writeAtomic(htmlFile, pageText)
 
 # Get timeframe from CLI args
 parser = argparse.ArgumentParser()
 parser.add_argument('-t', '--timeframe', 
-                    choices = ['daily', 'weekly', 'monthly', 'currmonth'], 
+                    choices = ['daily', 'weekly', 'monthly', 'currmonth', 'all', 'multi'],
                     required = True,
-                    help = 'Timeframe to graph (day, week, month, current month)')
-parser.add_argument('-d' '--db',
+                    help = 'Timeframe to graph (day, week, month, current month, all, or multi for the first four at once)')
+parser.add_argument('-d', '--db',
                     required = True,
                     help = 'SQLite database where data is stored')
-parser.add_argument('-o' '--out',
+parser.add_argument('-o', '--out',
                     required = True,
                     help = 'Output directory for your generated graph(s)')
+parser.add_argument('-r', '--resolution',
+                    choices = ['auto', 'raw', 'hourly', 'daily'],
+                    default = 'auto',
+                    help = 'Raw readings or hourly/daily rollups (default auto)')
+parser.add_argument('-m', '--max-points',
+                    type = int,
+                    default = 2000,
+                    help = 'Most points to plot per trace (default 2000)')
+parser.add_argument('--downsample',
+                    choices = ['lttb', 'minmax', 'none'],
+                    default = 'lttb',
+                    help = 'How to cut traces down to --max-points (default lttb)')
+parser.add_argument('-a', '--archive',
+                    default = None,
+                    help = 'Archive directory from tempsArchive.py to include')
 
 # Get arguments - time to parse, DB to use, output location for graphs
 args = parser.parse_args()
 timeToGraph = args.timeframe
+resolution = args.resolution
+if resolution == 'auto' and timeToGraph != 'multi':
+    resolution = AUTO_RESOLUTION[timeToGraph]
+maxPoints = args.max_points
+downsampleMethod = args.downsample
+archiveDir = args.archive
 db_loc = args.db
 out_dir = args.out
 
 # Test existence of specified locations
 if not os.path.isfile(db_loc):
-    print 'SQLite DB {} does not exist. Exiting....'.format(db_loc)
+    print('SQLite DB {} does not exist. Exiting....'.format(db_loc))
     quit()
 elif not os.path.isdir(out_dir):
-    print 'Path {} does not exist. Exiting....'.format(out_dir)
+    print('Path {} does not exist. Exiting....'.format(out_dir))
     quit()
 
 # Connect to SQLite DB
 try:
     tempsDB = sqlite3.connect(db_loc)
     tempsDB.text_factory = str
-    cursor = tempsDB.cursor()
 except:
-    print 'Unable to open database. Please try again. Exiting....'
+    print('Unable to open database. Please try again. Exiting....')
     quit()
 
-# Lists to hold readings from each source
-timestamps = []
-DSAPI_reads = []
-OWM_reads = []
-W2_reads = []
-WG_reads = []
-DS18B20_reads = []
-temps_means = []
+# Migrated DBs keep raw readings in Readings (see migrateSchema.py)
+useReadings = tempsLoader.readingsSchema(tempsDB)
 
-# Get data from DB
-try:
-    queryInput, graphOutFile = buildDBQuery(timeToGraph, out_dir)
-    cursor.execute(queryInput)
-except:
-    queryInput = 'SELECT * FROM Temps WHERE temps_mean < 150.00'
-    graphOutFile = '/tmp/plotly_all.html'     # <YOUR_DEFAULT_OUTPUT_FILE>
-    cursor.execute(queryInput)
-
-# Start building array data
-for msg_row in cursor:
-    timestamps.append(castToDatetime(msg_row[1]))
-    DSAPI_reads.append(str(msg_row[2]))
-    OWM_reads.append(str(msg_row[3]))
-    W2_reads.append(str(msg_row[4]))
-    WG_reads.append(str(msg_row[5]))
-    DS18B20_reads.append(str(msg_row[6]))
-    temps_means.append(str(msg_row[7]))
+if timeToGraph == 'multi':
+    # Each resolution is loaded once over the widest window that uses it,
+    # then every timeframe slices its rows out of that
+    allBounds = {timeframe: timeframeBounds(timeframe, out_dir) for timeframe in MULTI_TIMEFRAMES}
+    resGroups = {}
+    for timeframe in MULTI_TIMEFRAMES:
+        groupRes = AUTO_RESOLUTION[timeframe] if resolution == 'auto' else resolution
+        resGroups.setdefault(groupRes, []).append(timeframe)
+
+    jsName = writePlotlyJs(out_dir)
+    for groupRes, timeframes in resGroups.items():
+        startStr = min(allBounds[timeframe][0] for timeframe in timeframes)
+        endStr = max(allBounds[timeframe][1] for timeframe in timeframes)
+        groupData, _ = loadRange(tempsDB, startStr, endStr, '<=', groupRes)
+        groupData = tempsLoader.sortColumns(groupData)
+
+        for timeframe in timeframes:
+            startStr, endStr, endOp, graphOutFile = allBounds[timeframe]
+            frameData = tempsLoader.sliceColumns(groupData, startStr, endStr,
+                        includeEnd = (endOp == '<='))
+            writePage(buildFigure(frameData), graphOutFile, jsName)
+            print('Wrote {} ({} rows)'.format(graphOutFile, len(frameData['rectime'])))
+
+    tempsDB.close()
+    quit()
+
+# Get data from DB into arrays, one per column
+startStr, endStr, endOp, graphOutFile = timeframeBounds(timeToGraph, out_dir)
+tempsData, resolution = loadRange(tempsDB, startStr, endStr, endOp, resolution)
 
 # Clean up DB connection
 tempsDB.close()
 
-# Scatter plot axis and title labels
-graphTitle = 'Local and API Temperature Readings'
-xAxisTitle = 'Timestamp'
-yAxisTitle = 'Temperature (F)'
-
-# Create traces for each reading
-DSAPI_trace = createPlotTrace(timestamps, DSAPI_reads, 'Dark Sky API')
-OWM_trace = createPlotTrace(timestamps, OWM_reads, 'OpenWeatherMap')
-W2_trace = createPlotTrace(timestamps, W2_reads, 'Weather2')
-WG_trace = createPlotTrace(timestamps, WG_reads, 'Wunderground')
-DS18B20_trace = createPlotTrace(timestamps, DS18B20_reads, 'RasPi_DS18B20')
-temps_means_trace = createPlotTrace(timestamps, temps_means, "Mean")
-
-# Set data for graph
-tempsGraphData = [DSAPI_trace, OWM_trace, W2_trace, WG_trace, DS18B20_trace,
-                  temps_means_trace]
-
-# Define layout for graph
-tempsGraphLayout = go.Layout(
-        showlegend = True,
-        title = graphTitle,
-        xaxis = dict(title = xAxisTitle),
-        yaxis = dict(title = yAxisTitle)
-        )
-
 # Generate graph
-tempsGraphFig = go.Figure(data = tempsGraphData, layout = tempsGraphLayout)
-py.offline.plot(tempsGraphFig, filename = graphOutFile)
+py.offline.plot(buildFigure(tempsData), filename = graphOutFile)
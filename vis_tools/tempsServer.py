@@ -0,0 +1,459 @@
+#!/usr/bin/env python3
+
+'''
+Program:      tempsServer.py
+Author:       Jeff VanSickle
+Created:      20261017
+Modified:     20261017
+
+Program serves readings from the Temps table (and the rollups from
+tempsRollup.py) as JSON over HTTP, so a dashboard can poll for what it
+needs instead of someone rebuilding HTML or TSV files by hand.
+
+Endpoints, all GET:
+
+    /range      Readings between two times, one array per source:
+                {"resolution": "raw", "rectime": [...], "dsapi": [...], ...}
+                Error readings (999.99) come back as null.
+    /aggregate  Count, errors, min, max and mean per source over a range
+    /latest     Newest reading
+
+/range and /aggregate take either start= and end= (rectime prefixes,
+YYYYMMDD[HH[MM[SS]]], both inclusive, UTC like rectime) or hours= for the
+last N hours; with neither they cover the last 24 hours. /range also takes
+resolution= (raw, 15m, hourly, daily or auto; auto picks from the length of
+the range; 15m is the Temps15m tier tempsRetention.py keeps once raw rows
+age out) and format=tsv for the data.tsv layout tempsVis.py writes, which
+d3Vis.html can load straight from the server.
+
+Queries run on a small pool of read-only connections. collectTemp.py puts
+the DB in WAL mode, so a long read doesn't hold up the collector's commit;
+a DB still in the default rollback journal (one the collector hasn't
+opened since) blocks the collector for as long as a read runs. Responses
+are cached by path and query string, with hours= turned into a start time
+to the minute when the request comes in. The cache is emptied when the oldest or newest
+reading changes, i.e. when new readings have landed or a retention run has
+removed old ones. PRAGMA data_version is checked first, so the readings are
+only looked at after another connection has committed; commits that don't
+touch readings (API cache, outbox, scheduler state, SensorReads) leave the
+cache alone. Rewrites that keep the same readings, like backfillStats.py or
+importTemps.py filling a gap, show up with the next reading. Every response
+carries an ETag; a browser sending it back in If-None-Match gets a 304 with
+no body until the data changes.
+
+DBs moved over by migrateSchema.py are read from the Readings table, keyed
+on epoch seconds; rectime still comes back as YYYYMMDDHHMMSS text.
+
+INSTRUCTIONS:
+    tempsServer.py -d <SQLITE_DB> [-p 8080] [--host 127.0.0.1]
+    curl 'http://127.0.0.1:8080/range?hours=48&resolution=hourly'
+'''
+
+import os
+import json
+import queue
+import sqlite3
+import hashlib
+import argparse
+import datetime
+import threading
+import collections
+import http.server
+import urllib.parse
+from contextlib import contextmanager
+import tempsLoader
+from tempsLoader import ERR_READING, MEAN_LIMIT, ROLLUP_TABLES, TSV_HEADER
+
+# Source name -> Temps column, in data.tsv column order
+SOURCE_COLUMNS = collections.OrderedDict([('dsapi', 'dsapi_read'),
+                                          ('owm', 'owm_read'),
+                                          ('w2', 'w2_read'),
+                                          ('wg', 'wg_read'),
+                                          ('ds18b20', 'ds18b20_read'),
+                                          ('mean', 'temps_mean')])
+
+# Longest range, in days, that auto resolution serves at each resolution
+AUTO_LIMITS = [(2, 'raw'), (62, 'hourly')]
+
+DEFAULT_HOURS = 24
+MAX_HOURS = 24 * 366 * 100     # Anything longer is a mistake, not a range
+
+
+class ReadPool:
+    ''' Fixed set of read-only connections shared by the request threads '''
+
+    def __init__(self, dbPath, size = 4):
+        self.uri = 'file:{}?mode=ro'.format(urllib.parse.quote(os.path.abspath(dbPath)))
+        self.idle = queue.Queue()
+        for _ in range(size):
+            self.idle.put(self.connect())
+
+        # Never written through, so its data_version only moves when
+        # another connection commits
+        self.watchConn = self.connect()
+        self.watchLock = threading.Lock()
+        self.version = None
+        self.marker = None
+
+    def connect(self):
+        conn = sqlite3.connect(self.uri, uri = True, check_same_thread = False)
+        conn.execute('PRAGMA query_only = ON')
+        return conn
+
+    @contextmanager
+    def connection(self):
+        ''' Borrow a connection; waits if all are busy '''
+
+        conn = self.idle.get()
+        try:
+            yield conn
+        finally:
+            self.idle.put(conn)
+
+    def dataMarker(self):
+        ''' Changes when readings are added or removed '''
+
+        with self.watchLock:
+            version = self.watchConn.execute('PRAGMA data_version').fetchone()[0]
+            if version != self.version:
+                self.version = version
+                self.marker = self.readMarker()
+            return self.marker
+
+    def readMarker(self):
+        ''' Oldest and newest raw rectime; both come straight off the rectime index '''
+
+        try:
+            rawTable = 'Readings' if tempsLoader.readingsSchema(self.watchConn) else 'Temps'
+            return self.watchConn.execute('SELECT MIN(rectime), MAX(rectime) FROM {}'.format(
+                                          rawTable)).fetchone()
+        except sqlite3.Error:
+            return ('version', self.version)     # No readings table yet
+
+    def close(self):
+        while not self.idle.empty():
+            self.idle.get().close()
+        self.watchConn.close()
+
+
+class QueryCache:
+    ''' LRU cache of finished responses, emptied when the data marker moves '''
+
+    def __init__(self, maxEntries = 256):
+        self.maxEntries = maxEntries
+        self.entries = collections.OrderedDict()
+        self.marker = None
+        self.lock = threading.Lock()
+
+    def get(self, key, marker):
+        with self.lock:
+            if marker != self.marker:
+                self.entries.clear()
+                self.marker = marker
+                return None
+
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, marker, entry):
+        with self.lock:
+            # Data moved on while the query ran; next request redoes it
+            if marker != self.marker:
+                return
+            self.entries[key] = entry
+            while len(self.entries) > self.maxEntries:
+                self.entries.popitem(last = False)
+
+
+# Function to pin an hours= window (or the default one) to a start time, so
+# a cached answer doesn't keep the window of an earlier request
+def pinRange(params):
+    if 'start' in params or 'end' in params:
+        return params
+
+    startStr, endStr = parseRange(params)
+    pinned = dict(params)
+    pinned.pop('hours', None)
+    pinned['start'] = startStr[:12]     # To the minute, so requests can share answers
+    return pinned
+
+# Function to turn query string into inclusive rectime bounds
+def parseRange(params):
+    if 'start' in params or 'end' in params:
+        startStr = params.get('start', '')
+        endStr = params.get('end', '')
+        for bound in [startStr, endStr]:
+            if not bound.isdigit() and bound != '':
+                raise ValueError('start and end must be YYYYMMDD[HH[MM[SS]]]')
+        return startStr.ljust(14, '0'), endStr.ljust(14, '9')
+
+    try:
+        hours = float(params.get('hours', DEFAULT_HOURS))
+    except ValueError:
+        raise ValueError('hours must be a number')
+    if not 0 < hours <= MAX_HOURS:      # Also false for nan
+        raise ValueError('hours must be more than 0 and at most {}'.format(MAX_HOURS))
+
+    timeNow = datetime.datetime.utcnow()
+    startStr = (timeNow - datetime.timedelta(hours = hours)).strftime('%Y%m%d%H%M%S')
+    return startStr, '9' * 14
+
+# Function to pick resolution for a range when asked for auto
+def autoResolution(startStr, endStr):
+    try:
+        start = datetime.datetime.strptime(startStr, '%Y%m%d%H%M%S')
+    except ValueError:
+        return 'daily'      # Open-ended start: everything
+    try:
+        end = datetime.datetime.strptime(endStr, '%Y%m%d%H%M%S')
+    except ValueError:
+        end = datetime.datetime.utcnow()
+
+    spanDays = (end - start).total_seconds() / 86400
+    for limitDays, resolution in AUTO_LIMITS:
+        if spanDays <= limitDays:
+            return resolution
+    return 'daily'
+
+def cleanReading(source, value):
+    ''' Error and missing readings go out as null '''
+
+    limit = MEAN_LIMIT if source == 'mean' else ERR_READING
+    if value is None or value >= limit:
+        return None
+    return round(value, 2)      # Rollup means carry full precision
+
+# Function to give raw readings' table, rectime-as-text SQL and bounds
+def rawSource(conn, startStr, endStr):
+    if tempsLoader.readingsSchema(conn):
+        # Epoch-keyed table from migrateSchema.py
+        return 'Readings', "strftime('%Y%m%d%H%M%S', {}, 'unixepoch')", \
+               (tempsLoader.rectimeToEpoch(startStr), tempsLoader.rectimeToEpoch(endStr))
+    return 'Temps', '{}', (startStr, endStr)
+
+# Function to read rows for a range at a resolution
+def queryRows(conn, startStr, endStr, resolution):
+    if resolution == 'raw':
+        rawTable, asText, bounds = rawSource(conn, startStr, endStr)
+        dbQuery = 'SELECT {}, {} FROM {} WHERE rectime >= ? AND rectime <= ? ' \
+                  'ORDER BY rectime'.format(asText.format('rectime'),
+                  ', '.join(SOURCE_COLUMNS.values()), rawTable)
+        return conn.execute(dbQuery, bounds).fetchall()
+
+    # One row per bucket, sources pivoted into columns; pad bucket back out
+    # to a full timestamp
+    rollupTable, width = ROLLUP_TABLES[resolution]
+    pivotCols = ', '.join(["MAX(CASE WHEN source = '{}' THEN mean_read END)".format(source)
+                           for source in SOURCE_COLUMNS])
+    dbQuery = "SELECT bucket || '{}', {} FROM {} WHERE bucket >= ? AND bucket <= ? " \
+              "GROUP BY bucket ORDER BY bucket".format('0' * (14 - width), pivotCols, rollupTable)
+    return conn.execute(dbQuery, (startStr[:width], endStr[:width])).fetchall()
+
+def rangeResponse(conn, params):
+    startStr, endStr = parseRange(params)
+    resolution = params.get('resolution', 'auto')
+    if resolution == 'auto':
+        resolution = autoResolution(startStr, endStr)
+    elif resolution != 'raw' and resolution not in ROLLUP_TABLES:
+        raise ValueError('resolution must be raw, 15m, hourly, daily or auto')
+
+    try:
+        rows = queryRows(conn, startStr, endStr, resolution)
+    except sqlite3.OperationalError:
+        # No rollup tables yet (run tempsRollup.py --rebuild); use raw readings
+        resolution = 'raw'
+        rows = queryRows(conn, startStr, endStr, resolution)
+
+    if params.get('format') == 'tsv':
+        lines = [TSV_HEADER]
+        lines.extend('\t'.join(str(value) if value is not None else '' for value in row) + '\n'
+                     for row in rows)
+        return ''.join(lines).encode('utf-8'), 'text/tab-separated-values; charset=utf-8'
+
+    columns = list(zip(*rows)) if rows else [()] * (len(SOURCE_COLUMNS) + 1)
+    result = {'resolution': resolution,
+              'start': startStr,
+              'end': endStr,
+              'rectime': list(columns[0])}
+    for source, values in zip(SOURCE_COLUMNS, columns[1:]):
+        result[source] = [cleanReading(source, value) for value in values]
+
+    return jsonBody(result)
+
+def aggregateResponse(conn, params):
+    startStr, endStr = parseRange(params)
+
+    # Everything in one pass over the range
+    rawTable, asText, bounds = rawSource(conn, startStr, endStr)
+    selectCols = ['COUNT(*)', asText.format('MIN(rectime)'), asText.format('MAX(rectime)')]
+    for source, column in SOURCE_COLUMNS.items():
+        goodRead = 'CASE WHEN {} < {} THEN {} END'.format(column,
+                   MEAN_LIMIT if source == 'mean' else ERR_READING, column)
+        selectCols.extend(['COUNT({})'.format(goodRead),
+                           'COUNT({}) - COUNT({})'.format(column, goodRead),
+                           'MIN({})'.format(goodRead),
+                           'MAX({})'.format(goodRead),
+                           'AVG({})'.format(goodRead)])
+
+    row = conn.execute('SELECT {} FROM {} WHERE rectime >= ? AND rectime <= ?'.format(
+                       ', '.join(selectCols), rawTable), bounds).fetchone()
+
+    result = {'start': startStr,
+              'end': endStr,
+              'rows': row[0],
+              'first': row[1],
+              'last': row[2],
+              'sources': {}}
+    for position, source in enumerate(SOURCE_COLUMNS):
+        count, errors, minRead, maxRead, meanRead = row[3 + position * 5:8 + position * 5]
+        result['sources'][source] = {'count': count,
+                                     'errors': errors,
+                                     'min': round(minRead, 2) if minRead is not None else None,
+                                     'max': round(maxRead, 2) if maxRead is not None else None,
+                                     'mean': round(meanRead, 2) if meanRead is not None else None}
+
+    return jsonBody(result)
+
+def latestResponse(conn, params):
+    rawTable, asText, bounds = rawSource(conn, '0' * 14, '9' * 14)
+    row = conn.execute('SELECT {}, {} FROM {} ORDER BY rectime DESC LIMIT 1'.format(
+                       asText.format('rectime'), ', '.join(SOURCE_COLUMNS.values()),
+                       rawTable)).fetchone()
+
+    result = None
+    if row is not None:
+        result = {'rectime': row[0]}
+        for source, value in zip(SOURCE_COLUMNS, row[1:]):
+            result[source] = cleanReading(source, value)
+
+    return jsonBody(result)
+
+def jsonBody(result):
+    return json.dumps(result, separators = (',', ':')).encode('utf-8'), 'application/json'
+
+ROUTES = {'/range': rangeResponse,
+          '/aggregate': aggregateResponse,
+          '/latest': latestResponse}
+
+# Routes that take start=/end= or hours=
+RANGE_ROUTES = [rangeResponse, aggregateResponse]
+
+
+class TempsHandler(http.server.BaseHTTPRequestHandler):
+    ''' Answers from the server's cache, querying through its pool on a miss '''
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        route = ROUTES.get(url.path)
+        if route is None:
+            self.send_error(404)
+            return
+
+        params = dict(urllib.parse.parse_qsl(url.query))
+        if route in RANGE_ROUTES:
+            try:
+                params = pinRange(params)
+            except ValueError as err:
+                self.send_error(400, str(err))
+                return
+        cacheKey = (url.path, tuple(sorted(params.items())))
+
+        marker = self.server.pool.dataMarker()
+        entry = self.server.cache.get(cacheKey, marker)
+        if entry is None:
+            try:
+                with self.server.pool.connection() as conn:
+                    body, contentType = route(conn, params)
+            except ValueError as err:
+                self.send_error(400, str(err))
+                return
+            except sqlite3.Error as err:
+                self.send_error(503, str(err))
+                return
+
+            etag = '"{}"'.format(hashlib.sha1(body).hexdigest()[:20])
+            entry = (etag, contentType, body)
+            self.server.cache.put(cacheKey, marker, entry)
+
+        etag, contentType, body = entry
+        clientTags = [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]
+
+        if etag in clientTags or '*' in clientTags:
+            self.send_response(304)
+            self.sendCommonHeaders(etag)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.sendCommonHeaders(etag)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def sendCommonHeaders(self, etag):
+        self.send_header('ETag', etag)
+        # Always ask; unchanged data costs a 304
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Access-Control-Allow-Origin', '*')
+
+    def log_message(self, format, *args):
+        if self.server.quiet:
+            return
+        http.server.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class TempsServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, dbPath, poolSize = 4, cacheEntries = 256, quiet = False):
+        self.pool = ReadPool(dbPath, poolSize)
+        self.cache = QueryCache(cacheEntries)
+        self.quiet = quiet
+        http.server.ThreadingHTTPServer.__init__(self, address, TempsHandler)
+
+    def server_close(self):
+        http.server.ThreadingHTTPServer.server_close(self)
+        self.pool.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--db',
+                        required = True,
+                        help = 'SQLite database where data is stored')
+    parser.add_argument('-p', '--port',
+                        type = int,
+                        default = 8080,
+                        help = 'Port to listen on (default 8080)')
+    parser.add_argument('--host',
+                        default = '127.0.0.1',
+                        help = 'Address to listen on (default 127.0.0.1)')
+    parser.add_argument('--pool',
+                        type = int,
+                        default = 4,
+                        help = 'Read-only SQLite connections (default 4)')
+    parser.add_argument('--cache-entries',
+                        type = int,
+                        default = 256,
+                        help = 'Responses to keep cached (default 256)')
+    parser.add_argument('-q', '--quiet',
+                        action = 'store_true',
+                        help = "Don't log each request")
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.db):
+        print('SQLite DB {} does not exist. Exiting....'.format(args.db))
+        quit()
+
+    server = TempsServer((args.host, args.port), args.db, args.pool, args.cache_entries,
+                         args.quiet)
+    print('Serving {} on http://{}:{}/'.format(args.db, args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -4,7 +4,7 @@
 Program:      tempsVis.py
 Author:       Jeff VanSickle
 Created:      20160508
-Modified:     20160514
+Modified:     20261017
 
 Program creates visualization of temperature data using tempsDB.sqlite as
 source. Visualization created using D3.js, cribbed from examples that were
@@ -14,48 +14,177 @@ Severance.
 UPDATES:
     20160510 JV - Remove data specific to my location and filesystem
     20160514 JV - Remove unused code writing close parens to flat file
+    20261017 JV - Load readings with tempsLoader.py (NumPy) and write the
+                  file in one buffered pass
+                  Export incrementally: remember last exported id in a
+                  watermark file and append only newer rows; --full
+                  rebuilds through a temp file and atomic rename
+                  Add -d/-o options for DB and output file
+                  Add -a to include months archived by tempsArchive.py
+                  Read from the Readings table in DBs moved over by
+                  migrateSchema.py, picking up after the watermark's
+                  rectime
+                  Rebuild the file when importTemps.py has loaded rows
+                  older than the watermark (ImportLog table)
 
 INSTRUCTIONS:
     - Replace '<YOUR_SQLITE_DB>' with the location of your SQLite DB where all
-    of your readings reside.
+    of your readings reside, or pass it with -d.
     - After running this code, you will have a flat file, data.tsv, that will
     serve as source for your D3 Javascript page. Open d3Vis.html after you run
     this code to see your D3 visualization.
+    - Later runs append only rows added since the last run. The watermark
+    sits beside the output as data.tsv.watermark; delete it or use --full to
+    start over. Rows older than the watermark loaded by importTemps.py
+    trigger a full rewrite on the next run.
 '''
 
 import sqlite3
-import time
+import argparse
+import json
+import os
+import tempfile
+import tempsLoader
+import tempsArchive
+
+WRITE_BUFFER = 1024 * 1024
+
+# Function to read watermark; None if missing or output file is gone
+def readWatermark(outFile):
+    try:
+        with open(outFile + '.watermark', 'r') as wmHandle:
+            watermark = json.load(wmHandle)
+    except (OSError, ValueError):
+        return None
+
+    if not os.path.isfile(outFile) or os.path.getsize(outFile) < watermark['size']:
+        return None
+
+    return watermark
+
+# Function to give (newest ImportLog id, oldest rectime imported after
+# seenId); importTemps.py adds a row each time it loads readings
+def importsSince(tempsDB, seenId):
+    try:
+        return tempsDB.execute('SELECT MAX(id), MIN(CASE WHEN id > ? THEN oldest END) '
+                               'FROM ImportLog', (seenId,)).fetchone()
+    except sqlite3.OperationalError:
+        return None, None       # Nothing ever imported
+
+# Function to save watermark atomically
+def writeWatermark(outFile, lastId, lastRectime, lastImport):
+    watermark = {'id': lastId,
+                 'rectime': lastRectime,
+                 'imports': lastImport,
+                 'size': os.path.getsize(outFile)}
+    tmpName = outFile + '.watermark.tmp'
+    with open(tmpName, 'w') as wmHandle:
+        json.dump(watermark, wmHandle)
+    os.replace(tmpName, outFile + '.watermark')
+
+# Function to write rows out as TSV lines; error readings go out as-is (999.99)
+def writeRows(fHandle, tempsData):
+    timestamps = tempsLoader.formatRectimes(tempsData['rectime'])
+    readCols = [tempsData[colName].data.tolist() for colName in tempsLoader.READ_COLUMNS]
+
+    fHandle.writelines('\t'.join([timestamp] + [str(reading) for reading in readings]) + '\n'
+                       for timestamp, *readings in zip(timestamps.tolist(), *readCols))
+
+# Get DB and output locations from CLI args
+parser = argparse.ArgumentParser()
+parser.add_argument('-d', '--db',
+                    default = '<YOUR_SQLITE_DB>',
+                    help = 'SQLite database where data is stored')
+parser.add_argument('-o', '--out',
+                    default = 'data.tsv',
+                    help = 'TSV file to write (default data.tsv)')
+parser.add_argument('--full',
+                    action = 'store_true',
+                    help = 'Rewrite the whole file instead of appending new rows')
+parser.add_argument('-a', '--archive',
+                    default = None,
+                    help = 'Archive directory from tempsArchive.py to include')
+args = parser.parse_args()
+outFile = args.out
+
+watermark = None if args.full else readWatermark(outFile)
 
 # Connect to SQLite DB
-tempsDB = sqlite3.connect('<YOUR_SQLITE_DB>')
+tempsDB = sqlite3.connect(args.db)
 tempsDB.text_factory = str
-cursor = tempsDB.cursor()
-
-# Get all data in DB
-cursor.execute('SELECT * FROM Temps WHERE temps_mean < 150.00')
-
-# Write first part of D3 JS source file
-fHandleJS = open('data.tsv','w')
-fHandleJS.write("date\tDark Sky API\tOpenWeatherMap\tWeather2\tWunderground\tHome\tMean\n")
-
-# Start building array data
-# Could be more elegant but is more readable this way
-for msg_row in cursor:
-    timestamp = str(msg_row[1])
-    DSAPI_read = str(msg_row[2])
-    OWM_read = str(msg_row[3])
-    W2_read = str(msg_row[4])
-    WG_read = str(msg_row[5])
-    DS18B20_read = str(msg_row[6])
-    temps_mean = str(msg_row[7])
-
-    lineOut = timestamp + "\t" + DSAPI_read + "\t" + OWM_read + "\t" + \
-              W2_read + "\t" + WG_read + "\t" + DS18B20_read + "\t" + \
-              temps_mean + "\n"
-    fHandleJS.write(lineOut)
-
-# Close out array data
-fHandleJS.close()
+
+# Rows imported since the last run that sort before the watermark can't be
+# appended; start over
+lastImport, oldestImported = importsSince(tempsDB, (watermark.get('imports') or 0) if watermark else 0)
+if watermark and oldestImported is not None and \
+        (watermark['rectime'] is None or oldestImported <= watermark['rectime']):
+    print('Rows older than {} were imported; rewriting {}'.format(watermark['rectime'], outFile))
+    watermark = None
+
+lastId = watermark['id'] if watermark else 0
+
+# Migrated DBs key readings on epoch seconds (see migrateSchema.py). Ids
+# changed in the move, so carry on from the watermark's rectime instead.
+useReadings = tempsLoader.readingsSchema(tempsDB)
+lastRectime = watermark['rectime'] if watermark else None
+
+# Get data added since last export (all data on a full rebuild)
+if useReadings:
+    tempsData = tempsLoader.loadTemps(tempsDB,
+                'SELECT rectime, rectime, dsapi_read, owm_read, w2_read, wg_read, ' +
+                'ds18b20_read, temps_mean FROM Readings ' +
+                'WHERE temps_mean < ' + str(tempsLoader.MEAN_LIMIT) + ' ' +
+                'AND rectime > ? ORDER BY rectime',
+                (tempsLoader.rectimeToEpoch(lastRectime) if lastRectime else -1,),
+                names = ['id', 'rectime'] + tempsLoader.READ_COLUMNS)
+else:
+    tempsData = tempsLoader.loadTemps(tempsDB,
+                'SELECT id, rectime, dsapi_read, owm_read, w2_read, wg_read, ' +
+                'ds18b20_read, temps_mean FROM Temps ' +
+                'WHERE temps_mean < ' + str(tempsLoader.MEAN_LIMIT) + ' ' +
+                'AND id > ? ORDER BY id', (lastId,),
+                names = ['id', 'rectime'] + tempsLoader.READ_COLUMNS)
 
 # Clean up DB connection
 tempsDB.close()
+
+# Put archived rows not yet exported ahead of what is still in SQLite
+if args.archive is not None:
+    archiveReader = tempsArchive.ArchiveReader(args.archive)
+    if useReadings:
+        archivedData = archiveReader.loadRange(start = lastRectime,
+                       names = ['id', 'rectime'] + tempsLoader.READ_COLUMNS)
+        if lastRectime:
+            # loadRange() includes the start; the watermark row is done
+            newRows = archivedData['rectime'] > tempsLoader.parseRectimes([lastRectime])[0]
+            archivedData = {name: values[newRows] for name, values in archivedData.items()}
+        tempsData = tempsLoader.combineColumns(archivedData, tempsData)
+    else:
+        archivedData = archiveReader.loadRange(minId = lastId,
+                       names = ['id', 'rectime'] + tempsLoader.READ_COLUMNS)
+        tempsData = tempsLoader.combineColumns(archivedData, tempsData, key = 'id')
+
+if len(tempsData['id']):
+    lastId = int(tempsData['id'][-1])
+    lastRectime = str(tempsLoader.formatRectimes(tempsData['rectime'][-1:])[0])
+else:
+    lastRectime = watermark['rectime'] if watermark else None
+
+if watermark is None:
+    # Full rebuild: write beside the target, then swap it in atomically so
+    # the D3 page never sees a half-written file
+    outDir = os.path.dirname(os.path.abspath(outFile))
+    fd, tmpName = tempfile.mkstemp(dir = outDir, prefix = '.data.tsv.')
+    with os.fdopen(fd, 'w', buffering = WRITE_BUFFER) as fHandleJS:
+        fHandleJS.write(tempsLoader.TSV_HEADER)
+        writeRows(fHandleJS, tempsData)
+    os.chmod(tmpName, 0o644)
+    os.replace(tmpName, outFile)
+else:
+    with open(outFile, 'r+', buffering = WRITE_BUFFER) as fHandleJS:
+        # Drop anything appended after the watermark was last saved
+        fHandleJS.truncate(watermark['size'])
+        fHandleJS.seek(watermark['size'])
+        writeRows(fHandleJS, tempsData)
+
+writeWatermark(outFile, lastId, lastRectime, lastImport)
@@ -4,7 +4,7 @@
 Program:      weatherAPIs.py
 Author:       Jeff VanSickle
 Created:      20160813
-Modified:     20170730
+Modified:     20261017
 
 Module provides the functions needed to pull weather data from four
 weather APIs:
@@ -30,30 +30,140 @@ UPDATES:
                   Make error reading (999.99) a class global
     20170730 JV - Convert to Python 3
                   Refactor variable names - eliminate camelcase
+    20261017 JV - Add timeout to fetch_JSON so a hung API cannot stall a run
+                  Add get_all() to read every source concurrently with
+                  per-source and per-cycle deadlines
+                  Fetch through a keep-alive ConnectionPool (httpPool.py)
+                  instead of a fresh urlopen connection per call
+                  Serve repeat polls from an optional ResponseCache
+                  (apiCache.py) with per-provider TTLs and revalidation
+                  get_DS18B20() takes the latest reading from an optional
+                  webTemp.Sampler and keeps stats since the previous call
+                  Add get_DS18B20_all() for multiple sensors on the bus;
+                  get_DS18B20() keeps every sensor's reading in sensor_reads
+                  Take shared per-provider rate limiters (rateLimit.py)
+                  Add get_OWM_group() for OpenWeatherMap multi-city queries
+                  Record fetch/parse latency, cache results, errors and
+                  timeouts in collectMetrics.REGISTRY
+                  Make API base URLs class attributes so they can point at
+                  a local stand-in (bench/fakeProviders.py)
+                  get_all() can read a subset of sources (for
+                  pollScheduler.py)
+                  get_all() runs on one long-lived thread pool and won't
+                  start a source while max_in_flight earlier reads of it
+                  are still running
 INSTRUCTIONS:
     - Configure API key environment variables for your accounts
 
 '''
-import urllib
+import urllib.parse
 import json
 import os
+import time
+import threading
+import concurrent.futures
 import webTemp
+from httpPool import ConnectionPool
+from collectMetrics import REGISTRY
 
 class WeatherAPI:
     """ Fetch and store weather data from selected APIs """
 
-    def __init__(self, lat, lon):
+    # Source names, in the order their columns appear in the Temps table
+    sources = ['dsapi', 'owm', 'w2', 'wg', 'ds18b20']
+
+    # API base URLs; set on the class to point every object at a test server
+    dsapi_URL = 'https://api.darksky.net/forecast/'
+    owm_URL = 'http://api.openweathermap.org/data/2.5/weather?'
+    owm_group_URL = 'http://api.openweathermap.org/data/2.5/group?'
+    w2_URL = 'http://www.myweather2.com/developer/forecast.ashx?'
+    wg_URL = 'http://api.wunderground.com/api/'
+
+    def __init__(self, lat, lon, timeout=10.0, pool=None, cache=None, sampler=None,
+                 limiters=None, max_in_flight=1):
         self.latitude = lat
         self.longitude = lon
         self.err_reading = 999.99
-
-    def fetch_JSON(self, fetch_URL):
+        self.timeout = timeout      # Seconds to wait on any one API socket
+
+        # Share a pool between WeatherAPI objects to share connections
+        if pool is None:
+            pool = ConnectionPool(timeout=timeout)
+        self.pool = pool
+        self.cache = cache
+        self.limiters = limiters or {}      # Provider -> RateLimiter
+
+        # Background DS18B20 reader; stats cover the time since last read
+        self.sampler = sampler
+        self.ds18b20_stats = None
+        self.last_ds18b20_read = None
+        self.sensor_reads = {}      # Sensor ID -> reading, from get_DS18B20()
+
+        # get_all() thread pool, made on first use. A read that hangs past
+        # its deadline keeps its thread; at most max_in_flight reads of one
+        # source run at a time, so hung reads can't pile up cycle on cycle.
+        self.max_in_flight = max_in_flight
+        self.executor = None
+        self.in_flight = {source: 0 for source in self.sources}
+        self.in_flight_lock = threading.Lock()
+
+    def fetch_text(self, fetch_URL, provider=None, location=None):
+        """ Return body of fetch_URL as text, using cache if provider given
+
+        Cache entries are keyed on provider and location, which defaults to
+        this object's coordinates. A rate-limited provider that can't get a
+        slot within the timeout reads as None.
+        """
+
+        if location is None:
+            location = self.latitude + ',' + self.longitude
+
+        entry = None
+        if self.cache is not None and provider is not None:
+            entry = self.cache.get(provider, location)
+            if entry is not None and entry['fresh']:
+                REGISTRY.inc('weather_cache_total', {'provider': provider, 'result': 'hit'})
+                return entry['body']
+
+        limiter = self.limiters.get(provider)
+        if limiter is not None and not limiter.acquire(timeout=self.timeout):
+            REGISTRY.inc('weather_errors_total', {'provider': provider, 'kind': 'rate_limited'})
+            return None
+
+        headers = self.cache.conditional_headers(entry) if entry else None
+        try:
+            with REGISTRY.timer('weather_fetch_seconds', {'provider': provider}):
+                status, resp_headers, body = self.pool.request(fetch_URL, headers=headers,
+                                                               timeout=self.timeout)
+        except Exception:
+            REGISTRY.inc('weather_errors_total', {'provider': provider, 'kind': 'exception'})
+            raise
+
+        if status == 304 and entry is not None:
+            REGISTRY.inc('weather_cache_total', {'provider': provider, 'result': 'revalidated'})
+            self.cache.refresh(provider, location)
+            return entry['body']
+        if status != 200:
+            REGISTRY.inc('weather_errors_total', {'provider': provider, 'kind': 'http'})
+            return None
+
+        if self.cache is not None and provider is not None:
+            REGISTRY.inc('weather_cache_total', {'provider': provider, 'result': 'miss'})
+
+        data_in = body.decode('utf-8')
+        if self.cache is not None and provider is not None:
+            self.cache.store(provider, location, data_in, resp_headers)
+
+        return data_in
+
+    def fetch_JSON(self, fetch_URL, provider=None, location=None):
         """ Query API address and return JSON results """
 
-        # Pull data from API
+        # Pull data from API (or cache)
         try:
-            open_URL = urllib.request.urlopen(fetch_URL)
-            data_in = open_URL.read().decode('utf-8')
+            data_in = self.fetch_text(fetch_URL, provider, location)
+            if data_in is None:
+                return None
 
         except:
             results_JSON = None
@@ -61,8 +171,10 @@ class WeatherAPI:
 
         # Grab JSON from retrieved page, if any exists
         try: 
-            results_JSON = json.loads(str(data_in))
+            with REGISTRY.timer('weather_parse_seconds', {'provider': provider}):
+                results_JSON = json.loads(str(data_in))
         except:
+            REGISTRY.inc('weather_errors_total', {'provider': provider, 'kind': 'json'})
             results_JSON = None
 
         # Pretty-print JSON output
@@ -74,12 +186,12 @@ class WeatherAPI:
         """ Retrieve current temperature from Dark Sky API """
 
         # Construct API URL with key and location
-        base_URL = 'https://api.darksky.net/forecast/'
+        base_URL = self.dsapi_URL
         api_key = os.getenv('DS_APIKEY', None)
         data_URL = base_URL + api_key + '/' + self.latitude + ',' + self.longitude
        
         # Get JSON from URL
-        output_JSON = self.fetch_JSON(data_URL)
+        output_JSON = self.fetch_JSON(data_URL, 'dsapi')
 
         # We didn't get any JSON
         if output_JSON is None or len(output_JSON) < 1:
@@ -99,13 +211,13 @@ class WeatherAPI:
         """ Retrieve current temperature from OpenWeatherMap API """
 
         # Construct URL with key, location, and units
-        base_URL = 'http://api.openweathermap.org/data/2.5/weather?'
+        base_URL = self.owm_URL
         api_key = os.getenv('OWM_APIKEY', None)
         data_URL = base_URL + urllib.parse.urlencode({'lat': self.latitude, \
             'lon': self.longitude, 'APPID': api_key, 'units': 'imperial'})
         
         # Get JSON from URL
-        output_JSON = self.fetch_JSON(data_URL)
+        output_JSON = self.fetch_JSON(data_URL, 'owm')
 
         # We didn't get any JSON
         if output_JSON is None or len(output_JSON) < 1:
@@ -121,18 +233,46 @@ class WeatherAPI:
             #print 'Current temp: ', curr_temp
             return return_temp
 
+    def get_OWM_group(self, city_ids):
+        """ Retrieve current temperatures for up to 20 OpenWeatherMap city IDs
+
+        One request covers every city. Returns dict of city ID -> reading;
+        cities missing from the answer read as err_reading.
+        """
+
+        city_ids = [str(city_id) for city_id in city_ids]
+        temps = {city_id: self.err_reading for city_id in city_ids}
+
+        base_URL = self.owm_group_URL
+        api_key = os.getenv('OWM_APIKEY', None)
+        data_URL = base_URL + urllib.parse.urlencode({'id': ','.join(city_ids), \
+            'APPID': api_key, 'units': 'imperial'})
+
+        output_JSON = self.fetch_JSON(data_URL, 'owm', 'group:' + ','.join(city_ids))
+
+        if output_JSON is None or len(output_JSON) < 1:
+            return temps
+
+        for city in output_JSON.get('list', []):
+            try:
+                temps[str(city['id'])] = float(city['main']['temp'])
+            except:
+                pass
+
+        return temps
+
     def get_W2(self):
         """ Retrieve current temperature from Weather2 API """
 
         # Construct URL with key, location, units
-        base_URL = 'http://www.myweather2.com/developer/forecast.ashx?'
+        base_URL = self.w2_URL
         api_key = os.getenv('W2_APIKEY', None)
         loc = self.latitude + ',' + self.longitude
         data_URL = base_URL + urllib.parse.urlencode({'uac': api_key, 'output': 'json', \
                 'query': loc, 'temp_unit': 'f'})
 
         # Get JSON from URL
-        output_JSON = self.fetch_JSON(data_URL)
+        output_JSON = self.fetch_JSON(data_URL, 'w2')
 
         if output_JSON is None or len(output_JSON) < 1:
             return self.err_reading
@@ -152,13 +292,13 @@ class WeatherAPI:
         """ Retrieve current temperature from Wunderground API """
 
         # Contstruct URL with key, geo options
-        base_URL = 'http://api.wunderground.com/api/'
+        base_URL = self.wg_URL
         api_key = os.getenv('WG_APIKEY', None)
         data_URL = base_URL + api_key + '/' + 'geolookup/conditions/q/' + \
                 self.latitude + ',' + self.longitude + '.json'
 
         # Get JSON from URL
-        output_JSON = self.fetch_JSON(data_URL)
+        output_JSON = self.fetch_JSON(data_URL, 'wg')
 
         if output_JSON is None or len(output_JSON) < 1:
             return self.err_reading
@@ -173,13 +313,11 @@ class WeatherAPI:
             #print 'Current temp: ', curr_temp
             return return_temp
 
-    def get_DS18B20(self):
-        """ Retrieve current temperature from DS18B20 sensor at home base """
+    def format_DS18B20(self, temps):
+        """ Turn (temp_C, temp_F) from webTemp into reading, 2 decimal places """
 
-        # Grab reading from DS18B20 sensor
-        temps = webTemp.read_temp()
-        if temps == None:
-            return temps
+        if temps is None:
+            return self.err_reading
 
         temp_F = "%.2f" % temps[1]     # Set precision 2
 
@@ -193,6 +331,121 @@ class WeatherAPI:
 
         return temp_F
 
+    def get_DS18B20_all(self):
+        """ Retrieve current temperature from every DS18B20 sensor at home base
+
+        Returns dict of sensor ID -> reading. Uses the sampler's newest
+        readings if there is a sampler, else reads all sensors at once.
+        """
+
+        if self.sampler is None:
+            all_temps = webTemp.read_all()
+        else:
+            read_time = time.time()
+            self.ds18b20_stats = self.sampler.stats(since=self.last_ds18b20_read)
+            self.last_ds18b20_read = read_time
+
+            all_temps = {}
+            for sensor in self.sampler.sensors():
+                sample = self.sampler.latest(sensor)
+                # Sampler has stopped getting readings from this sensor
+                if sample is None or read_time - sample[0] > 3 * self.sampler.interval + 5:
+                    all_temps[sensor] = None
+                else:
+                    all_temps[sensor] = sample[1:]
+
+        return {sensor: self.format_DS18B20(temps) for sensor, temps in all_temps.items()}
+
+    def get_DS18B20(self):
+        """ Retrieve current temperature from DS18B20 sensor at home base
+
+        Returns the primary sensor's reading, or None if there are no
+        sensors. Readings from all sensors are left in sensor_reads.
+        """
+
+        # Grab readings from DS18B20 sensors, or the sampler's newest ones
+        self.sensor_reads = self.get_DS18B20_all()
+
+        primary = webTemp.primary_sensor()
+        if primary is None:
+            return None
+
+        return self.sensor_reads.get(primary, self.err_reading)
+
+    def get_all(self, source_timeout=None, cycle_timeout=30.0, sources=None):
+        """ Read all sources at once; return dict of source name -> reading
+
+        Each source gets source_timeout seconds (defaults to self.timeout)
+        and the whole cycle gets cycle_timeout seconds. Sources that miss
+        their deadline read as err_reading. The DS18B20 may still return
+        None when no sensor is present, same as get_DS18B20(). If sources
+        is given, only those are read and only they are in the result.
+        """
+
+        if source_timeout is None:
+            source_timeout = self.timeout
+
+        readers = {'dsapi': self.get_DSAPI,
+                   'owm': self.get_OWM,
+                   'w2': self.get_W2,
+                   'wg': self.get_WG,
+                   'ds18b20': self.get_DS18B20}
+        if sources is not None:
+            readers = {name: reader for name, reader in readers.items() if name in sources}
+
+        cycle_start = time.monotonic()
+        cycle_end = cycle_start + cycle_timeout
+        readings = {}
+
+        def timed_read(name, reader):
+            try:
+                with REGISTRY.timer('source_read_seconds', {'source': name}):
+                    return reader()
+            finally:
+                with self.in_flight_lock:
+                    self.in_flight[name] -= 1
+
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=len(self.sources) * self.max_in_flight, thread_name_prefix='source')
+
+        futures = {}
+        for name, reader in readers.items():
+            with self.in_flight_lock:
+                busy = self.in_flight[name] >= self.max_in_flight
+                if not busy:
+                    self.in_flight[name] += 1
+            if busy:
+                # Earlier reads still hung; don't stack another on them
+                REGISTRY.inc('source_busy_total', {'source': name})
+                readings[name] = self.err_reading
+                continue
+            futures[name] = self.executor.submit(timed_read, name, reader)
+
+        # All sources started together, so each deadline is measured from
+        # cycle start and capped by the cycle deadline. Stragglers aren't
+        # waited on; their sockets time out on their own.
+        source_end = min(cycle_start + source_timeout, cycle_end)
+        for name in [name for name in self.sources if name in futures]:
+            wait_for = max(0.0, source_end - time.monotonic())
+            try:
+                readings[name] = futures[name].result(timeout=wait_for)
+            except concurrent.futures.TimeoutError:
+                REGISTRY.inc('source_timeouts_total', {'source': name})
+                readings[name] = self.err_reading
+            except Exception:
+                readings[name] = self.err_reading
+
+        return readings
+
+    def close(self):
+        """ Stop the get_all() thread pool and close pooled connections """
+
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+        self.pool.close()
+
     def get_mean(self, read_1, read_2, read_3, read_4, read_5):
         """ Find mean of non-error readings read_[1-5] """
 
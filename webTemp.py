@@ -4,7 +4,7 @@
 Program:      webTemp.py
 Author:       Simon Monk, Jeff VanSickle
 Created:      20160506
-Modified:     20170130
+Modified:     20261017
 
 Program runs on a Raspberry Pi Model B (1st generation). Reads input from
 DS18B20 digital temperature sensor.
@@ -28,19 +28,68 @@ thermometer-sensor/#prettyPhoto/3/
 UPDATES:
     20170130 JV - Add test condition for bus device file; stop running
                   modprobe unnecessarily
+    20261017 JV - Bound CRC retries in read_temp() and count failures
+                  Only look for the device again after a failed read
+                  Add Sampler thread that reads the sensor continuously
+                  into a ring buffer, with stats over any time window
+                  Support every DS18B20 on the bus: find them once, cache
+                  the list, rescan only after a failed read, and read them
+                  all at the same time
+                  Take the device directory from W1_BASE_DIR if set, for
+                  running against a fake sysfs tree
+                  Cache an empty device list too and rescan it only every
+                  RESCAN_INTERVAL seconds; count CRC failures under a lock
 
 INSTRUCTIONS:
+    - With more than one probe on the bus, the first one by serial number
+      (sorted) is the primary sensor that fills ds18b20_read; the others
+      are kept per sensor by collectTemp.py
 
 ''' 
 
 import time
 import os
 import glob
+import threading
+import collections
+import concurrent.futures
 
-# Find device file for temp sensor
-base_dir = '/sys/bus/w1/devices/'
-device_folder = glob.glob(base_dir + '28*')[0]
-device_file = device_folder + '/w1_slave'
+# Device folders for temp sensors live here, one per sensor (28-<serial>)
+base_dir = os.path.join(os.getenv('W1_BASE_DIR', '/sys/bus/w1/devices/'), '')
+
+# With no sensors found, look again (and rerun modprobe) this often
+RESCAN_INTERVAL = 300.0
+
+crc_failures = 0        # Reads that never got a good CRC
+crc_lock = threading.Lock()     # read_all() counts from several threads
+devices = None          # Cached list of device folders; None means scan
+scanned_at = None       # time.monotonic() of the last scan
+
+def get_devices(rescan=False):
+    '''
+    Finds device folders for all temp sensors on the bus, sorted by serial
+    Attempts to find the physical devices if none are present
+    '''
+
+    global devices, scanned_at
+
+    # Already found them; reads clear the cache if they fail. Finding none
+    # is cached too, until RESCAN_INTERVAL has gone by
+    if devices is not None and not rescan:
+        if devices or time.monotonic() - scanned_at < RESCAN_INTERVAL:
+            return devices
+
+    found = sorted(glob.glob(base_dir + '28*'))
+
+    # Have OS scan for devices if not represented in bus
+    if not found:
+        os.system('sudo modprobe w1-gpio')
+        os.system('sudo modprobe w1-therm')
+        found = sorted(glob.glob(base_dir + '28*'))
+
+    devices = found
+    scanned_at = time.monotonic()
+    return devices
 
 def get_device():
     '''
@@ -48,19 +97,25 @@ def get_device():
     Attempts to find the physical device if files not present
     '''
 
-    # Have OS scan for device if not represented in bus
-    if not os.path.isfile(device_file):
-        os.system('sudo modprobe w1-gpio')
-        os.system('sudo modprobe w1-therm')
+    return len(get_devices()) > 0
+
+def sensor_id(device_folder):
+    ''' Sensor name from its device folder, e.g. 28-000005e2fdc3 '''
+
+    return os.path.basename(device_folder.rstrip('/'))
 
-    if not os.path.isfile(device_file):
-        return False
+def primary_sensor():
+    ''' ID of the sensor that fills ds18b20_read, or None if no sensors '''
 
-    return True
+    found = get_devices()
+    return sensor_id(found[0]) if found else None
 
 
                
-def read_temp_raw():
+def read_temp_raw(device_file=None):
+    if device_file is None:
+        device_file = get_devices()[0] + '/w1_slave'
+
     f = open(device_file, 'r')
     lines = f.readlines()
     f.close()
@@ -69,23 +124,151 @@ def read_temp_raw():
 
 
 
-def read_temp():
+def read_device(device_folder, max_retries=10):
+    '''
+    Returns (temp_c, temp_f) for one sensor, or None if it never gives a
+    good CRC in max_retries tries or can't be read
+    '''
+
+    global devices, crc_failures
+
+    device_file = device_folder + '/w1_slave'
+
+    try:
+        lines = read_temp_raw(device_file)
+        tries = 0
+
+        while len(lines) < 2 or lines[0].strip()[-3:] != 'YES':
+            tries += 1
+            if tries > max_retries:
+                with crc_lock:
+                    crc_failures += 1
+                return None
+            time.sleep(0.2)
+            lines = read_temp_raw(device_file)
+    except OSError:
+        devices = None      # Look for the devices again next time
+        return None
+
+    equals_pos = lines[1].find('t=')
+
+    if equals_pos == -1:
+        return None
+
+    temp_string = lines[1][equals_pos + 2:]
+    temp_c = float(temp_string) / 1000.0
+    temp_f = temp_c * 9.0 / 5.0 + 32.0
+
+    return temp_c, temp_f
+
+
+
+def read_temp(max_retries=10):
+    '''
+    Returns (temp_c, temp_f) from the primary sensor, or None if there is no
+    sensor or it couldn't be read
+    '''
+
     have_therm = get_device()     # Make sure probe available for reading
 
     if not have_therm:
         return None
 
-    lines = read_temp_raw()
+    return read_device(get_devices()[0], max_retries)
 
-    while lines[0].strip()[-3:] != 'YES':
-        time.sleep(0.2)
-        lines = read_temp_raw()
 
-    equals_pos = lines[1].find('t=')
 
-    if equals_pos != -1:
-        temp_string = lines[1][equals_pos + 2:]
-        temp_c = float(temp_string) / 1000.0
-        temp_f = temp_c * 9.0 / 5.0 + 32.0
+def read_all(max_retries=10):
+    '''
+    Returns dict of sensor ID -> (temp_c, temp_f) or None for every sensor.
+    Each read waits on the sensor's conversion, so all sensors are read at
+    once instead of one after another.
+    '''
+
+    found = list(get_devices())
+    if not found:
+        return {}
 
-    return temp_c, temp_f
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(found)) as pool:
+        temps = pool.map(lambda folder: read_device(folder, max_retries), found)
+        return {sensor_id(folder): temp for folder, temp in zip(found, temps)}
+
+
+
+class Sampler(threading.Thread):
+    '''
+    Reads every sensor every interval seconds in the background and keeps
+    the last size readings per sensor in ring buffers, so callers never
+    wait on the sensor's ~750 ms conversion
+    '''
+
+    def __init__(self, interval=5.0, size=720, max_retries=5):
+        threading.Thread.__init__(self, daemon=True)
+        self.interval = interval
+        self.size = size
+        self.max_retries = max_retries
+        self.samples = {}       # sensor ID -> deque of (time, temp_c, temp_f)
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.failed_reads = 0
+
+    def run(self):
+        next_read = time.monotonic()
+
+        while not self.stop_event.is_set():
+            read_time = time.time()
+            for sensor, temps in read_all(self.max_retries).items():
+                if temps is None:
+                    self.failed_reads += 1
+                    continue
+                with self.lock:
+                    if sensor not in self.samples:
+                        self.samples[sensor] = collections.deque(maxlen=self.size)
+                    self.samples[sensor].append((read_time, temps[0], temps[1]))
+
+            next_read += self.interval
+            self.stop_event.wait(max(0.0, next_read - time.monotonic()))
+
+    def stop(self):
+        self.stop_event.set()
+
+    def sensors(self):
+        ''' IDs of sensors that have given at least one reading '''
+
+        with self.lock:
+            return sorted(self.samples)
+
+    def latest(self, sensor=None):
+        '''
+        Newest (time, temp_c, temp_f) for sensor (primary if None), or None if
+        nothing read yet
+        '''
+
+        if sensor is None:
+            sensor = primary_sensor()
+
+        with self.lock:
+            samples = self.samples.get(sensor)
+            return samples[-1] if samples else None
+
+    def stats(self, since=None, sensor=None):
+        '''
+        Returns dict with count, min, max and mean of Fahrenheit readings from
+        sensor (primary if None) taken at or after time since (all buffered
+        readings if None)
+        '''
+
+        if sensor is None:
+            sensor = primary_sensor()
+
+        with self.lock:
+            temps = [sample[2] for sample in self.samples.get(sensor, [])
+                     if since is None or sample[0] >= since]
+
+        if not temps:
+            return {'count': 0, 'min': None, 'max': None, 'mean': None}
+
+        return {'count': len(temps),
+                'min': min(temps),
+                'max': max(temps),
+                'mean': sum(temps) / len(temps)}